@@ -1,10 +1,12 @@
 import discord
 from discord import app_commands
 import os
-import subprocess
 import json
 import asyncio
+import collections
 from dotenv import load_dotenv
+import lokbot.events
+from lokbot.exceptions import NoAuthException
 from lokbot.util import decode_jwt
 import logging
 import psutil
@@ -22,6 +24,46 @@ load_dotenv()
 # Bot processes dictionary to track running instances
 bot_processes = {}
 
+# Recent output lines kept per user, older lines are dropped so the child is never blocked on its pipes
+LOG_BUFFER_LINES = 200
+# Longest output line read at once, longer lines are cut
+LOG_LINE_LIMIT = 1024 * 1024
+
+# `subprocess`: one `python -m lokbot` process per user
+# `runner`: every user's account hosted in this process, see `lokbot.runner.MultiAccountRunner`
+# `supervisor`: accounts sharded across worker processes, see `lokbot.supervisor.Supervisor`
+LOKBOT_BACKEND = os.getenv("LOKBOT_BACKEND", "subprocess")
+
+# created by `run_discord_bot`, worker processes of the supervisor import this module too
+runner = None
+# user id -> account id, for the `runner` and `supervisor` backends
+runner_accounts = {}
+
+
+def create_runner():
+    """Create the account host of the `runner` or `supervisor` backend"""
+    if LOKBOT_BACKEND == "runner":
+        from lokbot.runner import MultiAccountRunner
+
+        return MultiAccountRunner()
+
+    if LOKBOT_BACKEND == "supervisor":
+        from lokbot.supervisor import Supervisor, SupervisorClient
+
+        # `host:port` of a standalone `python -m lokbot.supervisor`
+        address = os.getenv("LOKBOT_SUPERVISOR_ADDRESS")
+        if address:
+            host, port = address.rsplit(":", 1)
+            return SupervisorClient((host, int(port)), os.getenv("LOKBOT_SUPERVISOR_AUTHKEY", "").encode())
+
+        authkey = os.urandom(32)
+        supervisor = Supervisor().start()
+
+        return SupervisorClient(supervisor.serve(("127.0.0.1", 0), authkey), authkey)
+
+    return None
+
+
 # Discord bot setup
 intents = discord.Intents.default()
 client = discord.Client(intents=intents)
@@ -33,8 +75,7 @@ async def start_bot(interaction: discord.Interaction, token: str):
     user_id = str(interaction.user.id)
 
     # Check if this user already has a bot running
-    if user_id in bot_processes and bot_processes[user_id]["process"].poll(
-    ) is None:
+    if user_id in runner_accounts or user_id in bot_processes and bot_processes[user_id]["process"].returncode is None:
         await interaction.response.send_message(
             "You already have a bot running! Stop it first with `/stop`",
             ephemeral=True)
@@ -84,15 +125,32 @@ async def start_bot(interaction: discord.Interaction, token: str):
                 await interaction.followup.send("Token appears to be invalid (too short). Please check your token and try again.", ephemeral=True)
             return
 
-        process = subprocess.Popen(["python", "-m", "lokbot", token],
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE,
-                                   text=True)
+        if runner is not None:
+            await start_in_runner(interaction, user_id, token)
+            return
 
+        # Structured status events of the child, see `lokbot.events`
+        event_read_fd, event_write_fd = os.pipe()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "python", "-m", "lokbot", token,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                limit=LOG_LINE_LIMIT,
+                env={**os.environ, lokbot.events.EVENT_FD_ENV: str(event_write_fd)},
+                pass_fds=(event_write_fd,))
+        except Exception:
+            os.close(event_read_fd)
+            raise
+        finally:
+            os.close(event_write_fd)
+
+        logs = collections.deque(maxlen=LOG_BUFFER_LINES)
         bot_processes[user_id] = {
             "process": process,
             "token": token,
-            "config_path": config_path
+            "config_path": config_path,
+            "logs": logs
         }
 
         # Send confirmation if interaction is still valid
@@ -101,7 +159,7 @@ async def start_bot(interaction: discord.Interaction, token: str):
                                             ephemeral=True)
 
         # Start log monitoring
-        asyncio.create_task(monitor_logs(interaction.user, process))
+        asyncio.create_task(monitor_logs(interaction.user, process, event_read_fd, logs))
 
     except Exception as e:
         logger.error(f"Error starting bot: {str(e)}")
@@ -110,10 +168,40 @@ async def start_bot(interaction: discord.Interaction, token: str):
                                             ephemeral=True)
 
 
+async def start_in_runner(interaction, user_id, token):
+    """Login and start the account on the `runner` or `supervisor` backend"""
+    runner_accounts[user_id] = decode_jwt(token).get('_id')
+
+    try:
+        await asyncio.to_thread(runner.add, token)
+    except NoAuthException:
+        del runner_accounts[user_id]
+        await interaction.followup.send(
+            "❌ Authentication failed! Your token appears to be invalid or expired. Please get a new token and try again.",
+            ephemeral=True)
+        return
+    except Exception as e:
+        del runner_accounts[user_id]
+        logger.error(f"Error starting bot: {str(e)}")
+        await interaction.followup.send(f"Error starting bot: {str(e)}",
+                                        ephemeral=True)
+        return
+
+    await interaction.followup.send("✅ LokBot has successfully connected to the game server!",
+                                    ephemeral=True)
+
+
 @tree.command(name="stop", description="Stop your running LokBot")
 async def stop_bot(interaction: discord.Interaction):
     user_id = str(interaction.user.id)
 
+    if user_id in runner_accounts:
+        await interaction.response.defer(ephemeral=True)
+        await asyncio.to_thread(runner.remove, runner_accounts.pop(user_id))
+        await interaction.followup.send("LokBot stopped successfully",
+                                        ephemeral=True)
+        return
+
     if user_id not in bot_processes:
         await interaction.response.send_message(
             "You don't have a bot running!", ephemeral=True)
@@ -130,11 +218,11 @@ async def stop_bot(interaction: discord.Interaction):
 
         # Terminate the process
         process = bot_processes[user_id]["process"]
-        if process.poll() is None:  # Process is still running
+        if process.returncode is None:  # Process is still running
             process.terminate()
             try:
-                process.wait(timeout=5)  # Wait for process to terminate
-            except subprocess.TimeoutExpired:
+                await asyncio.wait_for(process.wait(), timeout=5)  # Wait for process to terminate
+            except asyncio.TimeoutError:
                 process.kill()  # Force kill if needed
 
         # Send confirmation only if interaction is still valid
@@ -166,9 +254,17 @@ async def status(interaction: discord.Interaction):
             interaction_valid = False
             return
 
-        if user_id in bot_processes:
+        if user_id in runner_accounts:
+            if await asyncio.to_thread(runner.__contains__, runner_accounts[user_id]):
+                await interaction.followup.send(
+                    "Your LokBot is currently running", ephemeral=True)
+            else:
+                await interaction.followup.send(
+                    "Your LokBot has ended", ephemeral=True)
+                del runner_accounts[user_id]
+        elif user_id in bot_processes:
             process = bot_processes[user_id]["process"]
-            if process.poll() is None:  # Process is still running
+            if process.returncode is None:  # Process is still running
                 await interaction.followup.send(
                     "Your LokBot is currently running", ephemeral=True)
             else:
@@ -185,90 +281,76 @@ async def status(interaction: discord.Interaction):
                                             ephemeral=True)
 
 
-async def monitor_logs(user, process):
+async def drain_output(stream, logs, level):
+    """Read every line of a child pipe into the ring buffer"""
+    while True:
+        try:
+            line = await stream.readline()
+        except ValueError:
+            # Longer than LOG_LINE_LIMIT, the rest of the line has been discarded
+            logs.append("[line too long, truncated]")
+            continue
+
+        if not line:
+            return
+
+        stripped = line.decode(errors="replace").rstrip()
+        logs.append(stripped)
+        logger.log(level, f"LokBot Output: {stripped}")
+
+
+async def read_events(fd):
+    """Async line reader over the event pipe of a child"""
+    reader = asyncio.StreamReader()
+    await asyncio.get_running_loop().connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, "rb", 0))
+
+    return reader
+
+
+async def monitor_logs(user, process, event_fd, logs):
     """Monitor bot status and display only essential status updates"""
     try:
         await user.send("✅ Your LokBot is starting up...")
-        
-        auth_error_detected = False
+
+        # Output is only kept for the server logs, status comes from the event pipe
+        drains = [
+            asyncio.create_task(drain_output(process.stdout, logs, logging.DEBUG)),
+            asyncio.create_task(drain_output(process.stderr, logs, logging.WARNING)),
+        ]
+
         startup_complete = False
-        output_buffer = []
-        
-        # Set subprocess pipes to non-blocking mode
-        import fcntl
-        import os
-        
-        # Set stdout to non-blocking
-        stdout_fd = process.stdout.fileno()
-        fl = fcntl.fcntl(stdout_fd, fcntl.F_GETFL)
-        fcntl.fcntl(stdout_fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-        
-        # Set stderr to non-blocking
-        stderr_fd = process.stderr.fileno()
-        fl = fcntl.fcntl(stderr_fd, fcntl.F_GETFL)
-        fcntl.fcntl(stderr_fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-        
-        while True:
-            # Check if process has ended
-            if process.poll() is not None:
-                # Process ended - check if we have an error message
-                if not startup_complete and output_buffer:
-                    error_message = "❌ LokBot failed to start properly. Possible issues:\n"
-                    error_message += "- Invalid or expired token\n"
-                    error_message += "- API connection problems\n"
-                    error_message += "- Server authentication issues\n\n"
-                    error_message += "Check the logs for details and try again with a new token."
-                    await user.send(error_message)
-                break
-
-            # Try to read output without blocking
-            try:
-                output = process.stdout.readline()
-                if output:
-                    stripped_output = output.strip()
-                    logger.info(f"LokBot Output: {stripped_output}")
-                    
-                    # Store recent outputs for error analysis
-                    output_buffer.append(stripped_output)
-                    if len(output_buffer) > 10:  # Keep only the last 10 messages
-                        output_buffer.pop(0)
-                    
-                    # Check for successful startup
-                    if "kingdom/enter" in stripped_output and "result\": true" in stripped_output:
-                        if not startup_complete:
-                            startup_complete = True
-                            await user.send("✅ LokBot has successfully connected to the game server!")
-            except (BlockingIOError, IOError):
-                # No data available right now, continue
-                pass
-
-            # Try to read errors without blocking
+        failed = False
+
+        # Ends when the child exits and closes its end of the pipe
+        async for line in await read_events(event_fd):
             try:
-                error = process.stderr.readline()
-                if error:
-                    stripped_error = error.strip()
-                    logger.error(f"LokBot Error: {stripped_error}")
-                    
-                    # Detect auth errors
-                    if "NoAuthException" in stripped_error or "auth/connect" in stripped_error:
-                        auth_error_detected = True
-                        # Send auth error message
-                        await user.send("❌ Authentication failed! Your token appears to be invalid or expired. Please get a new token and try again.")
-                        return
-                    
-                    # Only send critical errors to Discord
-                    if "CRITICAL" in stripped_error or "ERROR" in stripped_error or "FATAL" in stripped_error:
-                        try:
-                            error_message = "❌ Critical error detected. Check logs for details."
-                            await user.send(error_message)
-                        except discord.errors.HTTPException as e:
-                            logger.error(f"Failed to send Discord error message: {str(e)}")
-            except (BlockingIOError, IOError):
-                # No data available right now, continue
-                pass
-
-            # Wait a bit before checking again
-            await asyncio.sleep(0.1)
+                event = json.loads(line)
+            except ValueError:
+                continue
+
+            if event.get("event") == lokbot.events.EVENT_CONNECTED and not startup_complete:
+                startup_complete = True
+                await user.send("✅ LokBot has successfully connected to the game server!")
+            elif event.get("event") == lokbot.events.EVENT_AUTH_FAILED:
+                failed = True
+                await user.send("❌ Authentication failed! Your token appears to be invalid or expired. Please get a new token and try again.")
+            elif event.get("event") == lokbot.events.EVENT_FATAL:
+                failed = True
+                logger.error(f"LokBot Error: {event.get('error')}")
+                await user.send("❌ Critical error detected. Check logs for details.")
+
+        await process.wait()
+        await asyncio.gather(*drains)
+
+        if not startup_complete and not failed:
+            logger.error("LokBot exited before connecting, last output:\n" + "\n".join(list(logs)[-10:]))
+            error_message = "❌ LokBot failed to start properly. Possible issues:\n"
+            error_message += "- Invalid or expired token\n"
+            error_message += "- API connection problems\n"
+            error_message += "- Server authentication issues\n\n"
+            error_message += "Check the logs for details and try again with a new token."
+            await user.send(error_message)
 
         # Notify when the process has ended
         await user.send("❌ Your LokBot has stopped running.")
@@ -322,6 +404,9 @@ def run_discord_bot():
         logger.error("Error: DISCORD_BOT_TOKEN not found in environment")
         return
 
+    global runner
+    runner = create_runner()
+
     # Start HTTP server to keep the bot alive
     run_http_server()
 
@@ -25,6 +25,18 @@ def load_config():
 
 config = load_config()
 
+LOG_SUFFIX_ENV = 'LOKBOT_LOG_SUFFIX'  # set by `lokbot.supervisor` for each worker process
+
+
+def log_path(name):
+    """
+    `data/{name}.log`, a worker process of `lokbot.supervisor` writes `data/{name}.worker-{index}.log` instead
+    :return:
+    """
+    suffix = os.environ.get(LOG_SUFFIX_ENV)
+
+    return project_root.joinpath(f'data/{name}.{suffix}.log' if suffix else f'data/{name}.log')
+
 # region socket-io related loggers
 
 socf_logger = logging.getLogger(f'{__name__}.socf')
@@ -38,24 +50,35 @@ if config.get('socketio').get('debug'):
 
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-socf_file_channel = logging.handlers.TimedRotatingFileHandler(
-    project_root.joinpath('data/socf.log'), interval=1, when='H', backupCount=48
-)
-socf_file_channel.setFormatter(formatter)
-socf_logger.addHandler(socf_file_channel)
-sock_file_channel = logging.handlers.TimedRotatingFileHandler(
-    project_root.joinpath('data/sock.log'), interval=1, when='H', backupCount=48
-)
-sock_file_channel.setFormatter(formatter)
-sock_logger.addHandler(sock_file_channel)
-socc_file_channel = logging.handlers.TimedRotatingFileHandler(
-    project_root.joinpath('data/socc.log'), interval=1, when='H', backupCount=48
-)
-socc_file_channel.setFormatter(formatter)
-socc_logger.addHandler(socc_file_channel)
+log_pipeline = None
+
+if config.get('logging', {}).get('queued'):
+    # imported here, `lokbot.log_pipeline` needs the names above
+    import lokbot.log_pipeline
+
+    logger.remove()
+    log_pipeline = lokbot.log_pipeline.install(
+        config.get('logging'), formatter, {'socf': socf_logger, 'sock': sock_logger, 'socc': socc_logger}
+    )
+else:
+    socf_file_channel = logging.handlers.TimedRotatingFileHandler(
+        log_path('socf'), interval=1, when='H', backupCount=48
+    )
+    socf_file_channel.setFormatter(formatter)
+    socf_logger.addHandler(socf_file_channel)
+    sock_file_channel = logging.handlers.TimedRotatingFileHandler(
+        log_path('sock'), interval=1, when='H', backupCount=48
+    )
+    sock_file_channel.setFormatter(formatter)
+    sock_logger.addHandler(sock_file_channel)
+    socc_file_channel = logging.handlers.TimedRotatingFileHandler(
+        log_path('socc'), interval=1, when='H', backupCount=48
+    )
+    socc_file_channel.setFormatter(formatter)
+    socc_logger.addHandler(socc_file_channel)
+
+    logger.remove()
+    logger.add(log_path('main'), rotation='1 hour', retention=48)
+    logger.add(sys.stdout, colorize=True)
 
 # endregion
-
-logger.remove()
-logger.add(project_root.joinpath('data/main.log'), rotation='1 hour', retention=48)
-logger.add(sys.stdout, colorize=True)
@@ -1,10 +1,22 @@
+import sys
 
 import fire
 
-from lokbot.app import main
+# `python -m lokbot bench`, imported on demand to keep the bot startup as it is
+commands = {
+    'bench': 'lokbot.bench',
+    'traffic': 'lokbot.field_traffic',
+    'profile': 'lokbot.profiling',
+    'trace': 'lokbot.tracing',
+    'reaction': 'lokbot.reaction',
+}
 
-if __name__ == "__main__":
-    fire.Fire(main)
+if len(sys.argv) > 1 and sys.argv[1] in commands:
+    import importlib
+
+    command = importlib.import_module(commands[sys.argv[1]])
+    fire.Fire(command.main, sys.argv[2:], f'lokbot {sys.argv[1]}')
 else:
-    # Allow running with fire CLI or directly
+    from lokbot.app import main
+
     fire.Fire(main)
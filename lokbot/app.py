@@ -1,15 +1,19 @@
 import asyncio
 import functools
-import threading
 import time
 
-import schedule
-
+import lokbot.events
+import lokbot.profiling
 import lokbot.util
+import lokbot.watchdog
 from lokbot import project_root, logger, config
-from lokbot.async_farmer import AsyncLokFarmer
+from lokbot.async_farmer import AsyncLokFarmer, run_farmers
 from lokbot.exceptions import NoAuthException
 from lokbot.farmer import LokFarmer
+from lokbot.scheduler import Scheduler, LANE_BLOCKING
+
+# jobs holding a worker for seconds, they run on the workers of `LANE_BLOCKING`
+BLOCKING_JOBS = ('socf_thread', 'hospital_recover', 'mail_claim', 'use_resource_in_item_list')
 
 
 def find_alliance(farmer: LokFarmer):
@@ -23,79 +27,138 @@ def find_alliance(farmer: LokFarmer):
         time.sleep(60 * 5)
 
 
-thread_map = {}
-
-
-def run_threaded(name, job_func):
-    if name in thread_map and thread_map[name].is_alive():
-        return
-
-    job_thread = threading.Thread(target=job_func, name=name, daemon=True)
-    thread_map[name] = job_thread
-    job_thread.start()
-
-
-def async_main(token):
-    async_farmer = AsyncLokFarmer(token)
-
-    asyncio.run(async_farmer.parallel_buy_caravan())
-
+def create_farmer(token, captcha_solver_config, scheduler=None, transport=None):
+    """
+    login with the token saved in `data/` if it is still valid, otherwise with the given one
+    """
+    _id = lokbot.util.decode_jwt(token).get('_id')
+    token_file = project_root.joinpath(f'data/{_id}.token')
+    if token_file.exists():
+        token_from_file = token_file.read_text()
+        logger.info(f'Using token: {token_from_file} from file: {token_file}')
+        try:
+            return LokFarmer(token_from_file, captcha_solver_config, scheduler, transport)
+        except NoAuthException:
+            logger.info('Token is invalid, using token from environment')
 
-def main(token=None, captcha_solver_config=None):
-    # async_main(token)
-    # exit()
+    return LokFarmer(token, captcha_solver_config, scheduler, transport)
 
-    if captcha_solver_config is None:
-        captcha_solver_config = {}
-    
-    # Get token from environment variable if not provided
-    if token is None:
-        import os
-        token = os.getenv("AUTH_TOKEN")
-        if not token:
-            logger.error("No AUTH_TOKEN found in environment variables. Please add it to Secrets.")
-            return
 
+async def create_async_farmer(token, captcha_solver_config=None):
+    """
+    coroutine version of `create_farmer`, a farmer with the token from environment is set up by its `run`
+    """
     _id = lokbot.util.decode_jwt(token).get('_id')
     token_file = project_root.joinpath(f'data/{_id}.token')
     if token_file.exists():
         token_from_file = token_file.read_text()
         logger.info(f'Using token: {token_from_file} from file: {token_file}')
+        farmer = AsyncLokFarmer(token_from_file, captcha_solver_config)
         try:
-            farmer = LokFarmer(token_from_file, captcha_solver_config)
+            await farmer.setup()
+            return farmer
         except NoAuthException:
             logger.info('Token is invalid, using token from environment')
-            farmer = LokFarmer(token, captcha_solver_config)
-    else:
-        farmer = LokFarmer(token, captcha_solver_config)
 
-    threading.Thread(target=farmer.sock_thread, daemon=True).start()
-    threading.Thread(target=farmer.socc_thread, daemon=True).start()
+    return AsyncLokFarmer(token, captcha_solver_config)
+
+
+async def run_async_farmers(tokens, captcha_solver_config, main_config):
+    """
+    create the farmers of `tokens`, then run them together, an account failing to login does not stop the others
+    """
+    farmers = await asyncio.gather(
+        *[create_async_farmer(token, captcha_solver_config) for token in tokens], return_exceptions=True
+    )
+
+    for token, farmer in zip(tokens, farmers):
+        if isinstance(farmer, Exception):
+            logger.error(f'farmer {lokbot.util.decode_jwt(token).get("_id")} failed to login: {farmer!r}')
+
+    await run_farmers([farmer for farmer in farmers if not isinstance(farmer, Exception)], main_config)
+
+
+def start_farmer(farmer: LokFarmer, main_config):
+    """
+    start the websockets of the farmer and register the jobs and threads of `main_config` on its scheduler
+    """
+    farmer.start_socket('sock_thread')
+    farmer.start_socket('socc_thread')
 
     farmer.keepalive_request()
 
-    for job in config.get('main').get('jobs'):
+    for name in main_config.get('scheduler', {}).get('blocking_jobs', BLOCKING_JOBS):
+        farmer.scheduler.set_lane(name, LANE_BLOCKING)
+
+    for job in main_config.get('jobs'):
         if not job.get('enabled'):
             continue
 
         name = job.get('name')
 
-        schedule.every(
-            job.get('interval').get('start')
-        ).to(
-            job.get('interval').get('end')
-        ).minutes.do(run_threaded, name, functools.partial(getattr(farmer, name), **job.get('kwargs', {})))
-
-    schedule.run_all()
+        farmer.scheduler.every(
+            name,
+            job.get('interval').get('start') * 60,
+            job.get('interval').get('end') * 60,
+            functools.partial(getattr(farmer, name), **job.get('kwargs', {}))
+        )
 
-    # schedule.every(15).to(20).minutes.do(farmer.keepalive_request)
-
-    for thread in config.get('main').get('threads'):
+    threads = {}
+    for thread in main_config.get('threads'):
         if not thread.get('enabled'):
             continue
 
-        threading.Thread(target=getattr(farmer, thread.get('name')), kwargs=thread.get('kwargs'), daemon=True).start()
+        name = thread.get('name')
+        threads[name] = functools.partial(getattr(farmer, name), **(thread.get('kwargs') or {}))
+        farmer.scheduler.submit(name, threads[name])
+
+    watchdog_config = main_config.get('watchdog', {})
+    if watchdog_config.get('enabled'):
+        farmer.watch(watchdog_config.get('loops', {}), threads)
+
+        interval = watchdog_config.get('interval', lokbot.watchdog.CHECK_INTERVAL)
+        farmer.scheduler.every('watchdog', interval, interval, farmer.watchdog.check, run_now=False)
+
+
+def async_main(*tokens, captcha_solver_config=None):
+    """
+    run one or many accounts on a single asyncio event loop
+    """
+    asyncio.run(run_async_farmers(tokens, captcha_solver_config, config.get('main')))
+
+
+def main(token=None, captcha_solver_config=None):
+    if captcha_solver_config is None:
+        captcha_solver_config = {}
+    
+    # Get token from environment variable if not provided
+    if token is None:
+        import os
+        token = os.getenv("AUTH_TOKEN")
+        if not token:
+            logger.error("No AUTH_TOKEN found in environment variables. Please add it to Secrets.")
+            return
+
+    lokbot.profiling.install(config.get('profiling', {}))
+
+    try:
+        if config.get('main').get('runtime') == 'asyncio':
+            async_main(token, captcha_solver_config=captcha_solver_config)
+            return
+
+        scheduler_config = config.get('main').get('scheduler', {})
+        scheduler = Scheduler(scheduler_config.get('workers', 4), lanes=scheduler_config.get('lanes'))
+
+        farmer = create_farmer(token, captcha_solver_config, scheduler)
+        lokbot.events.emit(lokbot.events.EVENT_CONNECTED, _id=farmer._id)
+        start_farmer(farmer, config.get('main'))
+    except NoAuthException:
+        lokbot.events.emit(lokbot.events.EVENT_AUTH_FAILED)
+        raise
+    except Exception as e:
+        lokbot.events.emit(lokbot.events.EVENT_FATAL, error=repr(e))
+        raise
 
     while True:
-        schedule.run_pending()
-        time.sleep(1)
+        logger.debug(f'scheduled jobs: {scheduler.jobs()}')
+        time.sleep(600)
@@ -1,27 +1,103 @@
+import asyncio
+import base64
+import functools
 import json
+import time
 
 import httpx
+import tenacity
 
 import lokbot.enum
-from lokbot import logger
+import lokbot.rate_control
+import lokbot.tracing
+from lokbot import logger, config, project_root
+from lokbot.client import BaseLokBotApi
+from lokbot.circuit_breaker import AsyncCircuitBreaker
+from lokbot.exceptions import *
+from lokbot.rate_control import AdaptiveRates
+from lokbot.request_scheduler import AsyncRequestScheduler
 
 
-class AsyncLokBotApi:
-    def __init__(self, access_token):
+def limits(calls, period):
+    """
+    per-instance adaptive rate limit of an `AsyncLokBotApi` coroutine method, waits for a free slot instead of raising
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            while True:
+                wait = self.rates.acquire(func.__name__, calls / period)
+                if not wait:
+                    break
+
+                lokbot.tracing.add('limiter_wait_seconds', wait)
+                await asyncio.sleep(wait)
+
+            token = lokbot.rate_control.current_endpoint.set(func.__name__)
+            try:
+                return await func(self, *args, **kwargs)
+            finally:
+                lokbot.rate_control.current_endpoint.reset(token)
+
+        return wrapper
+
+    return decorator
+
+
+class AsyncLokBotApi(BaseLokBotApi):
+    def __init__(self, token, captcha_solver_config=None, request_callback=None):
+        super().__init__(token)
         self.opener = httpx.AsyncClient(
             headers={
-                'User-Agent': 'BestHTTP',
-                'x-access-token': access_token
+                'Accept': '*/*',
+                'Accept-Encoding': 'gzip, deflate, br',
+                'Accept-Language': 'en-US,en;q=0.9',
+                'Origin': 'https://play.leagueofkingdoms.com',
+                'Referer': 'https://play.leagueofkingdoms.com/',
+                'Sec-Fetch-Dest': 'empty',
+                'Sec-Fetch-Mode': 'cors',
+                'Sec-Fetch-Site': 'same-site',
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/114.0',
+                'X-Access-Token': token
             },
             http2=True,
             base_url=lokbot.enum.API_BASE_URL
         )
+        self.request_callback = request_callback
+        self.request_scheduler = AsyncRequestScheduler(**config.get('main', {}).get('request_scheduler', {}))
+        self.breaker = AsyncCircuitBreaker()
+        self.rates = AdaptiveRates(
+            project_root.joinpath(f'data/{self._id}.rates.json'), **config.get('main', {}).get('adaptive_rate', {})
+        )
+        self.request_scheduler.set_rate(self.rates.rate(lokbot.rate_control.POST, self.request_scheduler.rate))
 
-    async def post(self, url, json_data=None):
+        self.last_requested_at = time.time()
+
+        self.captcha_solver = None
+        if captcha_solver_config and 'ttshitu' in captcha_solver_config:
+            from lokbot.captcha_solver import Ttshitu
+            self.captcha_solver = Ttshitu(**captcha_solver_config['ttshitu'])
+
+    async def request(self, url, json_data=None):
+        """
+        single round trip without client-side rate limit and error handling
+        :return:
+        """
         if json_data is None:
             json_data = {}
 
-        response = await self.opener.post(url, data={'json': json.dumps(json_data)})
+        api_path = str(url).split('/api/').pop()
+        post_data = self._encode_request(api_path, json_data)
+
+        # remove request cookie since it's not needed and may cause account ban
+        self.opener.cookies.clear()
+
+        started_at = time.perf_counter()
+        response = await self.opener.post(url, data={'json': post_data})
+        self.last_requested_at = time.time()
+        lokbot.tracing.add('network_seconds', time.perf_counter() - started_at)
+        lokbot.tracing.add('attempts', 1)
 
         log_data = {
             'url': url,
@@ -29,21 +105,321 @@ class AsyncLokBotApi:
             'elapsed': response.elapsed.total_seconds(),
         }
 
+        started_at = time.perf_counter()
         try:
-            json_response = response.json()
+            json_response = self._decode_response(api_path, response.text)
         except json.JSONDecodeError:
             log_data.update({'res': response.text})
             logger.error(log_data)
 
-            return None
+            raise
+        finally:
+            lokbot.tracing.add('decode_seconds', time.perf_counter() - started_at)
 
         log_data.update({'res': json_response})
         logger.debug(json.dumps(log_data))
 
         return json_response
 
+    @lokbot.tracing.traced()
+    @tenacity.retry(
+        stop=tenacity.stop_after_attempt(2),
+        wait=tenacity.wait_random_exponential(multiplier=1, max=60),
+        # general http error or json decode error
+        retry=tenacity.retry_if_exception_type((httpx.HTTPError, json.JSONDecodeError)),
+        before_sleep=lokbot.tracing.before_sleep,
+        reraise=True
+    )
+    # server-side rate limiters, the retry waits in `self.breaker` until the circuit they opened is probed
+    @tenacity.retry(
+        retry=tenacity.retry_if_exception_type(DuplicatedException),
+        before_sleep=lokbot.tracing.before_sleep,
+    )
+    @tenacity.retry(
+        retry=tenacity.retry_if_exception_type(ExceedLimitPacketException),
+        before_sleep=lokbot.tracing.before_sleep,
+    )
+    async def post(self, url, json_data=None):
+        api_path = str(url).split('/api/').pop()
+        await self.request_scheduler.acquire(api_path)
+        if await self.breaker.wait(api_path):
+            # the waiting requests are released together when the circuit closes, space them out again
+            await self.request_scheduler.acquire(api_path)
+
+        try:
+            json_response = await self.request(url, json_data)
+        except (httpx.HTTPError, json.JSONDecodeError) as e:
+            await self.breaker.release(api_path)
+            if isinstance(e, httpx.HTTPError):
+                self._adapt_rate(False)
+            raise
+
+        if json_response.get('result'):
+            await self.breaker.record(api_path)
+            self._adapt_rate(True)
+
+            if callable(self.request_callback):
+                self.request_callback(json_response)
+
+            return json_response
+
+        code = json_response.get('err').get('code')
+        await self.breaker.record(api_path, code)
+        self._adapt_rate(code not in lokbot.rate_control.PUSHBACK_CODES)
+
+        if code == 'need_captcha':
+            if not self.captcha_solver:
+                raise NeedCaptchaException()
+
+            await self._solve_captcha()
+
+            raise DuplicatedException()
+
+        self._raise_for_error(code)
+
+    async def batch(self, calls):
+        """
+        `LokBotApi.batch` of coroutine methods, run as concurrent tasks
+        :return: the result of each call, or the exception it raised, in the order of `calls`
+        """
+        coros = []
+        for call in calls:
+            func, *args = call if isinstance(call, tuple) else (call,)
+            coros.append(func(*args))
+
+        return await asyncio.gather(*coros, return_exceptions=True)
+
+    @tenacity.retry(
+        stop=tenacity.stop_after_attempt(4),
+        wait=tenacity.wait_random_exponential(multiplier=1, max=60)
+    )
+    async def _solve_captcha(self):
+        loop = asyncio.get_running_loop()
+        picture_base64 = base64.b64encode((await self.opener.get('auth/captcha')).content).decode()
+
+        def captcha_confirm_func(_captcha):
+            future = asyncio.run_coroutine_threadsafe(self.auth_captcha_confirm(_captcha), loop)
+
+            return future.result().get('valid')
+
+        # the solver is a blocking http client
+        solved = await asyncio.to_thread(
+            self.captcha_solver.solve, lambda: picture_base64, captcha_confirm_func
+        )
+
+        if not solved:
+            raise tenacity.TryAgain()
+
+    @limits(calls=1, period=2)
+    async def auth_captcha_confirm(self, value):
+        return await self.post('auth/captcha/confirm', {'value': value})
+
+    async def auth_connect(self, json_data=None):
+        try:
+            res = await self.post('https://lok-api-live.leagueofkingdoms.com/api/auth/connect', json_data)
+        except OtherException:
+            # {"result":false,"err":{}} when no auth
+            project_root.joinpath(f'data/{self._id}.token').unlink(missing_ok=True)
+            raise NoAuthException()
+
+        self.opener.headers['x-access-token'] = res['token']
+
+        return res
+
+    async def auth_set_device_info(self, device_info):
+        return await self.post('auth/setDeviceInfo', {'deviceInfo': device_info})
+
+    async def auth_analytics(self, url, param):
+        return await self.post('auth/analytics', {'url': url, 'param': param})
+
+    async def alliance_research_list(self):
+        return await self.post('alliance/research/list')
+
+    async def alliance_research_donate_all(self, code):
+        return await self.post('alliance/research/donateAll', {'code': code})
+
+    async def alliance_shop_list(self):
+        return await self.post('alliance/shop/list')
+
+    async def alliance_shop_buy(self, code, amount):
+        return await self.post('alliance/shop/buy', {'code': code, 'amount': amount})
+
+    async def alliance_gift_claim_all(self):
+        return await self.post('alliance/gift/claim/all')
+
+    async def alliance_help_all(self):
+        return await self.post('alliance/help/all')
+
+    async def chat_logs(self, chat_channel):
+        return await self.post('chat/logs', {'chatChannel': chat_channel})
+
+    async def quest_main(self):
+        return await self.post('quest/main')
+
+    async def quest_list(self):
+        return await self.post('quest/list')
+
+    async def quest_list_daily(self):
+        return await self.post('quest/list/daily')
+
+    @limits(calls=1, period=1)
+    async def quest_claim(self, quest):
+        return await self.post('quest/claim', {'questId': quest.get('_id'), 'code': quest.get('code')})
+
+    @limits(calls=1, period=1)
+    async def quest_claim_daily(self, quest):
+        return await self.post('quest/claim/daily', {'questId': quest.get('_id'), 'code': quest.get('code')})
+
+    @limits(calls=1, period=1)
+    async def quest_claim_daily_level(self, reward):
+        return await self.post('quest/claim/daily/level', {'level': reward.get('level')})
+
+    async def pkg_recommend(self):
+        return await self.post('pkg/recommend')
+
+    async def pkg_list(self):
+        return await self.post('pkg/list')
+
+    async def event_roulette_open(self):
+        return await self.post('event/roulette/open')
+
+    async def event_cvc_open(self):
+        return await self.post('event/cvc/open')
+
+    async def event_list(self):
+        return await self.post('event/list')
+
+    @limits(calls=1, period=2)
+    async def event_info(self, root_event_id):
+        return await self.post('event/info', {'rootEventId': root_event_id})
+
+    @limits(calls=1, period=1)
+    async def event_claim(self, event_id, event_target_id, code):
+        return await self.post('event/claim', {'eventId': event_id, 'eventTargetId': event_target_id, 'code': code})
+
+    async def drago_lair_list(self):
+        return await self.post('drago/lair/list')
+
+    async def train_troop(self, troop_code, amount):
+        return await self.post('kingdom/barrack/train', {'troopCode': troop_code, 'amount': amount, 'instant': 0})
+
+    async def kingdom_wall_info(self):
+        return await self.post('kingdom/wall/info')
+
+    async def kingdom_wall_repair(self):
+        return await self.post('kingdom/wall/repair')
+
+    async def kingdom_treasure_list(self):
+        return await self.post('kingdom/treasure/list')
+
+    async def kingdom_enter(self):
+        res = await self.post('https://lok-api-live.leagueofkingdoms.com/api/kingdom/enter')
+
+        captcha = res.get('captcha')
+        if captcha and captcha.get('next'):
+            if not self.captcha_solver:
+                raise NeedCaptchaException()
+
+            await self._solve_captcha()
+
+        return res
+
+    async def kingdom_task_all(self):
+        return await self.post('kingdom/task/all')
+
+    @limits(calls=1, period=4)
+    async def kingdom_task_claim(self, position):
+        return await self.post('kingdom/task/claim', {'position': position})
+
+    @limits(calls=1, period=2)
+    async def kingdom_task_speedup(self, task_id, code, amount, is_buy=0):
+        res = await self.post(
+            'kingdom/task/speedup', {'taskId': task_id, 'code': code, 'amount': amount, 'isBuy': is_buy}
+        )
+
+        await self.auth_analytics('item/use', f'{code}|{amount}')
+
+        return res
+
+    @limits(calls=1, period=2)
+    async def kingdom_heal_speedup(self, code, amount, is_buy=0):
+        res = await self.post('kingdom/heal/speedup', {'code': code, 'amount': amount, 'isBuy': is_buy})
+
+        await self.auth_analytics('item/use', f'{code}|{amount}')
+
+        return res
+
+    async def kingdom_academy_research_list(self):
+        return await self.post('kingdom/arcademy/research/list')
+
+    async def kingdom_hospital_recover(self):
+        return await self.post('kingdom/hospital/recover')
+
+    async def kingdom_hospital_wounded(self):
+        return await self.post('kingdom/hospital/wounded')
+
+    @limits(calls=1, period=4)
+    async def kingdom_resource_harvest(self, position):
+        return await self.post('kingdom/resource/harvest', {'position': position})
+
+    @limits(calls=1, period=6)
+    async def kingdom_building_upgrade(self, building, instant=0):
+        return await self.post('kingdom/building/upgrade', {
+            'position': building.get('position'),
+            'level': building.get('level'),
+            'instant': instant
+        })
+
+    @limits(calls=1, period=6)
+    async def kingdom_building_build(self, building, instant=0):
+        return await self.post('kingdom/building/build', {
+            'position': building.get('position'),
+            'buildingCode': building.get('code'),
+            'instant': instant
+        })
+
+    @limits(calls=1, period=6)
+    async def kingdom_academy_research(self, research, instant=0):
+        return await self.post('kingdom/arcademy/research', {
+            'researchCode': research.get('code'),
+            'instant': instant
+        })
+
+    async def kingdom_vip_info(self):
+        return await self.post('kingdom/vip/info')
+
+    async def kingdom_vip_claim(self):
+        return await self.post('kingdom/vip/claim')
+
     async def kingdom_caravan_list(self):
         return await self.post('kingdom/caravan/list')
 
     async def kingdom_caravan_buy(self, caravan_item_id):
+        # not rate limited on purpose, see `AsyncLokFarmer.parallel_buy_caravan`
+        return await self.request('kingdom/caravan/buy', {'caravanItemId': caravan_item_id})
+
+    @limits(calls=1, period=4)
+    async def kingdom_caravan_buy_limited(self, caravan_item_id):
         return await self.post('kingdom/caravan/buy', {'caravanItemId': caravan_item_id})
+
+    async def item_list(self):
+        return await self.post('item/list')
+
+    @limits(calls=1, period=2)
+    async def item_use(self, code, amount=1):
+        res = await self.post('item/use', {'code': code, 'amount': amount})
+
+        await self.auth_analytics('item/use', f'{code}|{amount}')
+
+        return res
+
+    @limits(calls=1, period=4)
+    async def item_free_chest(self, _type=0):
+        return await self.post('item/freechest', {'type': _type})
+
+    @limits(calls=1, period=2)
+    async def mail_claim_all(self, category=1):
+        return await self.post('mail/claim/all', {'category': category})
+
+    async def field_worldmap_devrank(self):
+        return await self.post('field/worldmap/devrank')
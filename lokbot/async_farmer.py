@@ -1,14 +1,1126 @@
 import asyncio
+import collections
+import functools
+import itertools
+import json
+import random
+import time
 
-import lokbot.async_client
+import arrow
 
+import lokbot.async_client
 import lokbot.enum
+import lokbot.events
+import lokbot.field_session
+import lokbot.metrics
+import lokbot.request_scheduler
+import lokbot.tracing
+import lokbot.util
+from lokbot import logger, socf_logger, sock_logger, socc_logger, project_root
+from lokbot.connection import AsyncManagedSocket
+from lokbot.enum import *
+from lokbot.exceptions import OtherException, NoAuthException
+from lokbot.farmer import BaseFarmer, ws_headers, land_with_level_cache, land_with_level_lock
+from lokbot.planner import Planner
+from lokbot.state import KingdomState
+from lokbot.tasks import AsyncTaskTracker, QUEUE_BUILDING, QUEUE_ACADEMY, QUEUE_CAMP
+from lokbot.watchdog import Watchdog, CHECK_INTERVAL
+
 
+class AsyncLokFarmer(BaseFarmer):
+    """
+    asyncio counterpart of `lokbot.farmer.LokFarmer`, every job is a coroutine on a single event loop
+    """
 
-class AsyncLokFarmer:
-    def __init__(self, token, concurrency=50):
-        self.api = lokbot.async_client.AsyncLokBotApi(token)
+    def __init__(self, token, captcha_solver_config=None, concurrency=50):
+        self.token = token
+        self.api = lokbot.async_client.AsyncLokBotApi(token, captcha_solver_config, self._request_callback)
         self.concurrency = concurrency
+        self._id = lokbot.util.decode_jwt(token).get('_id')
+
+        self.kingdom_enter = None
+        self.alliance_id = None
+        self.state = KingdomState()
+        self.tasks = AsyncTaskTracker(self.state, self.api)
+        self.planner = Planner(self.state)
+        self.watchdog = Watchdog()
+        self.sio_clients = {}
+        self.loop_tasks = {}  # {name: task}, of the loops the watchdog may restart
+        self.restarting = set()
+        self.has_additional_building_queue = False
+        self.level = 0
+        self.zone_scheduler = None
+        self.started_at = time.time()
+        self.buff_item_use_lock = asyncio.Lock()
+        self.hospital_recover_lock = asyncio.Lock()
+        self.background_tasks = set()
+
+    async def setup(self):
+        """
+        login and enter the kingdom, same as `LokFarmer.__init__`
+        :return:
+        """
+        auth_res = await self.api.auth_connect({"deviceInfo": {"build": "global"}})
+        self.api.load_auth_connect(auth_res)
+        self.token = auth_res.get('token')
+        project_root.joinpath(f'data/{self._id}.token').write_text(self.token)
+
+        self.kingdom_enter = await self.api.kingdom_enter()
+        self.alliance_id = self.kingdom_enter.get('kingdom', {}).get('allianceId')
+
+        await self.api.auth_set_device_info({
+            "build": "global",
+            "OS": "Windows 10",
+            "country": "USA",
+            "language": "English",
+            "bundle": "",
+            "version": "1.1694.152.229",
+            "platform": "web",
+            "pushId": ""
+        })
+
+        chat_channels = [f'w{self.kingdom_enter.get("kingdom").get("worldId")}']
+        if self.alliance_id:
+            chat_channels.append(f'a{self.alliance_id}')
+        for result in await self.api.batch([(self.api.chat_logs, channel) for channel in chat_channels]):
+            if isinstance(result, Exception):
+                raise result
+
+        self.state.load_kingdom(self.kingdom_enter.get('kingdom'))
+        self.has_additional_building_queue = self.kingdom_enter.get('kingdom').get('vip', {}).get('level') >= 5
+        self.level = self.kingdom_enter.get('kingdom').get('level')
+        self.started_at = time.time()
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+        return task
+
+    async def _supervise(self, name, func):
+        """
+        run `func()` in its own task, again whenever `_restart` cancelled it
+        :return:
+        """
+        while True:
+            task = asyncio.ensure_future(func())
+            self.loop_tasks[name] = task
+            try:
+                return await task
+            except asyncio.CancelledError:
+                if name not in self.restarting:
+                    raise
+
+                self.restarting.discard(name)
+
+    def _restart(self, name):
+        task = self.loop_tasks.get(name)
+        if task is None or task.done():
+            return 'stopped'
+
+        self.restarting.add(name)
+        task.cancel()
+        return 'restart'
+
+    def _reconnect(self, name):
+        sio = self.sio_clients.get(name.removesuffix('_thread'))
+        if sio is None or not sio.connected:
+            return self._restart(name)
+
+        # `sio.wait()` returns and the loop connects again
+        self._spawn(sio.disconnect())
+        return 'reconnect'
+
+    async def _check_loops(self):
+        self.watchdog.check()
+
+    def _request_callback(self, json_response):
+        resources = json_response.get('resources')
+
+        if resources and len(resources) == 4:
+            logger.info(f'resources updated: {resources}')
+            self.state.update_resources(resources)
+
+    def _update_building(self, building):
+        if building.get('code') == BUILDING_CODE_MAP['hospital']:
+            if building.get('param', {}).get('wounded', []):
+                logger.info('hospital has wounded troops, try to recover')
+                self._spawn(self.hospital_recover())
+
+        self.state.update_building(building)
+
+    async def do_speedup(self, expected_ended, task_id, speedup_type):
+        need_seconds = self.calc_time_diff_in_seconds(expected_ended)
+
+        if need_seconds > 60 * 5 or speedup_type == 'recover':
+            # try speedup only when need_seconds > 5 minutes
+            items = (await self.api.item_list()).get('items', [])
+            speedups = self._calc_optimal_speedups(items, need_seconds, speedup_type)
+            if speedups:
+                counts = speedups.get('counts')
+                used_seconds = speedups.get('used_seconds')
+
+                # using speedup items
+                logger.info(f'need_seconds: {need_seconds}, using speedups: {counts}, saved {used_seconds} seconds')
+                for code, count in counts.items():
+                    if speedup_type == 'recover':
+                        await self.api.kingdom_heal_speedup(code, count)
+                    else:
+                        await self.api.kingdom_task_speedup(task_id, code, count)
+                    await lokbot.tracing.async_sleep(random.randint(1, 3))
+
+    async def _upgrade_building(self, building, snapshot, speedup):
+        if not self._is_building_upgradeable(building, snapshot):
+            return 'continue'
+
+        try:
+            if building.level == 0:
+                res = await self.api.kingdom_building_build(building.to_dict())
+                updated = res.get('newBuilding', building.to_dict())
+            else:
+                res = await self.api.kingdom_building_upgrade(building.to_dict())
+                updated = res.get('updateBuilding', building.to_dict())
+        except OtherException as error_code:
+            if str(error_code) == 'full_task':
+                logger.warning('building_farmer: full_task, quit')
+                return 'break'
+
+            logger.info(f'building upgrade failed: {building}')
+            return 'continue'
+
+        updated['state'] = BUILDING_STATE_UPGRADING
+        self._update_building(updated)
+        self.tasks.add(res.get('newTask'))
+
+        if speedup:
+            await self.do_speedup(res.get('newTask').get('expectedEnded'), res.get('newTask').get('_id'), 'building')
+
+    async def sock(self):
+        """
+        websocket connection of the kingdom
+        :return:
+        """
+        url = self.kingdom_enter.get('networks').get('kingdoms')[0]
+
+        socket = AsyncManagedSocket(
+            'sock', f'{url}?token={self.token}',
+            enter=lambda sio: sio.emit('/kingdom/enter', {'token': self.token}),
+            resync=self.tasks.resync,
+            headers=ws_headers, logger=sock_logger, engineio_logger=sock_logger
+        )
+        sio = socket.sio
+        self.sio_clients['sock'] = sio
+
+        @sio.on('/building/update')
+        async def on_building_update(data):
+            logger.debug(data)
+            self.watchdog.progress('sock_thread')
+            self.tasks.building_updated(data)
+            self._update_building(data)
+
+        @sio.on('/resource/upgrade')
+        async def on_resource_update(data):
+            logger.debug(data)
+            self.watchdog.progress('sock_thread')
+            self.state.update_resource(data.get('resourceIdx'), data.get('value'))
+
+        @sio.on('/buff/list')
+        async def on_buff_list(data):
+            logger.debug(f'on_buff_list: {data}')
+            self.watchdog.progress('sock_thread')
+
+            self.has_additional_building_queue = len([
+                item for item in data if item.get('param', {}).get('itemCode') == ITEM_CODE_GOLDEN_HAMMER
+            ]) > 0
+
+            # handlers run inline on the receive loop of the client, do not block it
+            self._spawn(self._activate_buffs(data))
+
+        @sio.on('/task/update')
+        async def on_task_update(data):
+            logger.debug(data)
+            self.watchdog.progress('sock_thread')
+            self.tasks.update(data)
+
+        await socket.run()
+
+    async def _activate_buffs(self, data):
+        delay = self.started_at + 10 - time.time()
+        if delay > 0:
+            logger.info(f'started at {arrow.get(self.started_at).humanize()}, wait 10 seconds to activate buff')
+            await asyncio.sleep(delay)
+
+        item_list = (await self.api.item_list()).get('items')
+
+        for buff_type, item_code_list in USABLE_BOOST_CODE_MAP.items():
+            already_activated = [item for item in data if item.get('param', {}).get('itemCode') in item_code_list]
+
+            if already_activated:
+                continue
+
+            item_in_inventory = [item for item in item_list if item.get('code') in item_code_list]
+
+            if not item_in_inventory:
+                continue
+
+            if self.buff_item_use_lock.locked():
+                return
+
+            async with self.buff_item_use_lock:
+                code = item_in_inventory[0].get('code')
+                logger.info(f'activating buff: {buff_type}, code: {code}')
+                await self.api.item_use(code)
+
+                if code == ITEM_CODE_GOLDEN_HAMMER:
+                    self.has_additional_building_queue = True
+
+    async def _get_land_with_level(self):
+        """
+        coroutine version of `LokFarmer._get_land_with_level`, sharing its cache
+        :return:
+        """
+        world_id = self.kingdom_enter.get('kingdom').get('worldId')
+
+        with land_with_level_lock:
+            if world_id in land_with_level_cache:
+                return land_with_level_cache[world_id]
+
+        rank = (await self.api.field_worldmap_devrank()).get('lands')
+
+        land_with_level = [[], [], [], [], [], [], [], [], [], []]
+        for index, level in enumerate(rank):
+            # land id start from 100000
+            land_with_level[int(level)].append(100000 + index)
+
+        with land_with_level_lock:
+            return land_with_level_cache.setdefault(world_id, land_with_level)
+
+    async def socf(self, radius, targets, share_to=None, timeout=30):
+        """
+        websocket connection of the field
+        Only scans for objects and logs them without starting marches
+        :return:
+        """
+        if not self.zone_scheduler:
+            logger.info('getting nearest zone')
+            self.zone_scheduler = self._create_zone_scheduler(radius, await self._get_land_with_level())
+
+        step = 9
+        zone_ids = self.zone_scheduler.next_batch(step)
+        if not zone_ids:
+            logger.debug('socf no zone is due for a scan')
+            return
+
+        while self.api.last_requested_at + 16 > time.time():
+            # when we are in the field, we should not be doing anything else
+            logger.info(f'last requested at {arrow.get(self.api.last_requested_at).humanize()}, waiting...')
+            await asyncio.sleep(4)
+
+        objects_logger, code_loggers = self._get_objects_loggers(targets)
+        objects_logger.info(f"Starting new object scanning session at {arrow.now().format('HH:mm:ss')}")
+
+        world_id = self.kingdom_enter.get('kingdom').get('worldId')
+        url = self.kingdom_enter.get('networks').get('fields')[0]
+
+        scanning = None  # zone ids waiting for their pack
+        field_entered = asyncio.Event()
+        field_objects_processed = asyncio.Event()
+        entering_at = None
+
+        async def enter_field(sio):
+            nonlocal entering_at
+            field_entered.clear()
+            entering_at = time.time()
+            logger.debug('entering field')
+            await sio.emit('/field/enter/v3', self.api.b64xor_enc({'token': self.token}))
+
+        socket = AsyncManagedSocket(
+            'socf', f'{url}?token={self.token}',
+            enter=enter_field, headers=ws_headers, logger=socf_logger, engineio_logger=socf_logger
+        )
+        sio = socket.sio
+
+        @sio.on('/field/objects/v4')
+        async def on_field_objects(data):
+            objects = self._decode_field_objects(data)
+            # file logging and discord webhooks are blocking
+            found = await asyncio.to_thread(self._process_field_objects, objects, targets, objects_logger, code_loggers)
+
+            if scanning is None or not lokbot.field_session.covers(scanning, objects):
+                # the pack of other zones, the batch goes on waiting for its own
+                return
+
+            if not field_objects_processed.is_set():
+                self.zone_scheduler.record(scanning, found)
+            field_objects_processed.set()
+
+        @sio.on('/field/enter/v3')
+        async def on_field_enter(data):
+            nonlocal world_id
+
+            data_decoded = self.api.b64xor_dec(data)
+            logger.debug(data_decoded)
+            world_id = data_decoded.get('loc')[0]  # in case of cvc event world map
+
+            # knock
+            await sio.emit('/zone/leave/list/v2', {'world': world_id, 'zones': '[]'})
+            default_zones = '[0,64,1,65]'
+            await sio.emit('/zone/enter/list/v4', self.api.b64xor_enc({'world': world_id, 'zones': default_zones}))
+            await sio.emit('/zone/leave/list/v2', {'world': world_id, 'zones': default_zones})
+
+            field_entered.set()
+
+        async def wait_field_entered():
+            """
+            after a reconnect, the field is entered again before the next batch
+            :return: whether the field is entered
+            """
+            await socket.connect()
+            for attempt in range(1 + lokbot.field_session.ENTER_RETRIES):
+                if attempt:
+                    logger.warning(f'socf field not entered after {timeout}s, reconnecting')
+                    await socket.reconnect()
+
+                if field_entered.is_set():
+                    return True
+
+                try:
+                    await asyncio.wait_for(field_entered.wait(), timeout)
+                    lokbot.metrics.observe('field_enter_seconds', time.time() - entering_at)
+                    return True
+                except asyncio.TimeoutError:
+                    continue
+
+            return False
+
+        try:
+            grace = 7  # 9 times enter-leave action will cause ban
+            index = 0
+            while zone_ids:
+                if index >= grace:
+                    logger.info('socf grace exceeded, break')
+                    break
+
+                index += 1
+
+                if not await wait_field_entered():
+                    logger.warning('socf field not entered, giving up until the next run')
+                    break
+
+                message = {'world': world_id, 'zones': json.dumps(zone_ids, separators=(',', ':'))}
+
+                scanning = zone_ids
+                for attempt in range(1 + lokbot.field_session.ZONE_BATCH_RETRIES):
+                    if attempt:
+                        # a retry is another enter-leave action, so it counts towards `grace`
+                        if index >= grace:
+                            break
+                        index += 1
+
+                    field_objects_processed.clear()
+                    entered_at = time.time()
+                    await sio.emit('/zone/enter/list/v4', self.api.b64xor_enc(message))
+                    logger.debug(f'entering zone: {zone_ids} and waiting for processing')
+                    try:
+                        await asyncio.wait_for(field_objects_processed.wait(), lokbot.field_session.ZONE_BATCH_TIMEOUT)
+                        lokbot.metrics.observe('field_zone_pack_seconds', time.time() - entered_at)
+                        received = True
+                    except asyncio.TimeoutError:
+                        lokbot.metrics.inc('field_zone_batch_timeouts')
+                        received = False
+                    await sio.emit('/zone/leave/list/v2', message)
+                    if received:
+                        break
+
+                    logger.warning(f'no objects received for zone: {zone_ids} (attempt {attempt + 1})')
+
+                scanning = None
+                # zones left over when `grace` is exceeded would be skipped for the cycle
+                zone_ids = self.zone_scheduler.next_batch(step) if index < grace else []
+        finally:
+            await socket.stop()
+
+        await asyncio.to_thread(self.zone_scheduler.save)
+        logger.info('a loop is finished')
+        objects_logger.info(f"Finished object scanning session at {arrow.now().format('HH:mm:ss')}")
+
+    async def socf_session(self, radius, targets, share_to=None, cadence=10, timeout=30):
+        """
+        coroutine version of `LokFarmer.socf_session_thread`, stays in the field and enters the next batch of zones
+        every `cadence` seconds, reconnecting with the same client and handlers
+        :return:
+        """
+        world_id = self.kingdom_enter.get('kingdom').get('worldId')
+        url = self.kingdom_enter.get('networks').get('fields')[0]
+        if not self.zone_scheduler:
+            logger.info('getting nearest zone')
+            self.zone_scheduler = self._create_zone_scheduler(radius, await self._get_land_with_level())
+
+        zone_ids = None
+        batches = collections.deque()
+        scanned_batches = 0
+        log_date = None
+        objects_logger, code_loggers = None, None
+
+        def open_loggers():
+            # objects are logged to one file per day, see `FieldSession._open_loggers`
+            nonlocal log_date, objects_logger, code_loggers
+            today = arrow.now().format('YYYY-MM-DD')
+            if today != log_date:
+                objects_logger, code_loggers = self._get_objects_loggers(targets)
+                log_date = today
+
+        field_entered = asyncio.Event()
+        field_objects_processed = asyncio.Event()
+        entering_at = None
+
+        async def enter_field(sio):
+            nonlocal entering_at
+            # when we are in the field, we should not be doing anything else
+            while self.api.last_requested_at + lokbot.field_session.QUIET_SECONDS > time.time():
+                logger.info(f'last requested at {arrow.get(self.api.last_requested_at).humanize()}, waiting...')
+                await asyncio.sleep(4)
+
+            # the knock zones are processed as soon as the field is entered
+            open_loggers()
+
+            field_entered.clear()
+            entering_at = time.time()
+            await sio.emit('/field/enter/v3', self.api.b64xor_enc({'token': self.token}))
+
+        socket = AsyncManagedSocket(
+            'socf_session', f'{url}?token={self.token}',
+            enter=enter_field, headers=ws_headers, logger=socf_logger, engineio_logger=socf_logger
+        )
+        sio = socket.sio
+        self.sio_clients['socf_session'] = sio
+
+        @sio.on('/field/objects/v4')
+        async def on_field_objects(data):
+            objects = self._decode_field_objects(data)
+            # file logging and discord webhooks are blocking
+            found = await asyncio.to_thread(self._process_field_objects, objects, targets, objects_logger, code_loggers)
+
+            if zone_ids is None or not lokbot.field_session.covers(zone_ids, objects):
+                # the pack of other zones, the batch goes on waiting for its own
+                return
+
+            if not field_objects_processed.is_set():
+                self.zone_scheduler.record(zone_ids, found)
+            field_objects_processed.set()
+
+        @sio.on('/field/enter/v3')
+        async def on_field_enter(data):
+            nonlocal world_id
+
+            data_decoded = self.api.b64xor_dec(data)
+            logger.debug(data_decoded)
+            world_id = data_decoded.get('loc')[0]  # in case of cvc event world map
+
+            # knock
+            await sio.emit('/zone/leave/list/v2', {'world': world_id, 'zones': '[]'})
+            default_zones = '[0,64,1,65]'
+            await sio.emit('/zone/enter/list/v4', self.api.b64xor_enc({'world': world_id, 'zones': default_zones}))
+            await sio.emit('/zone/leave/list/v2', {'world': world_id, 'zones': default_zones})
+
+            field_entered.set()
+
+        try:
+            while True:
+                await socket.connect()
+                if not field_entered.is_set():
+                    try:
+                        await asyncio.wait_for(field_entered.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        logger.warning(f'socf_session: field not entered after {timeout}s, reconnecting')
+                        await socket.reconnect()
+                        continue
+
+                    lokbot.metrics.inc('field_session_enters')
+                    lokbot.metrics.observe('field_enter_seconds', time.time() - entering_at)
+
+                while sio.connected:
+                    now = time.time()
+                    while batches and batches[0] <= now - lokbot.field_session.ZONE_BATCH_WINDOW:
+                        batches.popleft()
+
+                    if len(batches) >= lokbot.field_session.ZONE_BATCH_LIMIT:
+                        await asyncio.sleep(batches[0] + lokbot.field_session.ZONE_BATCH_WINDOW - now)
+                        continue
+
+                    open_loggers()
+
+                    zone_ids = self.zone_scheduler.next_batch(lokbot.field_session.ZONE_BATCH_SIZE)
+                    if not zone_ids:
+                        # nothing is expected to have changed, check again later
+                        await asyncio.sleep(cadence)
+                        continue
+
+                    scanned_batches += 1
+                    if scanned_batches % lokbot.field_session.ZONE_BATCH_LIMIT == 0:
+                        await asyncio.to_thread(self.zone_scheduler.save)
+
+                    message = {'world': world_id, 'zones': json.dumps(zone_ids, separators=(',', ':'))}
+
+                    batches.append(now)
+                    field_objects_processed.clear()
+                    await sio.emit('/zone/enter/list/v4', self.api.b64xor_enc(message))
+                    try:
+                        await asyncio.wait_for(field_objects_processed.wait(), cadence)
+                        lokbot.metrics.observe('field_zone_pack_seconds', time.time() - now)
+                    except asyncio.TimeoutError:
+                        logger.warning(f'no objects received for zone: {zone_ids}')
+                        lokbot.metrics.inc('field_zone_batch_timeouts')
+                    await sio.emit('/zone/leave/list/v2', message)
+                    zone_ids = None
+
+                    await asyncio.sleep(max(now + cadence - time.time(), 0))
+
+                logger.warning('socf_session: disconnected, reconnecting')
+        finally:
+            await socket.stop()
+
+    async def socc(self):
+        """
+        websocket connection of the chat
+        :return:
+        """
+        url = self.kingdom_enter.get('networks').get('chats')[0]
+
+        # no token needed in query string, yet
+        socket = AsyncManagedSocket(
+            'socc', url,
+            enter=lambda sio: sio.emit('/chat/enter', {'token': self.token}),
+            headers=ws_headers, logger=socc_logger, engineio_logger=socc_logger
+        )
+        self.sio_clients['socc'] = socket.sio
+
+        await socket.run()
+
+    async def harvester(self):
+        snapshot = self.state.snapshot()
+
+        # 每个种类只需要收获一次, 就会自动收获整个种类下所有资源
+        codes = [code for code in snapshot.buildings_by_code if code in HARVESTABLE_CODE]
+        random.shuffle(codes)
+
+        for code in codes:
+            await self.api.kingdom_resource_harvest(random.choice(snapshot.buildings_of(code)).position)
+
+    async def quest_monitor(self):
+        while True:
+            quest_list = await self.api.quest_list()
+
+            # main quest(currently only one)
+            for q in quest_list.get('mainQuests'):
+                if q.get('status') == STATUS_FINISHED:
+                    await self.api.quest_claim(q)
+
+            # side quest(max 5)
+            side_quests = [q for q in quest_list.get('sideQuests') if q.get('status') == STATUS_FINISHED]
+            for q in side_quests:
+                await self.api.quest_claim(q)
+
+            if len(side_quests) >= 5:
+                # 若五个均为已完成, 则翻页
+                continue
+
+            quest_list_daily = (await self.api.quest_list_daily()).get('dailyQuest')
+
+            # daily quest(max 5)
+            daily_quests = [q for q in quest_list_daily.get('quests') if q.get('status') == STATUS_FINISHED]
+            for q in daily_quests:
+                await self.api.quest_claim_daily(q)
+
+            if len(daily_quests) >= 5:
+                # 若五个均为已完成, 则翻页
+                continue
+
+            # daily quest reward
+            for q in quest_list_daily.get('rewards'):
+                if q.get('status') == STATUS_FINISHED:
+                    await self.api.quest_claim_daily_level(q)
+
+            # event
+            event_list = await self.api.event_list()
+            event_has_red_dot = [each for each in event_list.get('events') if each.get('reddot') > 0]
+            event_infos = await self.api.batch([
+                (self.api.event_info, event.get('_id')) for event in event_has_red_dot
+            ])
+            for event_info in event_infos:
+                if isinstance(event_info, Exception):
+                    raise event_info
+
+                finished_code = [
+                    each.get('code') for each in event_info.get('eventKingdom').get('events')
+                    if each.get('status') == STATUS_FINISHED
+                ]
+
+                for each in event_info.get('event').get('events'):
+                    if each.get('code') in finished_code:
+                        await self.api.event_claim(
+                            event_info.get('event').get('_id'), each.get('_id'), each.get('code')
+                        )
+
+            logger.info('quest_monitor: done, sleep for 1h')
+            await asyncio.sleep(3600)
+
+    def _plan_building(self):
+        snapshot = self.state.snapshot()
+        self.planner.set(QUEUE_BUILDING, next((
+            building for building in self._building_candidates(snapshot)
+            if self._is_building_upgradeable(building, snapshot)
+        ), None))
+
+    async def _building_farmer_worker(self, speedup=False):
+        snapshot = self.state.snapshot()
+        candidates = self._building_candidates(snapshot)
+
+        planned = self.planner.take(QUEUE_BUILDING, self._is_building_plan_valid)
+        if planned is not None:
+            candidates = itertools.chain([planned], candidates)
+
+        for building in candidates:
+            res = await self._upgrade_building(building, snapshot, speedup)
+
+            if res == 'continue':
+                continue
+            if res == 'break':
+                break
+
+            self._plan_building()
+            return True
+
+        return False
+
+    async def building_farmer(self, speedup=False):
+        while True:
+            self.watchdog.beat('building_farmer_thread')
+            self.tasks.woke(TASK_CODE_SILVER_HAMMER)
+            silver_in_use = await self.tasks.tasks(TASK_CODE_SILVER_HAMMER)
+            gold_in_use = await self.tasks.tasks(TASK_CODE_GOLD_HAMMER)
+
+            if not silver_in_use or (self.has_additional_building_queue and not gold_in_use):
+                if not await self._building_farmer_worker(speedup):
+                    logger.info(f'no building to upgrade, sleep for 2h')
+                    await asyncio.sleep(7200)
+                    continue
+
+            # wait for building queue available from `sock`
+            await self.tasks.wait('building_farmer', (TASK_CODE_SILVER_HAMMER, TASK_CODE_GOLD_HAMMER))
+
+    async def academy_farmer(self, to_max_level=False, speedup=False):
+        while True:
+            self.watchdog.beat('academy_farmer_thread')
+            if not await self._academy_farmer_worker(to_max_level, speedup):
+                logger.info('academy_farmer: no research to do, sleep for 2h')
+                await asyncio.sleep(2 * 3600)
+                continue
+
+            await self.tasks.wait('academy_farmer', (TASK_CODE_ACADEMY,))  # wait for research queue from `sock`
+
+    async def _start_research(self, category_name, research_name, research_code, speedup):
+        try:
+            res = await self.api.kingdom_academy_research({'code': research_code})
+        except OtherException as error_code:
+            if str(error_code) == 'not_enough_condition':
+                logger.warning(f'category {category_name} reached max level')
+                return 'break'
+
+            logger.info(f'research failed, try next one, current: {research_name}({research_code})')
+            return 'continue'
+
+        self.tasks.add(res.get('newTask'))
+        if speedup:
+            await self.do_speedup(res.get('newTask').get('expectedEnded'), res.get('newTask').get('_id'), 'research')
+
+    async def _plan_research(self, to_max_level, research_code):
+        exist_researches = (await self.api.kingdom_academy_research_list()).get('researches', [])
+        academy_level = self.state.snapshot().building(BUILDING_CODE_MAP['academy']).level
+
+        planned = next(self._research_candidates(academy_level, exist_researches, to_max_level, research_code), None)
+        self.planner.set(QUEUE_ACADEMY, planned and (*planned, exist_researches))
+
+    async def _academy_farmer_worker(self, to_max_level=False, speedup=False):
+        """
+        :return: False if there is nothing to research
+        """
+        self.tasks.woke(TASK_CODE_ACADEMY)
+        worker_used = await self.tasks.tasks(TASK_CODE_ACADEMY)
+
+        if worker_used:
+            if worker_used[0].status != STATUS_CLAIMED:
+                return True
+
+            # 如果已完成, 则领取奖励并继续
+            await self.api.kingdom_task_claim(BUILDING_POSITION_MAP['academy'])
+            self.tasks.discard(TASK_CODE_ACADEMY)
+
+        planned = self.planner.take(QUEUE_ACADEMY, functools.partial(self._is_research_plan_valid, to_max_level))
+        if planned is not None and await self._start_research(*planned[:3], speedup) is None:
+            await self._plan_research(to_max_level, planned[2])
+            return True
+
+        exist_researches = (await self.api.kingdom_academy_research_list()).get('researches', [])
+        academy_level = self.state.snapshot().building(BUILDING_CODE_MAP['academy']).level
+
+        maxed_categories = set()
+        for category_name, research_name, research_code in self._research_candidates(
+                academy_level, exist_researches, to_max_level
+        ):
+            if category_name in maxed_categories:
+                continue
+
+            res = await self._start_research(category_name, research_name, research_code, speedup)
+            if res == 'break':
+                maxed_categories.add(category_name)
+                continue
+            if res == 'continue':
+                continue
+
+            await self._plan_research(to_max_level, research_code)
+            return True
+
+        return False
+
+    async def train_troop(self, troop_code, speedup=False, interval=3600):
+        while True:
+            self.watchdog.beat('train_troop_thread')
+            self.tasks.woke(TASK_CODE_CAMP)
+            while self.api.last_requested_at + 4 > time.time():
+                # attempt to prevent `insufficient_resources` due to race conditions
+                logger.info(f'last requested at {arrow.get(self.api.last_requested_at).humanize()}, waiting...')
+                await lokbot.tracing.async_sleep(4)
+
+            worker_used = await self.tasks.tasks(TASK_CODE_CAMP)
+
+            troop_training_capacity = self._troop_training_capacity()
+
+            if worker_used:
+                if worker_used[0].status == STATUS_CLAIMED:
+                    barrack = self._random_choice_building(BUILDING_CODE_MAP['barrack'])
+                    await self.api.kingdom_task_claim(barrack.position)
+                    self.tasks.discard(TASK_CODE_CAMP)
+                    self.tasks.reactions.pause(QUEUE_CAMP, interval)
+                    logger.info(f'train_troop: one loop completed, sleep for {interval} seconds')
+                    await asyncio.sleep(interval)
+                    continue
+
+                if worker_used[0].status == STATUS_PENDING:
+                    await self.tasks.wait('train_troop', (TASK_CODE_CAMP,))  # wait for train queue from `sock`
+                    continue
+
+            # if there are not enough resources, train how much possible
+            total_troops_capacity_according_to_resources = self._total_troops_capacity_according_to_resources(
+                troop_code
+            )
+            if troop_training_capacity > total_troops_capacity_according_to_resources:
+                troop_training_capacity = total_troops_capacity_according_to_resources
+
+            if not troop_training_capacity:
+                logger.info('train_troop: no resource, sleep for 1h')
+                await asyncio.sleep(3600)
+                continue
+
+            try:
+                res = await self.api.train_troop(troop_code, troop_training_capacity)
+            except OtherException as error_code:
+                logger.info(f'train_troop: {error_code}, sleep for 1h')
+                await asyncio.sleep(3600)
+                continue
+
+            self.tasks.add(res.get('newTask'))
+            if speedup:
+                await self.do_speedup(res.get('newTask').get('expectedEnded'), res.get('newTask').get('_id'), 'train')
+
+            await self.tasks.wait('train_troop', (TASK_CODE_CAMP,))  # wait for train queue from `sock`
+
+    async def free_chest_farmer(self, _type=0):
+        while True:
+            try:
+                res = await self.api.item_free_chest(_type)
+            except OtherException as error_code:
+                if str(error_code) == 'free_chest_not_yet':
+                    logger.info('free_chest_farmer: free_chest_not_yet, sleep for 2h')
+                    _type = 0
+                    await asyncio.sleep(2 * 3600)
+                    continue
+
+                raise
+
+            next_dict = {
+                0: arrow.get(res.get('freeChest', {}).get('silver', {}).get('next')),
+                1: arrow.get(res.get('freeChest', {}).get('gold', {}).get('next')),
+                2: arrow.get(res.get('freeChest', {}).get('platinum', {}).get('next')),
+            }
+            _type = min(next_dict, key=next_dict.get)
+
+            await asyncio.sleep(self.calc_time_diff_in_seconds(next_dict[_type]))
+
+    async def use_resource_in_item_list(self):
+        item_list = (await self.api.item_list()).get('items', [])
+
+        if not item_list:
+            return
+
+        usable_item_list = filter(lambda x: x.get('code') in USABLE_ITEM_CODE_LIST, item_list)
+
+        for each_item in usable_item_list:
+            await self.api.item_use(each_item.get('code'), each_item.get('amount'))
+            await lokbot.tracing.async_sleep(random.randint(1, 3))
+
+    async def vip_chest_claim(self):
+        vip_info = await self.api.kingdom_vip_info()
+
+        if vip_info.get('vip', {}).get('isClaimed'):
+            return
+
+        await self.api.kingdom_vip_claim()
+
+    async def _ignore_other_exception(self, coro):
+        try:
+            return await coro
+        except OtherException:
+            return None
+
+    async def _alliance_research_donate_all(self):
+        research_list = await self._ignore_other_exception(self.api.alliance_research_list())
+        if research_list is None:
+            return
+
+        code = research_list.get('recommendResearch')
+
+        if not code:
+            code = 31101003  # 骑兵攻击力 1
+
+        await self._ignore_other_exception(self.api.alliance_research_donate_all(code))
+
+    async def _alliance_shop_autobuy(self, item_code_list=(ITEM_CODE_VIP_100,)):
+        shop_list = await self._ignore_other_exception(self.api.alliance_shop_list())
+        if shop_list is None:
+            return
+
+        alliance_point = shop_list.get('alliancePoint')
+        shop_items = shop_list.get('allianceShopItems')
+
+        for each_shop_item in shop_items:
+            code = each_shop_item.get('code')
+            if code not in item_code_list:
+                continue
+
+            cost = each_shop_item.get('ap_1')  # or 'ap_2'?
+            amount_available = each_shop_item.get('amount')
+
+            minimum_buy_amount = int(alliance_point / cost)
+            if minimum_buy_amount < 1:
+                continue
+
+            amount = minimum_buy_amount if minimum_buy_amount < amount_available else amount_available
+
+            try:
+                await self.api.alliance_shop_buy(code, amount)
+            except OtherException as error_code:
+                logger.warning(f'alliance_shop_buy failed({str(error_code)}): {code}, {amount}')
+                return
+
+            alliance_point -= cost * amount
+
+    async def alliance_farmer(
+            self, gift_claim=True, help_all=True, research_donate=True, shop_auto_buy_item_code_list=None
+    ):
+        if not self.alliance_id:
+            return
+
+        if gift_claim:
+            await self._ignore_other_exception(self.api.alliance_gift_claim_all())
+
+        if help_all:
+            await self._ignore_other_exception(self.api.alliance_help_all())
+
+        if research_donate:
+            await self._alliance_research_donate_all()
+
+        if shop_auto_buy_item_code_list and type(shop_auto_buy_item_code_list) is list:
+            await self._alliance_shop_autobuy(shop_auto_buy_item_code_list)
+
+    async def caravan_farmer(self):
+        caravan = (await self.api.kingdom_caravan_list()).get('caravan')
+
+        if not caravan:
+            return
+
+        for each_item in caravan.get('items', []):
+            if each_item.get('amount') < 1:
+                continue
+
+            if each_item.get('code') not in BUYABLE_CARAVAN_ITEM_CODE_LIST:
+                continue
+
+            if each_item.get('costItemCode') not in BUYABLE_CARAVAN_ITEM_CODE_LIST:
+                continue
+
+            resource_index = lokbot.util.get_resource_index_by_item_code(each_item.get('costItemCode'))
+
+            if resource_index == -1:
+                continue
+
+            if each_item.get('cost') > self.state.resource(resource_index):
+                continue
+
+            await self.api.kingdom_caravan_buy_limited(each_item.get('_id'))
+
+    async def mail_claim(self):
+        await self.api.mail_claim_all(1)  # report
+        await lokbot.tracing.async_sleep(random.randint(4, 6))
+        await self.api.mail_claim_all(2)  # alliance
+        await lokbot.tracing.async_sleep(random.randint(4, 6))
+        await self.api.mail_claim_all(3)  # system
+
+    async def wall_repair(self):
+        wall_info = await self.api.kingdom_wall_info()
+
+        max_durability = wall_info.get('wall', {}).get('maxDurability')
+        durability = wall_info.get('wall', {}).get('durability')
+        last_repair_date = wall_info.get('wall', {}).get('lastRepairDate')
+
+        if not last_repair_date:
+            return
+
+        last_repair_diff = arrow.utcnow() - arrow.get(last_repair_date)
+
+        if durability >= max_durability:
+            return
+
+        if int(last_repair_diff.total_seconds()) < 60 * 30:
+            # 30 minute interval
+            return
+
+        await self.api.kingdom_wall_repair()
+
+    async def hospital_recover(self):
+        if self.hospital_recover_lock.locked():
+            logger.info('another hospital_recover is running, skip')
+            return
+
+        async with self.hospital_recover_lock:
+            wounded = (await self.api.kingdom_hospital_wounded()).get('wounded', [])
+
+            estimated_end_time = None
+            for each_batch in wounded:
+                if estimated_end_time is None:
+                    estimated_end_time = arrow.get(each_batch[0].get('startTime'))
+                time_total = sum([each.get('time') for each in each_batch])
+                estimated_end_time = estimated_end_time.shift(seconds=time_total)
+
+            if estimated_end_time and estimated_end_time > arrow.utcnow():
+                await self.do_speedup(estimated_end_time, 'dummy_task_id', 'recover')
+
+            await self.api.kingdom_hospital_recover()
+
+    async def keepalive_request(self):
+        functions = [
+            self.api.kingdom_wall_info,
+            self.api.quest_main,
+            self.api.item_list,
+            self.api.kingdom_treasure_list,
+            self.api.event_list,
+            self.api.event_cvc_open,
+            self.api.event_roulette_open,
+            self.api.drago_lair_list,
+            self.api.pkg_recommend,
+            self.api.pkg_list,
+        ]
+        random.shuffle(functions)
+
+        self._keepalive_results(functions, await self.api.batch(functions))
+
+    async def _run_every(self, name, start, end, func):
+        # the coroutine runs in its own task, the job name stays with it
+        lokbot.request_scheduler.set_job(name)
+
+        while True:
+            try:
+                with lokbot.tracing.span(name, lokbot.tracing.KIND_JOB, account=self._id):
+                    await func()
+            except Exception as e:
+                logger.exception(f'job {name} failed: {e}')
+
+            await asyncio.sleep(random.uniform(start, end))
+
+    @staticmethod
+    async def _run_loop(name, coro):
+        # like `_run_every`, a failing loop is logged and the other loops of the farmer go on
+        try:
+            await coro
+        except Exception as e:
+            logger.exception(f'loop {name} failed: {e}')
+
+    async def run(self, main_config):
+        """
+        coroutine version of `lokbot.app.main`, runs the jobs and threads of `main_config` on the current loop
+        :param main_config: the `main` section of config.json
+        :return:
+        """
+        try:
+            # unless set up by `lokbot.app.create_async_farmer` already
+            if self.kingdom_enter is None:
+                await self.setup()
+        except NoAuthException:
+            lokbot.events.emit(lokbot.events.EVENT_AUTH_FAILED, _id=self._id)
+            raise
+
+        lokbot.events.emit(lokbot.events.EVENT_CONNECTED, _id=self._id)
+
+        # `sock_thread` -> `sock`, `building_farmer_thread` -> `building_farmer` and so on
+        def get_job(name):
+            return getattr(self, name.removesuffix('_thread'))
+
+        watchdog_config = main_config.get('watchdog', {})
+        loops = watchdog_config.get('loops', {}) if watchdog_config.get('enabled') else {}
+
+        # the websockets are probed, the other loops beat themselves
+        def watched(name, func):
+            if name not in loops:
+                return self._run_loop(name, func())
+
+            if name in ('sock_thread', 'socc_thread'):
+                heal = functools.partial(self._reconnect, name)
+                probe = functools.partial(self._socket_seen, name.removesuffix('_thread'))
+            else:
+                heal, probe = functools.partial(self._restart, name), None
+
+            self.watchdog.register(name, heal, probe=probe, **loops[name])
+            return self._run_loop(name, self._supervise(name, func))
+
+        jobs = [watched('sock_thread', self.sock), watched('socc_thread', self.socc)]
+
+        await self.keepalive_request()
+
+        for job in main_config.get('jobs'):
+            if not job.get('enabled'):
+                continue
+
+            name = job.get('name')
+            jobs.append(self._run_every(
+                name,
+                job.get('interval').get('start') * 60,
+                job.get('interval').get('end') * 60,
+                functools.partial(get_job(name), **job.get('kwargs', {}))
+            ))
+
+        for thread in main_config.get('threads'):
+            if not thread.get('enabled'):
+                continue
+
+            name = thread.get('name')
+            jobs.append(watched(name, functools.partial(get_job(name), **(thread.get('kwargs') or {}))))
+
+        if loops:
+            interval = watchdog_config.get('interval', CHECK_INTERVAL)
+            jobs.append(self._run_every('watchdog', interval, interval, self._check_loops))
+
+        await asyncio.gather(*jobs)
 
     async def parallel_buy_caravan(self):
         caravan_items = (await self.api.kingdom_caravan_list()).get('caravan').get('items')
@@ -24,5 +1136,17 @@ class AsyncLokFarmer:
                 asyncio.ensure_future(self.api.kingdom_caravan_buy(each_item.get('_id')))
                 for _ in range(self.concurrency)
             ]
-            await asyncio.gather(*jobs)
+            await asyncio.gather(*jobs, return_exceptions=True)
             return
+
+
+async def run_farmers(farmers, main_config):
+    """
+    drive several accounts on one event loop, a failing account does not stop the others
+    :return:
+    """
+    results = await asyncio.gather(*[farmer.run(main_config) for farmer in farmers], return_exceptions=True)
+
+    for farmer, result in zip(farmers, results):
+        if isinstance(result, Exception):
+            logger.error(f'farmer {farmer._id} stopped: {result!r}')
@@ -0,0 +1,354 @@
+import gzip
+import json
+import logging
+import random
+import sys
+import time
+import tracemalloc
+
+import arrow
+
+import lokbot.enum
+from lokbot import logger, config, project_root
+from lokbot.client import BaseLokBotApi
+from lokbot.enum import *
+from lokbot.farmer import LokFarmer, land_with_level_cache
+from lokbot.field_traffic import FieldTrafficGenerator, ZONE_BATCH_SIZE
+from lokbot.metrics import quantile
+from lokbot.state import KingdomState
+
+MIN_TIME = 0.5  # seconds each benchmark is run for
+MIN_SAMPLE_TIME = 0.001  # seconds, calls are timed in groups at least this long
+MIN_ROUNDS = 3
+SLOW_CALL = 1.0  # seconds, slower calls are timed once and not traced by tracemalloc
+THRESHOLD = 0.1  # ops/s drop reported as a regression
+
+BENCH_WORLD_ID = 0
+BENCH_LOC = [BENCH_WORLD_ID, 1024, 1024]
+BENCH_OBJECTS = 300  # objects per synthetic field pack
+BENCH_RADIUS = 4  # of `_get_nearest_land`, which scans the whole devrank for every land around
+
+benchmarks = {}
+
+
+def benchmark(name):
+    """
+    register a benchmark, the decorated function does the setup and returns the function to time
+    :return:
+    """
+
+    def decorator(func):
+        benchmarks[name] = func
+        return func
+
+    return decorator
+
+
+# region fixtures
+
+def _api():
+    api = BaseLokBotApi.__new__(BaseLokBotApi)
+    api.xor_password = 'a1b2c3d4e5f6a7b8'
+
+    return api
+
+
+def bench_farmer():
+    """
+    a `LokFarmer` that never logged in, with a synthetic devrank
+    """
+    rnd = random.Random(0)
+    land_with_level_cache.setdefault(BENCH_WORLD_ID, [[] for _ in range(10)])
+    if not any(land_with_level_cache[BENCH_WORLD_ID]):
+        for land_id in range(100000, 165536):
+            land_with_level_cache[BENCH_WORLD_ID][rnd.choice((0, 0, 0, 1, 1, 2, 3, 5, 9))].append(land_id)
+
+    farmer = LokFarmer.__new__(LokFarmer)
+    farmer.api = _api()
+    farmer.kingdom_enter = {'kingdom': {'worldId': BENCH_WORLD_ID, 'loc': BENCH_LOC}}
+    farmer.state = KingdomState()
+
+    return farmer
+
+
+def _field_objects(count=BENCH_OBJECTS):
+    return FieldTrafficGenerator(_api(), count, seed=0).objects(list(range(ZONE_BATCH_SIZE)))
+
+
+def _field_pack(count=BENCH_OBJECTS):
+    return FieldTrafficGenerator(_api(), count, seed=0).pack(list(range(ZONE_BATCH_SIZE)))
+
+
+def _null_logger(name):
+    null_logger = logging.getLogger(f'{__name__}.{name}')
+    null_logger.addHandler(logging.NullHandler())
+    null_logger.propagate = False
+
+    return null_logger
+
+
+def _kingdom():
+    buildings = []
+    for position, code in enumerate(BUILDING_CODE_MAP.values()):
+        buildings.append({'position': position + 1, 'code': code, 'level': 10, 'state': BUILDING_STATE_NORMAL})
+
+    return {'buildings': buildings, 'resources': [10 ** 9] * 4}
+
+
+# endregion
+
+# region benchmarks
+
+@benchmark('xor')
+def bench_xor():
+    api = _api()
+    plain = json.dumps({'objects': _field_objects(20)}).encode()
+
+    return lambda: api.xor(plain)
+
+
+@benchmark('b64xor_enc')
+def bench_b64xor_enc():
+    api = _api()
+    data = {'world': BENCH_WORLD_ID, 'zones': json.dumps(list(range(9)))}
+
+    return lambda: api.b64xor_enc(data)
+
+
+@benchmark('b64xor_dec')
+def bench_b64xor_dec():
+    api = _api()
+    encoded = api.b64xor_enc({'objects': _field_objects(20)})
+
+    return lambda: api.b64xor_dec(encoded)
+
+
+@benchmark('field_pack_decode')
+def bench_field_pack_decode():
+    api = _api()
+    data = _field_pack()
+
+    return lambda: api.b64xor_dec(gzip.decompress(bytearray(data.get('packs'))))
+
+
+@benchmark('on_field_objects')
+def bench_on_field_objects():
+    farmer = bench_farmer()
+    data = _field_pack()
+    targets = [{'code': OBJECT_CODE_CRYSTAL_MINE, 'level': []}, {'code': OBJECT_CODE_DRAGON_SOUL_CAVERN, 'level': []}]
+    objects_logger = _null_logger('objects')
+    code_loggers = {target['code']: _null_logger(str(target['code'])) for target in targets}
+
+    def on_field_objects():
+        # same as the handler in `LokFarmer.socf_thread`
+        farmer._process_field_objects(farmer._decode_field_objects(data), targets, objects_logger, code_loggers)
+
+    return on_field_objects
+
+
+@benchmark('get_nearest_land')
+def bench_get_nearest_land():
+    farmer = bench_farmer()
+
+    # `__wrapped__` skips the lru_cache
+    return lambda: LokFarmer._get_nearest_land.__wrapped__(farmer, BENCH_LOC[1], BENCH_LOC[2], BENCH_RADIUS)
+
+
+@benchmark('get_nearest_zone')
+def bench_get_nearest_zone():
+    farmer = bench_farmer()
+
+    def get_nearest_zone():
+        LokFarmer._get_nearest_land.cache_clear()
+        LokFarmer._get_nearest_zone.__wrapped__(farmer, BENCH_LOC[1], BENCH_LOC[2], BENCH_RADIUS)
+
+    return get_nearest_zone
+
+
+@benchmark('get_nearest_zone_ng')
+def bench_get_nearest_zone_ng():
+    farmer = bench_farmer()
+
+    return lambda: farmer._get_nearest_zone_ng(BENCH_LOC[1], BENCH_LOC[2], 16)
+
+
+@benchmark('calc_optimal_speedups')
+def bench_calc_optimal_speedups():
+    farmer = bench_farmer()
+    codes = list(ITEM_CODE_SPEEDUP_MAP.get('building')) + list(ITEM_CODE_SPEEDUP_MAP.get('universal'))
+    items = [{'code': code, 'amount': 50} for code in codes]
+
+    return lambda: farmer._calc_optimal_speedups(items, 3 * 86400 + 1234, 'building')
+
+
+@benchmark('is_building_upgradeable')
+def bench_is_building_upgradeable():
+    farmer = bench_farmer()
+    farmer.state.load_kingdom(_kingdom())
+    snapshot = farmer.state.snapshot()
+
+    def is_building_upgradeable():
+        for building in snapshot.buildings.values():
+            farmer._is_building_upgradeable(building, snapshot)
+
+    return is_building_upgradeable
+
+
+@benchmark('is_researchable')
+def bench_is_researchable():
+    farmer = bench_farmer()
+    researches = [
+        (category_name, research_name)
+        for category_name, category in RESEARCH_CODE_MAP.items() for research_name in category
+    ]
+    exist_researches = [
+        {'code': RESEARCH_CODE_MAP[category_name][research_name], 'level': 1}
+        for category_name, research_name in researches[::2]
+    ]
+
+    def is_researchable():
+        for category_name, research_name in researches:
+            farmer._is_researchable(20, category_name, research_name, exist_researches, to_max_level=True)
+
+    return is_researchable
+
+
+@benchmark('load_building_json')
+def bench_load_building_json():
+    return lokbot.enum.load_building_json
+
+
+@benchmark('load_research_json')
+def bench_load_research_json():
+    return lokbot.enum.load_research_json
+
+
+# endregion
+
+def run_benchmark(func, min_time=MIN_TIME):
+    """
+    time `func` in groups of calls lasting at least `MIN_SAMPLE_TIME`, for at least `min_time` seconds
+    :return: dict of ops/s, per call p50/p99 and tracemalloc allocations per call
+    """
+    started_at = time.perf_counter()
+    func()  # warm up caches and lazy imports
+    slow = time.perf_counter() - started_at >= SLOW_CALL
+
+    samples = []
+    total_time = 0
+    number = 1
+    while True:
+        started_at = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started_at
+        if elapsed >= MIN_SAMPLE_TIME:
+            samples.append(elapsed / number)
+            total_time += elapsed
+            break
+        number *= 2
+
+    # functions get at least `MIN_ROUNDS` rounds, however long they take, unless slower than `SLOW_CALL`
+    while not slow and (total_time < min_time or len(samples) < MIN_ROUNDS):
+        started_at = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started_at
+        samples.append(elapsed / number)
+        total_time += elapsed
+
+    allocated = peak = current = None
+    if not slow:
+        tracemalloc.start()
+        try:
+            current, _ = tracemalloc.get_traced_memory()
+            func()
+            allocated, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'ops': len(samples) * number / total_time,
+        'p50': quantile(samples, 0.5),
+        'p99': quantile(samples, 0.99),
+        'rounds': len(samples),
+        'number': number,
+        'alloc_peak_bytes': None if slow else peak - current,
+        'alloc_retained_bytes': None if slow else allocated - current,
+    }
+
+
+def compare(baseline, results, threshold=THRESHOLD):
+    """
+    :return: {name: ops/s change ratio} of the benchmarks slower than `baseline` by more than `threshold`
+    """
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        change = result['ops'] / baseline[name]['ops'] - 1
+        if change < -threshold:
+            regressions[name] = change
+
+    return regressions
+
+
+def _format_seconds(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f}{unit}'
+
+    return f'{seconds / 1e-9:.0f}ns'
+
+
+def main(only=None, output=None, baseline=None, threshold=THRESHOLD, min_time=MIN_TIME):
+    """
+    run the benchmarks, `python -m lokbot bench --baseline data/bench/before.json`
+    :param only: comma separated benchmark names
+    :param output: json file of the results, `data/bench/<time>.json` by default
+    :param baseline: json file of a previous run to compare with, exits with 1 on regressions
+    :param threshold: ops/s drop reported as a regression
+    :param min_time: seconds each benchmark is run for
+    :return:
+    """
+    names = list(benchmarks)
+    if only:
+        names = [name for name in (only.split(',') if isinstance(only, str) else only) if name in benchmarks]
+
+    # keep the benchmarked code quiet
+    logger.disable('lokbot')
+    discord_config = config.pop('discord', None)
+    results = {}
+    try:
+        for name in names:
+            result = results[name] = run_benchmark(benchmarks[name](), min_time)
+            peak = result['alloc_peak_bytes']
+            print(
+                f'{name:<26} {result["ops"]:>12,.1f} ops/s  p50 {_format_seconds(result["p50"]):>9}'
+                f'  p99 {_format_seconds(result["p99"]):>9}  peak {"n/a" if peak is None else f"{peak:,}":>10} B'
+            )
+    finally:
+        if discord_config is not None:
+            config['discord'] = discord_config
+        logger.enable('lokbot')
+
+    if output is None:
+        project_root.joinpath('data/bench').mkdir(exist_ok=True)
+        output = project_root.joinpath(f'data/bench/{arrow.now().format("YYYYMMDD-HHmmss")}.json')
+
+    with open(output, 'w') as f:
+        json.dump({'python': sys.version, 'time': time.time(), 'results': results}, f, indent=2)
+    print(f'results saved to {output}')
+
+    if not baseline:
+        return
+
+    with open(baseline) as f:
+        regressions = compare(json.load(f).get('results', {}), results, threshold)
+
+    for name, change in regressions.items():
+        print(f'REGRESSION {name}: {change:+.1%} ops/s')
+
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,211 @@
+import asyncio
+import threading
+import time
+
+import lokbot.tracing
+from lokbot import logger, metrics
+
+STATE_CLOSED = 'closed'
+STATE_HALF_OPEN = 'half_open'  # one probe request is let through, the others keep waiting for its outcome
+STATE_OPEN = 'open'
+
+STATE_VALUES = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}  # of the `circuit_breaker_state` gauge
+
+ACCOUNT = '*'  # circuit of every request of the account
+
+# error code -> (whether it opens the account-wide circuit, first open seconds, max open seconds)
+TRIP_CODES = {
+    'exceed_limit_packet': (True, 3600, 3600),  # server-side penalty of the account, about an hour
+    'duplicated': (False, 2, 60),  # server-side rate limit of an endpoint group
+}
+
+PROBE_TIMEOUT = 60  # seconds after which a probe that never reported is given up
+
+
+def get_group(api_path):
+    """
+    `kingdom/task/claim` -> `kingdom/task`
+    :return:
+    """
+    return '/'.join(api_path.split('/')[:2])
+
+
+class Circuit:
+    __slots__ = ('name', 'state', 'reopen_at', 'trips', 'probe_started_at')
+
+    def __init__(self, name):
+        self.name = name
+        self.state = STATE_CLOSED
+        self.reopen_at = 0
+        self.trips = 0  # consecutive, the open time doubles with each
+        self.probe_started_at = None
+
+    def set_state(self, state):
+        self.state = state
+        metrics.gauge('circuit_breaker_state', STATE_VALUES[state], group=self.name)
+
+
+class _Breaker:
+    """
+    Circuits of an account, shared by every thread (or task) posting with its `LokBotApi`.
+
+    `exceed_limit_packet` opens the account-wide circuit and `duplicated` the circuit of the endpoint group,
+    so the requests behind them wait until the computed reopen time instead of each hitting the penalty again.
+    Then the circuit is half-open: the next request is the probe, a response without these codes closes
+    the circuit, another one opens it again for twice as long.
+    """
+
+    def __init__(self):
+        self.circuits = {}
+
+    def _check(self, api_path):
+        """
+        :return: 0 when the request may be sent, otherwise seconds to wait, or None to wait for a probe
+        """
+        now = time.time()
+        circuits = [self.circuits.get(ACCOUNT), self.circuits.get(get_group(api_path))]
+        circuits = [circuit for circuit in circuits if circuit is not None and circuit.state != STATE_CLOSED]
+
+        for circuit in circuits:
+            if circuit.state == STATE_OPEN:
+                if now < circuit.reopen_at:
+                    return circuit.reopen_at - now
+
+                circuit.set_state(STATE_HALF_OPEN)
+
+            if circuit.probe_started_at is not None:
+                if now < circuit.probe_started_at + PROBE_TIMEOUT:
+                    return None
+
+                circuit.probe_started_at = None
+
+        for circuit in circuits:
+            circuit.probe_started_at = now
+
+        return 0
+
+    def _record(self, api_path, code):
+        group = get_group(api_path)
+
+        if code in TRIP_CODES:
+            account_wide, seconds, max_seconds = TRIP_CODES[code]
+            name = ACCOUNT if account_wide else group
+            circuit = self.circuits.setdefault(name, Circuit(name))
+            circuit.trips += 1
+            circuit.reopen_at = time.time() + min(seconds * 2 ** (circuit.trips - 1), max_seconds)
+            circuit.probe_started_at = None
+            circuit.set_state(STATE_OPEN)
+
+            metrics.inc('circuit_breaker_trips', group=name, code=code)
+            logger.warning(f'circuit_breaker: {code} on {api_path}, {name} open until {time.ctime(circuit.reopen_at)}')
+            return
+
+        for name in (ACCOUNT, group):
+            circuit = self.circuits.get(name)
+            if circuit is not None and circuit.state == STATE_HALF_OPEN:
+                circuit.trips = 0
+                circuit.probe_started_at = None
+                circuit.set_state(STATE_CLOSED)
+                logger.info(f'circuit_breaker: {name} closed')
+
+    def _release(self, api_path):
+        # the request failed before a response, the next one probes instead
+        for name in (ACCOUNT, get_group(api_path)):
+            circuit = self.circuits.get(name)
+            if circuit is not None and circuit.state == STATE_HALF_OPEN:
+                circuit.probe_started_at = None
+
+    def states(self):
+        return {name: circuit.state for name, circuit in self.circuits.items()}
+
+    @staticmethod
+    def _observe(waited):
+        metrics.observe('circuit_breaker_wait_seconds', waited)
+        lokbot.tracing.add('retry_wait_seconds', waited)
+
+
+class CircuitBreaker(_Breaker):
+    """
+    `_Breaker` for the threads of a `LokBotApi`
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.cond = threading.Condition()
+
+    def wait(self, api_path):
+        """
+        block while a circuit of `api_path` is open or probed by another request
+        :return: whether it blocked
+        """
+        started_at = time.time()
+        waited = False
+
+        with self.cond:
+            while True:
+                wait = self._check(api_path)
+                if wait == 0:
+                    break
+
+                waited = True
+                self.cond.wait(PROBE_TIMEOUT if wait is None else wait)
+
+        if waited:
+            self._observe(time.time() - started_at)
+
+        return waited
+
+    def record(self, api_path, code=None):
+        """
+        account the response of a request, `code` is the error code or None when it succeeded
+        :return:
+        """
+        with self.cond:
+            self._record(api_path, code)
+            self.cond.notify_all()
+
+    def release(self, api_path):
+        with self.cond:
+            self._release(api_path)
+            self.cond.notify_all()
+
+
+class AsyncCircuitBreaker(_Breaker):
+    """
+    `_Breaker` for the coroutines of an `AsyncLokBotApi`
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.cond = asyncio.Condition()
+
+    async def wait(self, api_path):
+        started_at = time.time()
+        waited = False
+
+        async with self.cond:
+            while True:
+                wait = self._check(api_path)
+                if wait == 0:
+                    break
+
+                waited = True
+                try:
+                    await asyncio.wait_for(self.cond.wait(), PROBE_TIMEOUT if wait is None else wait)
+                except asyncio.TimeoutError:
+                    pass
+
+        if waited:
+            self._observe(time.time() - started_at)
+
+        return waited
+
+    async def record(self, api_path, code=None):
+        async with self.cond:
+            self._record(api_path, code)
+            self.cond.notify_all()
+
+    async def release(self, api_path):
+        async with self.cond:
+            self._release(api_path)
+            self.cond.notify_all()
@@ -1,4 +1,7 @@
 import base64
+import concurrent.futures
+import contextvars
+import functools
 import gzip
 import json
 import time
@@ -9,13 +12,129 @@ import ratelimit
 import tenacity
 
 import lokbot.enum
+import lokbot.rate_control
+import lokbot.tracing
 import lokbot.util
 from lokbot.exceptions import *
-from lokbot import logger, project_root
+from lokbot import logger, config, project_root
+from lokbot.circuit_breaker import CircuitBreaker
+from lokbot.rate_control import AdaptiveRates
+from lokbot.request_scheduler import RequestScheduler
 
+BATCH_CONCURRENCY = 4  # requests of a `LokBotApi.batch` in flight at once, multiplexed on the HTTP/2 connection
 
-class LokBotApi:
-    def __init__(self, token, captcha_solver_config, request_callback=None):
+
+def limits(calls, period):
+    """
+    `ratelimit.limits` keeping its state per `LokBotApi` instance, so that accounts hosted in the same process
+    do not share their limits. `calls / period` is where the adaptive rate of the method starts, see `self.rates`
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            wait = self.rates.acquire(func.__name__, calls / period)
+            if wait:
+                raise ratelimit.RateLimitException('too many calls', wait)
+
+            # the outcome of the posts it makes feeds its rate
+            token = lokbot.rate_control.current_endpoint.set(func.__name__)
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                lokbot.rate_control.current_endpoint.reset(token)
+
+        return wrapper
+
+    return decorator
+
+
+class BaseLokBotApi:
+    """
+    Protocol details shared by `LokBotApi` and `lokbot.async_client.AsyncLokBotApi`
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self._id = lokbot.util.decode_jwt(token).get('_id')
+
+        self.xor_password = None
+        self.protected_api_list = []
+
+    def xor(self, plain: bytes) -> bytes:
+        assert self.xor_password is not None
+
+        return bytearray([
+            each_plain ^ ord(self.xor_password[index % len(self.xor_password)])
+            for index, each_plain in enumerate(plain)
+        ])
+
+    def b64xor_enc(self, d: dict) -> str:
+        return base64.b64encode(self.xor(json.dumps(d, separators=(',', ':')).encode())).decode()
+
+    def b64xor_dec(self, s: typing.Union[str, bytes]) -> dict:
+        return json.loads(self.xor(base64.b64decode(s)))
+
+    def load_auth_connect(self, auth_res):
+        """
+        setup protected api list and xor password from `auth/connect` response
+        :param auth_res:
+        :return:
+        """
+        protected_api_list = json.loads(base64.b64decode(auth_res.get('lstProtect')).decode())
+        self.protected_api_list = [str(api).split('/api/').pop() for api in protected_api_list]
+        logger.debug(f'protected_api_list: {self.protected_api_list}')
+        self.xor_password = json.loads(base64.b64decode(auth_res.get('regionHash')).decode()).split('-')[1]
+        logger.debug(f'xor_password: {self.xor_password}')
+
+    def _encode_request(self, api_path, json_data):
+        if api_path in self.protected_api_list:
+            return self.b64xor_enc(json_data)
+
+        return json.dumps(json_data, separators=(',', ':'))
+
+    def _decode_response(self, api_path, response_text):
+        if api_path in self.protected_api_list and response_text[0] != '{':
+            json_response = self.b64xor_dec(response_text)
+        else:
+            json_response = json.loads(response_text)
+
+        if json_response.get('isPacked') is True:
+            json_response = json.loads(gzip.decompress(bytearray(json_response.get('payload'))))
+
+        return json_response
+
+    def _adapt_rate(self, accepted):
+        """
+        feed the outcome of a request to the adaptive rates, the request scheduler follows the rate of `post`
+        :return:
+        """
+        self.rates.record(accepted)
+        self.request_scheduler.set_rate(self.rates.rate(lokbot.rate_control.POST, self.request_scheduler.rate))
+
+    def _raise_for_error(self, code):
+        if code == 'no_auth':
+            project_root.joinpath(f'data/{self._id}.token').unlink(missing_ok=True)
+            raise NoAuthException()
+
+        if code == 'duplicated':
+            raise DuplicatedException()
+
+        if code == 'exceed_limit_packet':
+            raise ExceedLimitPacketException()
+
+        if code == 'not_online':
+            raise NotOnlineException()
+
+        raise OtherException(code)
+
+
+class LokBotApi(BaseLokBotApi):
+    def __init__(self, token, captcha_solver_config, request_callback=None, transport=None):
+        """
+        :param transport: `httpx.HTTPTransport` to share one connection pool between accounts
+        """
+        super().__init__(token)
         self.opener = httpx.Client(
             headers={
                 'Accept': '*/*',
@@ -31,69 +150,68 @@ class LokBotApi:
             },
             http2=True,
             base_url=lokbot.enum.API_BASE_URL,
+            transport=transport,
         )
-        self.token = token
         self.request_callback = request_callback
-        self._id = lokbot.util.decode_jwt(token).get('_id')
-
-        self.xor_password = None
-        self.protected_api_list = []
+        self.request_scheduler = RequestScheduler(**config.get('main', {}).get('request_scheduler', {}))
+        self.breaker = CircuitBreaker()
+        self.rates = AdaptiveRates(
+            project_root.joinpath(f'data/{self._id}.rates.json'), **config.get('main', {}).get('adaptive_rate', {})
+        )
+        self.request_scheduler.set_rate(self.rates.rate(lokbot.rate_control.POST, self.request_scheduler.rate))
 
         self.last_requested_at = time.time()
+        self.executor = None  # of `batch`, created on first use
 
         self.captcha_solver = None
         if 'ttshitu' in captcha_solver_config:
             from lokbot.captcha_solver import Ttshitu
             self.captcha_solver = Ttshitu(**captcha_solver_config['ttshitu'])
 
-    def xor(self, plain: bytes) -> bytes:
-        assert self.xor_password is not None
-
-        return bytearray([
-            each_plain ^ ord(self.xor_password[index % len(self.xor_password)])
-            for index, each_plain in enumerate(plain)
-        ])
-
-    def b64xor_enc(self, d: dict) -> str:
-        return base64.b64encode(self.xor(json.dumps(d, separators=(',', ':')).encode())).decode()
-
-    def b64xor_dec(self, s: typing.Union[str, bytes]) -> dict:
-        return json.loads(self.xor(base64.b64decode(s)))
-
+    @lokbot.tracing.traced()
     @tenacity.retry(
         stop=tenacity.stop_after_attempt(2),
         wait=tenacity.wait_random_exponential(multiplier=1, max=60),
         # general http error or json decode error
         retry=tenacity.retry_if_exception_type((httpx.HTTPError, json.JSONDecodeError)),
+        before_sleep=lokbot.tracing.before_sleep,
         reraise=True
     )
+    # server-side rate limiters, the retry waits in `self.breaker` until the circuit they opened is probed
     @tenacity.retry(
-        wait=tenacity.wait_fixed(2),
-        retry=tenacity.retry_if_exception_type(DuplicatedException),  # server-side rate limiter(wait 2s)
+        retry=tenacity.retry_if_exception_type(DuplicatedException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
     @tenacity.retry(
-        wait=tenacity.wait_fixed(3600),
-        retry=tenacity.retry_if_exception_type(ExceedLimitPacketException),  # server-side rate limiter(wait 1h)
+        retry=tenacity.retry_if_exception_type(ExceedLimitPacketException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @tenacity.retry(
-        wait=tenacity.wait_fixed(1),
-        retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
-    )
-    @ratelimit.limits(calls=1, period=0.1)
     def post(self, url, json_data=None):
         if json_data is None:
             json_data = {}
 
-        post_data = json.dumps(json_data, separators=(',', ':'))
         api_path = str(url).split('/api/').pop()
-        if api_path in self.protected_api_list:
-            post_data = self.b64xor_enc(json_data)
+        post_data = self._encode_request(api_path, json_data)
+
+        # every attempt waits for its slot, marches and task claims ahead of housekeeping
+        self.request_scheduler.acquire(api_path)
+        if self.breaker.wait(api_path):
+            # the waiting requests are released together when the circuit closes, space them out again
+            self.request_scheduler.acquire(api_path)
 
         # remove request cookie since it's not needed and may cause account ban
         self.opener.cookies.clear()
 
-        response = self.opener.post(url, data={'json': post_data})
+        started_at = time.perf_counter()
+        try:
+            response = self.opener.post(url, data={'json': post_data})
+        except httpx.HTTPError:
+            self.breaker.release(api_path)
+            self._adapt_rate(False)
+            raise
         self.last_requested_at = time.time()
+        lokbot.tracing.add('network_seconds', time.perf_counter() - started_at)
+        lokbot.tracing.add('attempts', 1)
 
         log_data = {
             'url': url,
@@ -101,25 +219,26 @@ class LokBotApi:
             'elapsed': response.elapsed.total_seconds(),
         }
 
+        started_at = time.perf_counter()
         try:
-            if api_path in self.protected_api_list and response.text[0] != '{':
-                json_response = self.b64xor_dec(response.text)
-            else:
-                json_response = response.json()
+            json_response = self._decode_response(api_path, response.text)
         except json.JSONDecodeError:
             log_data.update({'res': response.text})
             logger.error(log_data)
+            self.breaker.release(api_path)
 
             raise
-
-        if json_response.get('isPacked') is True:
-            json_response = json.loads(gzip.decompress(bytearray(json_response.get('payload'))))
+        finally:
+            lokbot.tracing.add('decode_seconds', time.perf_counter() - started_at)
 
         log_data.update({'res': json_response})
 
         logger.debug(json.dumps(log_data))
 
         if json_response.get('result'):
+            self.breaker.record(api_path)
+            self._adapt_rate(True)
+
             if callable(self.request_callback):
                 self.request_callback(json_response)
 
@@ -127,10 +246,8 @@ class LokBotApi:
 
         err = json_response.get('err')
         code = err.get('code')
-
-        if code == 'no_auth':
-            project_root.joinpath(f'data/{self._id}.token').unlink(missing_ok=True)
-            raise NoAuthException()
+        self.breaker.record(api_path, code)
+        self._adapt_rate(code not in lokbot.rate_control.PUSHBACK_CODES)
 
         if code == 'need_captcha':
             if not self.captcha_solver:
@@ -140,16 +257,32 @@ class LokBotApi:
 
             raise DuplicatedException()
 
-        if code == 'duplicated':
-            raise DuplicatedException()
+        self._raise_for_error(code)
 
-        if code == 'exceed_limit_packet':
-            raise ExceedLimitPacketException()
+    def batch(self, calls):
+        """
+        make independent reads concurrently, like `api.batch([api.quest_main, (api.event_info, event_id)])`.
+        every call still goes through `post`, so the request scheduler, the circuit breaker and the rate limits apply
+        :param calls: methods, or `(method, *args)` tuples
+        :return: the result of each call, or the exception it raised, in the order of `calls`
+        """
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(BATCH_CONCURRENCY, f'lokbot-batch-{self._id}')
 
-        if code == 'not_online':
-            raise NotOnlineException()
+        futures = []
+        for call in calls:
+            func, *args = call if isinstance(call, tuple) else (call,)
+            # the calls are accounted to the job (and the span) of the caller
+            futures.append(self.executor.submit(contextvars.copy_context().run, func, *args))
 
-        raise OtherException(code)
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+
+        return results
 
     @tenacity.retry(
         stop=tenacity.stop_after_attempt(4),
@@ -173,8 +306,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=2)
+    @limits(calls=1, period=2)
     def auth_captcha_confirm(self, value):
         return self.post('auth/captcha/confirm', {'value': value})
 
@@ -231,8 +365,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=1)
+    @limits(calls=1, period=1)
     def quest_claim(self, quest):
         """
         领取任务奖励
@@ -244,8 +379,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=1)
+    @limits(calls=1, period=1)
     def quest_claim_daily(self, quest):
         """
         领取日常任务奖励
@@ -257,8 +393,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=1)
+    @limits(calls=1, period=1)
     def quest_claim_daily_level(self, reward):
         """
         领取日常任务上方进度条奖励
@@ -292,8 +429,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=2)
+    @limits(calls=1, period=2)
     def event_info(self, root_event_id):
         """
         获取活动信息
@@ -304,8 +442,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=1)
+    @limits(calls=1, period=1)
     def event_claim(self, event_id, event_target_id, code):
         """
         领取活动奖励
@@ -351,8 +490,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=4)
+    @limits(calls=1, period=4)
     def kingdom_task_claim(self, position):
         """
         领取任务奖励
@@ -363,8 +503,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=2)
+    @limits(calls=1, period=2)
     def kingdom_task_speedup(self, task_id, code, amount, is_buy=0):
         """
         加速任务
@@ -379,8 +520,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=2)
+    @limits(calls=1, period=2)
     def kingdom_heal_speedup(self, code, amount, is_buy=0):
         """
         加速治疗
@@ -419,8 +561,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=4)
+    @limits(calls=1, period=4)
     def kingdom_resource_harvest(self, position):
         """
         收获资源
@@ -432,8 +575,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),  # client-side rate limiter
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=6)
+    @limits(calls=1, period=6)
     def kingdom_building_upgrade(self, building, instant=0):
         """
         建筑升级
@@ -450,8 +594,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=6)
+    @limits(calls=1, period=6)
     def kingdom_building_build(self, building, instant=0):
         """
         建筑建造
@@ -468,8 +613,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=6)
+    @limits(calls=1, period=6)
     def kingdom_academy_research(self, research, instant=0):
         """
         学院研究升级
@@ -511,8 +657,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=4)
+    @limits(calls=1, period=4)
     def kingdom_caravan_buy(self, caravan_item_id):
         return self.post('kingdom/caravan/buy', {'caravanItemId': caravan_item_id})
 
@@ -560,8 +707,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=2)
+    @limits(calls=1, period=2)
     def item_use(self, code, amount=1):
         """
         使用道具
@@ -587,8 +735,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=4)
+    @limits(calls=1, period=4)
     def item_free_chest(self, _type=0):
         """
         领取免费宝箱
@@ -600,8 +749,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=2)
+    @limits(calls=1, period=2)
     def event_roulette_spin(self):
         """
         转轮抽奖
@@ -616,8 +766,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=2)
+    @limits(calls=1, period=2)
     def mail_claim_all(self, category=1):
         return self.post('mail/claim/all', {'category': category})
 
@@ -636,8 +787,9 @@ class LokBotApi:
     @tenacity.retry(
         wait=tenacity.wait_fixed(1),
         retry=tenacity.retry_if_exception_type(ratelimit.RateLimitException),
+        before_sleep=lokbot.tracing.before_sleep,
     )
-    @ratelimit.limits(calls=1, period=4)
+    @limits(calls=1, period=4)
     def field_march_start(self, data):
         return self.post('field/march/start', data)
 
@@ -0,0 +1,229 @@
+import asyncio
+import random
+import threading
+import time
+
+import socketio
+
+from lokbot import logger, metrics
+from lokbot.exceptions import FatalApiException
+
+BACKOFF_BASE = 0.5  # seconds, doubled with every failed connect in a row
+BACKOFF_MAX = 30  # seconds
+MAX_FAILURES = 8  # failed connects in a row before giving up, see `lokbot.watchdog`
+
+
+def backoff(failures, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """
+    jittered exponential back-off, no wait after a disconnect
+    :return: seconds to wait before connecting again after `failures` failed connects in a row
+    """
+    if not failures:
+        return 0
+
+    return random.uniform(0, min(cap, base * 2 ** failures))
+
+
+class ConnectionStats:
+    """
+    `socket_*` metrics of a websocket: disconnects, time spent disconnected and failed connects
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.up = False
+        self.connects = 0
+        self.failures = 0  # in a row
+        self.disconnected_at = None
+
+    def connected(self):
+        """
+        :return: whether it is a reconnect
+        """
+        self.up = True
+        self.connects += 1
+        self.failures = 0
+        metrics.gauge('socket_connected', 1, socket=self.name)
+
+        if self.disconnected_at is not None:
+            disconnected = time.time() - self.disconnected_at
+            self.disconnected_at = None
+            metrics.observe('socket_disconnected_seconds', disconnected, socket=self.name)
+            logger.info(f'{self.name}: reconnected after {disconnected:.1f}s')
+
+        return self.connects > 1
+
+    def disconnected(self):
+        if not self.up:
+            return
+
+        self.up = False
+        self.disconnected_at = time.time()
+        metrics.inc('socket_disconnects', socket=self.name)
+        metrics.gauge('socket_connected', 0, socket=self.name)
+
+    def failed(self):
+        """
+        :return: seconds to wait before the next connect
+        """
+        self.failures += 1
+        metrics.inc('socket_connect_failures', socket=self.name)
+
+        return backoff(self.failures)
+
+
+class _ManagedSocket:
+    """
+    A socket.io client kept connected. A dropped connection is connected again at once, a failed connect is retried
+    with a jittered exponential back-off, up to `max_failures` in a row.
+
+    The handlers stay registered on `sio` across reconnects. `enter` sends the enter messages after every connect
+    and `resync` requests the state missed while disconnected after every reconnect.
+    """
+
+    def __init__(self, sio, name, url, enter=None, resync=None, headers=None, max_failures=MAX_FAILURES):
+        self.sio = sio
+        self.name = name
+        self.url = url
+        self.enter = enter  # called with `sio`
+        self.resync = resync
+        self.headers = headers
+        self.max_failures = max_failures
+        self.stats = ConnectionStats(name)
+        self.stopped = False
+
+        self.sio.on('disconnect', self._on_disconnect)
+
+    def _on_disconnect(self):
+        # not triggered by `sio.disconnect()`, the run loop accounts those
+        if not self.stopped:
+            self.stats.disconnected()
+
+    def _failed(self, error):
+        delay = self.stats.failed()
+        if self.stats.failures >= self.max_failures:
+            logger.error(f'{self.name}: connect failed {self.stats.failures} times in a row, giving up')
+            raise error
+
+        logger.warning(f'{self.name}: connect failed: {error}, retrying in {delay:.1f}s')
+        return delay
+
+    def _resync_failed(self, error):
+        if isinstance(error, FatalApiException):
+            raise error
+
+        logger.warning(f'{self.name}: resync failed: {error!r}')
+
+
+class ManagedSocket(_ManagedSocket):
+    """
+    `_ManagedSocket` of a `socketio.Client`, for the threads of a `LokFarmer`
+    """
+
+    def __init__(self, name, url, enter=None, resync=None, headers=None, max_failures=MAX_FAILURES, **kwargs):
+        super().__init__(
+            socketio.Client(reconnection=False, **kwargs), name, url, enter, resync, headers, max_failures
+        )
+        self.stop_event = threading.Event()
+
+    def connect(self):
+        """
+        connect unless connected or stopped, then enter and, after a reconnect, resync
+        :return:
+        """
+        while not self.sio.connected and not self.stopped:
+            self.stats.disconnected()
+            try:
+                self.sio.connect(self.url, transports=["websocket"], headers=self.headers)
+            except socketio.exceptions.ConnectionError as e:
+                self.stop_event.wait(self._failed(e))
+                continue
+
+            reconnected = self.stats.connected()
+            if self.enter is not None:
+                self.enter(self.sio)
+
+            if reconnected and self.resync is not None:
+                try:
+                    self.resync()
+                except Exception as e:
+                    self._resync_failed(e)
+
+    def reconnect(self):
+        """
+        drop the connection and connect again, when the server does not answer the enter messages
+        :return:
+        """
+        if self.sio.connected:
+            self.sio.disconnect()
+
+        self.connect()
+
+    def run(self):
+        """
+        stay connected until `stop`
+        :return:
+        """
+        while not self.stopped:
+            self.connect()
+            self.sio.wait()
+
+            if not self.stopped:
+                logger.warning(f'{self.name}: disconnected, reconnecting')
+
+    def stop(self):
+        self.stopped = True
+        self.stop_event.set()
+
+        if self.sio.connected:
+            self.sio.disconnect()
+
+
+class AsyncManagedSocket(_ManagedSocket):
+    """
+    `_ManagedSocket` of a `socketio.AsyncClient`, `enter` and `resync` are coroutine functions
+    """
+
+    def __init__(self, name, url, enter=None, resync=None, headers=None, max_failures=MAX_FAILURES, **kwargs):
+        super().__init__(
+            socketio.AsyncClient(reconnection=False, **kwargs), name, url, enter, resync, headers, max_failures
+        )
+
+    async def connect(self):
+        while not self.sio.connected and not self.stopped:
+            self.stats.disconnected()
+            try:
+                await self.sio.connect(self.url, transports=["websocket"], headers=self.headers)
+            except socketio.exceptions.ConnectionError as e:
+                await asyncio.sleep(self._failed(e))
+                continue
+
+            reconnected = self.stats.connected()
+            if self.enter is not None:
+                await self.enter(self.sio)
+
+            if reconnected and self.resync is not None:
+                try:
+                    await self.resync()
+                except Exception as e:
+                    self._resync_failed(e)
+
+    async def reconnect(self):
+        if self.sio.connected:
+            await self.sio.disconnect()
+
+        await self.connect()
+
+    async def run(self):
+        while not self.stopped:
+            await self.connect()
+            await self.sio.wait()
+
+            if not self.stopped:
+                logger.warning(f'{self.name}: disconnected, reconnecting')
+
+    async def stop(self):
+        self.stopped = True
+
+        if self.sio.connected:
+            await self.sio.disconnect()
@@ -0,0 +1,131 @@
+import collections
+import threading
+import time
+
+from lokbot import logger, metrics
+from lokbot.scheduler import LANE_EVENTS
+
+
+def latest(data):
+    """
+    coalesce key of events where only the most recent one matters
+    """
+    return None
+
+
+class EventDispatcher:
+    """
+    Runs socket.io event handlers on a `Scheduler` instead of the receive thread of the client.
+
+    Every event type has its own bounded queue, drained in order by at most one scheduler job at a time.
+    Events with a `coalesce` key replace the queued event with the same key, the others drop the oldest
+    queued event once `maxsize` is reached, so a slow handler never blocks the socket.
+    `lossless` events are never dropped, their queue grows past `maxsize` instead.
+    """
+
+    def __init__(self, scheduler, name='sock', maxsize=256, batch=32, received=None):
+        self.scheduler = scheduler
+        self.name = name
+        self.maxsize = maxsize
+        self.batch = batch  # events handled per job run, before yielding the worker
+        self.received = received  # called with the name of every event, on the receive thread
+
+        self._lock = threading.Lock()
+        self._handlers = {}
+        self._queues = {}
+        self._lossless = set()
+        self._scheduled = set()
+
+    def on(self, event, handler=None, coalesce=None, lossless=False):
+        """
+        register a handler, usable as a decorator like `socketio.Client.on`
+        :param coalesce: function of the event data returning its key, a newer event with the same key wins
+        :param lossless: never drop the event, for the ones a consumer waits for like `/task/update`
+        :return:
+        """
+
+        def set_handler(func):
+            self._handlers[event] = (func, coalesce)
+            if lossless:
+                self._lossless.add(event)
+            self._queues[event] = collections.OrderedDict() if coalesce else collections.deque()
+            return func
+
+        if handler is None:
+            return set_handler
+
+        return set_handler(handler)
+
+    def bind(self, sio):
+        for event in self._handlers:
+            self.scheduler.set_lane(f'{self.name}:{event}', LANE_EVENTS)
+            sio.on(event, lambda data, _event=event: self.dispatch(_event, data))
+
+    def dispatch(self, event, data):
+        """
+        enqueue an event, never blocks
+        :return:
+        """
+        _, coalesce = self._handlers[event]
+        item = (data, time.time())
+
+        if self.received is not None:
+            self.received(event)
+
+        with self._lock:
+            queue = self._queues[event]
+            if coalesce:
+                key = coalesce(data)
+                if key in queue:
+                    metrics.inc('socket_events_coalesced', event=event)
+                queue[key] = item
+            else:
+                if len(queue) >= self.maxsize:
+                    if event in self._lossless:
+                        metrics.inc('socket_events_overflowed', event=event)
+                    else:
+                        queue.popleft()
+                        metrics.inc('socket_events_dropped', event=event)
+                        logger.warning(f'{self.name}: {event} queue is full, dropped the oldest event')
+                queue.append(item)
+
+            metrics.gauge('socket_event_queue_depth', len(queue), event=event)
+
+            if event in self._scheduled:
+                return
+
+            self._scheduled.add(event)
+
+        self.scheduler.call_later(f'{self.name}:{event}', 0, self._drain, event)
+
+    def _pop(self, event):
+        queue = self._queues[event]
+        if isinstance(queue, collections.OrderedDict):
+            return queue.popitem(last=False)[1]
+
+        return queue.popleft()
+
+    def _drain(self, event):
+        handler, _ = self._handlers[event]
+
+        for _ in range(self.batch):
+            with self._lock:
+                if not self._queues[event]:
+                    self._scheduled.discard(event)
+                    metrics.gauge('socket_event_queue_depth', 0, event=event)
+                    return
+
+                data, enqueued_at = self._pop(event)
+
+            started_at = time.time()
+            metrics.observe('socket_event_wait_seconds', started_at - enqueued_at, event=event)
+
+            try:
+                handler(data)
+            except Exception as e:
+                logger.exception(f'{self.name}: handler of {event} failed: {e}')
+
+            metrics.observe('socket_event_handler_seconds', time.time() - started_at, event=event)
+
+        # more events left, let the other jobs run first
+        self.scheduler.call_later(f'{self.name}:{event}', 0, self._drain, event)
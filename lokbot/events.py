@@ -0,0 +1,34 @@
+import json
+import os
+import threading
+import time
+
+# fd inherited from the parent process, see `discord_bot.start_bot`
+EVENT_FD_ENV = 'LOKBOT_EVENT_FD'
+
+EVENT_CONNECTED = 'connected'
+EVENT_AUTH_FAILED = 'auth_failed'
+EVENT_FATAL = 'fatal'
+
+_lock = threading.Lock()
+_fd = int(os.environ[EVENT_FD_ENV]) if os.getenv(EVENT_FD_ENV) else None
+
+
+def emit(event, **fields):
+    """
+    write one JSON line to the event fd, a no-op when not started with `LOKBOT_EVENT_FD`
+    :return:
+    """
+    global _fd
+
+    if _fd is None:
+        return
+
+    line = json.dumps({'event': event, 'time': time.time(), **fields}, default=str) + '\n'
+
+    with _lock:
+        try:
+            os.write(_fd, line.encode())
+        except OSError:
+            # reader is gone, stop trying
+            _fd = None
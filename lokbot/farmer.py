@@ -1,6 +1,7 @@
-import base64
+import concurrent.futures
 import functools
 import gzip
+import itertools
 import logging
 import math
 import random
@@ -9,14 +10,24 @@ import time
 
 import arrow
 import numpy
-import socketio
-import tenacity
 
+import lokbot.field_traffic
+import lokbot.metrics
+import lokbot.tracing
 import lokbot.util
 from lokbot import logger, socf_logger, sock_logger, socc_logger, config
 from lokbot.client import LokBotApi
+from lokbot.connection import ManagedSocket
+from lokbot.dispatcher import EventDispatcher, latest
 from lokbot.enum import *
 from lokbot.exceptions import OtherException, FatalApiException
+from lokbot.field_session import FieldSession, ZoneBatch, ENTER_TIMEOUT, ENTER_RETRIES, ZONE_BATCH_RETRIES, covers
+from lokbot.planner import Planner
+from lokbot.scheduler import Scheduler, JOB_STATE_RUNNING
+from lokbot.state import KingdomState, Building
+from lokbot.tasks import TaskTracker, QUEUE_BUILDING, QUEUE_ACADEMY, QUEUE_CAMP
+from lokbot.watchdog import Watchdog, Stalled, DEADLINE_SLACK
+from lokbot.zones import ZoneScheduler
 
 ws_headers = {
     'Accept': '*/*',
@@ -69,61 +80,15 @@ def neighbors(a, radius, row_number, column_number):
             for i in range(row_number - 1 - radius, row_number + radius)]
 
 
-class LokFarmer:
-    def __init__(self, token, captcha_solver_config):
-        self.kingdom_enter = None
-        self.token = token
-        self.api = LokBotApi(token, captcha_solver_config, self._request_callback)
-
-        auth_res = self.api.auth_connect({"deviceInfo": {"build": "global"}})
-        self.api.protected_api_list = json.loads(base64.b64decode(auth_res.get('lstProtect')).decode())
-        self.api.protected_api_list = [str(api).split('/api/').pop() for api in self.api.protected_api_list]
-        logger.debug(f'protected_api_list: {self.api.protected_api_list}')
-        self.api.xor_password = json.loads(base64.b64decode(auth_res.get('regionHash')).decode()).split('-')[1]
-        logger.debug(f'xor_password: {self.api.xor_password}')
-        self.token = auth_res.get('token')
-        self._id = lokbot.util.decode_jwt(token).get('_id')
-        project_root.joinpath(f'data/{self._id}.token').write_text(self.token)
+# devrank of each world, shared by all accounts hosted in the process
+land_with_level_cache = {}
+land_with_level_lock = threading.Lock()
 
-        self.kingdom_enter = self.api.kingdom_enter()
-        self.alliance_id = self.kingdom_enter.get('kingdom', {}).get('allianceId')
 
-        self.api.auth_set_device_info({
-            "build": "global",
-            "OS": "Windows 10",
-            "country": "USA",
-            "language": "English",
-            "bundle": "",
-            "version": "1.1694.152.229",
-            "platform": "web",
-            "pushId": ""
-        })
-
-        self.api.chat_logs(f'w{self.kingdom_enter.get("kingdom").get("worldId")}')
-        if self.alliance_id:
-            self.api.chat_logs(f'a{self.alliance_id}')
-
-        # [food, lumber, stone, gold]
-        self.resources = self.kingdom_enter.get('kingdom').get('resources')
-        self.buff_item_use_lock = threading.Lock()
-        self.hospital_recover_lock = threading.Lock()
-        self.has_additional_building_queue = self.kingdom_enter.get('kingdom').get('vip', {}).get('level') >= 5
-        self.troop_queue = []
-        self.march_limit = 2
-        self.march_size = 10000
-        self.level = self.kingdom_enter.get('kingdom').get('level')
-        self.socf_entered = False
-        self.socf_world_id = None
-        self.field_object_processed = False
-        self.started_at = time.time()
-        self.building_queue_available = threading.Event()
-        self.research_queue_available = threading.Event()
-        self.train_queue_available = threading.Event()
-        self.kingdom_tasks = []
-        self.zones = []
-        self.available_dragos = self._get_available_dragos()
-        self.drago_action_point = self.kingdom_enter.get('kingdom').get('dragoActionPoint', {}).get('value', 0)
-        self.shared_objects = set()
+class BaseFarmer:
+    """
+    Helpers that never call the game API, shared by `LokFarmer` and `lokbot.async_farmer.AsyncLokFarmer`
+    """
 
     @staticmethod
     def calc_time_diff_in_seconds(expected_ended):
@@ -135,21 +100,20 @@ class LokFarmer:
 
         return diff_in_seconds + random.randint(5, 10)
 
-    def _is_building_upgradeable(self, building, buildings):
-        if building.get('state') != BUILDING_STATE_NORMAL:
+    def _is_building_upgradeable(self, building, snapshot):
+        if building.state != BUILDING_STATE_NORMAL:
             return False
 
-        if building.get('code') == BUILDING_CODE_MAP['barrack']:
-            for t in self.kingdom_tasks:
-                if t.get('code') == TASK_CODE_CAMP:
-                    return False
+        if building.code == BUILDING_CODE_MAP['barrack']:
+            if snapshot.tasks_of(TASK_CODE_CAMP):
+                return False
 
         # 暂时忽略联盟中心
-        if building.get('code') == BUILDING_CODE_MAP['hall_of_alliance']:
+        if building.code == BUILDING_CODE_MAP['hall_of_alliance']:
             return False
 
-        building_level = building.get('level')
-        current_building_json = building_json.get(building.get('code'))
+        building_level = building.level
+        current_building_json = building_json.get(building.code)
 
         if not current_building_json:
             return False
@@ -160,14 +124,14 @@ class LokFarmer:
             req_type = requirement.get('type')
             req_code = BUILDING_CODE_MAP.get(req_type)
 
-            if not [b for b in buildings if b.get('code') == req_code and b.get('level') >= req_level]:
+            if not [b for b in snapshot.buildings_of(req_code) if b.level >= req_level]:
                 return False
 
         for res_requirement in next_level_building_json.get('resources'):
             req_value = res_requirement.get('value')
             req_type = res_requirement.get('type')
 
-            if self.resources[RESOURCE_IDX_MAP[req_type]] < req_value:
+            if snapshot.resources[RESOURCE_IDX_MAP[req_type]] < req_value:
                 return False
 
         return True
@@ -207,42 +171,153 @@ class LokFarmer:
                                               and each.get('level') >= req_level]:
                 return False
 
+        resources = self.state.snapshot().resources
         for res_requirement in next_level_research_json.get('resources'):
             req_value = int(res_requirement.get('value'))
             req_type = res_requirement.get('type')
 
-            if self.resources[RESOURCE_IDX_MAP[req_type]] < req_value:
+            if resources[RESOURCE_IDX_MAP[req_type]] < req_value:
                 return False
 
         return True
 
-    def _update_kingdom_enter_building(self, building):
-        if building.get('code') == BUILDING_CODE_MAP['hospital']:
-            if building.get('param', {}).get('wounded', []):
-                logger.info('hospital has wounded troops, try to recover')
-                self.hospital_recover()
+    @staticmethod
+    def _building_candidates(snapshot):
+        """
+        buildings to build or upgrade, the empty positions first, then the lowest level
+        :return:
+        """
+        kingdom_level = snapshot.building(BUILDING_CODE_MAP['castle']).level
+
+        for level_requirement, positions in BUILD_POSITION_UNLOCK_MAP.items():
+            if kingdom_level < level_requirement:
+                continue
 
-        buildings = self.kingdom_enter.get('kingdom', {}).get('buildings', [])
+            for position in positions:
+                if position.get('position') not in snapshot.buildings:
+                    yield Building(position.get('position'), position.get('code'))
 
-        self.kingdom_enter['kingdom']['buildings'] = [
-                                                         b for b in buildings if
-                                                         b.get('position') != building.get('position')
-                                                     ] + [building]
+        yield from sorted(snapshot.buildings.values(), key=lambda x: x.level)
 
-    def _request_callback(self, json_response):
-        resources = json_response.get('resources')
+    def _is_building_plan_valid(self, building, snapshot):
+        # records are replaced on update, the planned one must still be current (or its position still empty)
+        if snapshot.buildings.get(building.position, building) is not building:
+            return False
 
-        if resources and len(resources) == 4:
-            logger.info(f'resources updated: {resources}')
-            self.resources = resources
+        return self._is_building_upgradeable(building, snapshot)
 
-    def _get_optimal_speedups(self, need_seconds, speedup_type):
+    def _research_candidates(self, academy_level, exist_researches, to_max_level=False, exclude=None):
+        """
+        :param exclude: code of the research in progress, its level in `exist_researches` is outdated
+        :return: (category_name, research_name, research_code) of the researchable ones
+        """
+        for category_name, each_category in RESEARCH_CODE_MAP.items():
+            for research_name, research_code in each_category.items():
+                if research_code == exclude:
+                    continue
+
+                if self._is_researchable(academy_level, category_name, research_name, exist_researches, to_max_level):
+                    yield category_name, research_name, research_code
+
+    def _is_research_plan_valid(self, to_max_level, research, snapshot):
+        category_name, research_name, _, exist_researches = research
+        academy_level = snapshot.building(BUILDING_CODE_MAP['academy']).level
+
+        return self._is_researchable(academy_level, category_name, research_name, exist_researches, to_max_level)
+
+    def _socket_seen(self, name):
+        """
+        probe of the websocket `name` for `lokbot.watchdog.Watchdog`
+        :return:
+        """
+        sio = self.sio_clients.get(name)
+
+        return time.time() if sio is not None and sio.connected else None
+
+    @staticmethod
+    def _keepalive_results(functions, results):
+        """
+        every keepalive call stands on its own: `OtherException` is ignored, other errors are logged,
+        a fatal one (logged out, captcha) is raised once every call is made
+        :return:
+        """
+        fatal = None
+        for func, result in zip(functions, results):
+            if not isinstance(result, Exception) or isinstance(result, OtherException):
+                continue
+
+            logger.warning(f'keepalive_request: {func.__name__} failed: {result!r}')
+            if fatal is None and isinstance(result, FatalApiException):
+                fatal = result
+
+        if fatal is not None:
+            raise fatal
+
+    @staticmethod
+    @functools.lru_cache()
+    def _get_zone_array():
+        return numpy.arange(0, 4096).reshape(64, 64)
+
+    def _get_nearest_zone_ng(self, x, y, radius=8):
+        current_zone_id = lokbot.util.get_zone_id_by_coords(x, y)
+
+        idx = ndindex(self._get_zone_array(), current_zone_id)
+
+        nearby_zone_ids = neighbors(self._get_zone_array(), radius, idx[0] + 1, idx[1] + 1)
+        nearby_zone_ids = [item.item() for sublist in nearby_zone_ids for item in sublist if item != 0]
+
+        return nearby_zone_ids
+
+    def _create_zone_scheduler(self, radius, land_with_level):
+        from_loc = self.kingdom_enter.get('kingdom').get('loc')
+        zones = self._get_nearest_zone_ng(from_loc[1], from_loc[2], radius)
+
+        return ZoneScheduler(
+            zones, (from_loc[1], from_loc[2]), land_with_level, project_root.joinpath(f'data/{self._id}.zones.json')
+        )
+
+    @staticmethod
+    def _calc_distance(from_loc, to_loc):
+        return math.ceil(math.sqrt(math.pow(from_loc[1] - to_loc[1], 2) + math.pow(from_loc[2] - to_loc[2], 2)))
+
+    def _troop_training_capacity(self):
+        """
+        return total troop training capacity of all barracks
+        """
+        troop_training_capacity = 0
+        for building in self.state.snapshot().buildings_of(BUILDING_CODE_MAP['barrack']):
+            troop_training_capacity += BARRACK_LEVEL_TROOP_TRAINING_RATE_MAP[int(building.level)]
+
+        return troop_training_capacity
+
+    def _total_troops_capacity_according_to_resources(self, troop_code):
+        """
+        return maximum number of troops according to resources
+        """
+        req_resources = TRAIN_TROOP_RESOURCE_REQUIREMENT[troop_code]
+
+        amount = None
+        for req_resource, resource in zip(req_resources, self.state.snapshot().resources):
+            if req_resource == 0:
+                continue
+
+            if amount is None or resource // req_resource <= amount:
+                amount = resource // req_resource
+
+        return amount if amount is not None else 0
+
+    def _random_choice_building(self, building_code):
+        """
+        return a random building object with the building_code
+        """
+        return random.choice(self.state.snapshot().buildings_of(building_code))
+
+    def _calc_optimal_speedups(self, items, need_seconds, speedup_type):
         current_map = ITEM_CODE_SPEEDUP_MAP.get(speedup_type)
         current_map.update(ITEM_CODE_SPEEDUP_MAP.get('universal'))
 
         assert current_map, f'invalid speedup type: {speedup_type}'
 
-        items = self.api.item_list().get('items', [])
         items = [item for item in items if item.get('code') in current_map.keys()]
 
         if not items:
@@ -291,6 +366,365 @@ class LokFarmer:
             'used_seconds': used_seconds
         }
 
+    def _get_objects_loggers(self, targets):
+        """
+        loggers of found objects, one file per day for all objects and one per target code
+        :return:
+        """
+        # Create a timestamp for the session date (just the date, not time)
+        session_date = arrow.now().format('YYYY-MM-DD')
+
+        # Create main objects logger - use one file per day
+        objects_logger = logging.getLogger(f'{__name__}.objects')
+        # Clear any existing handlers to avoid duplicate logging
+        if objects_logger.hasHandlers():
+            objects_logger.handlers.clear()
+        objects_logger.setLevel(logging.INFO)
+
+        # Create a file handler for the main objects log
+        objects_formatter = logging.Formatter('%(asctime)s - %(message)s')
+        objects_file_handler = logging.FileHandler(project_root.joinpath(f'data/objects_{session_date}.log'), mode='a')
+        objects_file_handler.setFormatter(objects_formatter)
+        objects_logger.addHandler(objects_file_handler)
+
+        # Create separate loggers for each object code - one file per day
+        code_loggers = {}
+        for target in targets:
+            code = target['code']
+            code_name = "Crystal_Mine" if code == 20100105 else "Dragon_Soul_Cavern" if code == 20100106 else f"Code_{code}"
+            code_logger = logging.getLogger(f'{__name__}.{code_name}')
+            # Clear any existing handlers to avoid duplicate logging
+            if code_logger.hasHandlers():
+                code_logger.handlers.clear()
+            code_logger.setLevel(logging.INFO)
+
+            code_file_handler = logging.FileHandler(project_root.joinpath(f'data/{code_name}_{session_date}.log'), mode='a')
+            code_file_handler.setFormatter(objects_formatter)
+            code_logger.addHandler(code_file_handler)
+
+            code_loggers[code] = code_logger
+
+        return objects_logger, code_loggers
+
+    def _decode_field_objects(self, data):
+        """
+        objects of a `/field/objects/v4` event
+        :return:
+        """
+        lokbot.field_traffic.record(data, self.api)
+
+        packs = data.get('packs')
+        gzip_decompress = gzip.decompress(bytearray(packs))
+        data_decoded = self.api.b64xor_dec(gzip_decompress)
+
+        return data_decoded.get('objects')
+
+    def _process_field_objects(self, objects, targets, objects_logger, code_loggers):
+        """
+        log the objects matching `targets` and send them to discord
+        :return: the matching objects
+        """
+        target_code_set = set([target['code'] for target in targets])
+        found = []
+
+        logger.debug(f'Processing {len(objects)} objects')
+        for each_obj in objects:
+            code = each_obj.get('code')
+            level = each_obj.get('level')
+            loc = each_obj.get('loc')
+
+            level_whitelist = [target['level'] for target in targets if target['code'] == code]
+            if not level_whitelist:
+                # not the one we are looking for
+                continue
+
+            level_whitelist = level_whitelist[0]
+            if level_whitelist and level not in level_whitelist:
+                logger.info(f'level not in whitelist, ignore: {each_obj}')
+                continue
+
+            found.append(each_obj)
+
+            # Log found objects that match our criteria
+            if code in set(OBJECT_MINE_CODE_LIST).intersection(target_code_set) or \
+               code in set(OBJECT_MONSTER_CODE_LIST).intersection(target_code_set):
+                obj_type = "Resource" if code in OBJECT_MINE_CODE_LIST else "Monster"
+
+                # Format status information
+                status = "Available"
+                occupied_info = ""
+
+                if each_obj.get('occupied'):
+                    status = "Occupied"
+                    occupied = each_obj.get('occupied')
+                    occupied_info = f"""
+    Occupied by: {occupied.get('name', 'Unknown')}
+    Alliance: {occupied.get('allianceTag', 'None')}
+    From World: {occupied.get('worldId', 'Unknown')}
+    Started: {occupied.get('started', 'Unknown')}
+    Ended: {occupied.get('ended', 'Unknown')}"""
+
+                # Log in the requested format
+                log_message = f"""Found {obj_type}:
+Code - {code}
+Level - {level}
+Location - {loc}
+Status - {status}{occupied_info}"""
+
+                # Log to main objects file
+                objects_logger.info(log_message)
+
+                # Send to Discord if enabled
+                if config.get('discord', {}).get('enabled', False) and config.get('discord', {}).get('webhook_url'):
+                    try:
+                        from lokbot.discord_webhook import DiscordWebhook
+
+                        # Get resource name based on code
+                        resource_name = "Unknown"
+                        if code == 20100105:
+                            resource_name = "Crystal Mine"
+                        elif code == 20100106:
+                            resource_name = "Dragon Soul Cavern"
+                        else:
+                            resource_name = f"Resource {code}"
+
+                        # Special handling for level 1 Crystal Mines
+                        if code == 20100105 and level == 1 and config.get('discord', {}).get('crystal_mine_level1_webhook_url'):
+                            level1_webhook = DiscordWebhook(config.get('discord', {}).get('crystal_mine_level1_webhook_url'))
+                            level1_webhook.send_object_log(
+                                f"{obj_type} (Level 1 {resource_name})", 
+                                code, 
+                                level, 
+                                loc, 
+                                status, 
+                                occupied_info.strip() if occupied_info else ""
+                            )
+
+                        # For level 3+ resources, send to dedicated webhook if configured
+                        if level >= 3 and config.get('discord', {}).get('level3plus_webhook_url'):
+                            level3plus_webhook = DiscordWebhook(config.get('discord', {}).get('level3plus_webhook_url'))
+                            level3plus_webhook.send_object_log(
+                                f"{obj_type} (Level {level} {resource_name})", 
+                                code, 
+                                level, 
+                                loc, 
+                                status, 
+                                occupied_info.strip() if occupied_info else ""
+                            )
+                            
+                        # For level 2+ resources, send to dedicated webhook if configured
+                        if level >= 2 and config.get('discord', {}).get('level2plus_webhook_url'):
+                            level2plus_webhook = DiscordWebhook(config.get('discord', {}).get('level2plus_webhook_url'))
+                            level2plus_webhook.send_object_log(
+                                f"{obj_type} (Level {level} {resource_name})", 
+                                code, 
+                                level, 
+                                loc, 
+                                status, 
+                                occupied_info.strip() if occupied_info else ""
+                            )
+                            
+                        # Also send to main webhook for all resources except level 1 crystal mines
+                        if level >= 2 or code != 20100105:
+                            webhook = DiscordWebhook(config.get('discord', {}).get('webhook_url'))
+                            webhook.send_object_log(
+                                f"{obj_type} ({resource_name})", 
+                                code, 
+                                level, 
+                                loc, 
+                                status, 
+                                occupied_info.strip() if occupied_info else ""
+                            )
+                            
+                        # Send ALL resources to custom webhook regardless of type or level
+                        if config.get('discord', {}).get('custom_webhook_url'):
+                            custom_webhook = DiscordWebhook(config.get('discord', {}).get('custom_webhook_url'))
+                            custom_webhook.send_all_resources(
+                                f"{resource_name}", 
+                                code, 
+                                level, 
+                                loc, 
+                                status, 
+                                occupied_info.strip() if occupied_info else ""
+                            )
+                    except Exception as e:
+                        logger.error(f"Failed to send to Discord: {e}")
+
+                # Log to code-specific file if we have a logger for this code
+                if code in code_loggers:
+                    code_loggers[code].info(log_message)
+
+                logger.info(f"Found {obj_type} - Code: {code}, Level: {level}, Location: {loc}, Status: {status}")
+
+        return found
+
+
+class LokFarmer(BaseFarmer):
+    def __init__(self, token, captcha_solver_config, scheduler=None, transport=None):
+        self.kingdom_enter = None
+        self.state = KingdomState()
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self.stopped = False
+        self.sio_clients = {}
+        self.sockets = {}  # {name: ManagedSocket}
+        self.socket_threads = {}
+        self.token = token
+        self.api = LokBotApi(token, captcha_solver_config, self._request_callback, transport)
+        self.tasks = TaskTracker(self.state, self.api, self.scheduler)
+        self.planner = Planner(self.state)
+        self.watchdog = Watchdog()
+
+        auth_res = self.api.auth_connect({"deviceInfo": {"build": "global"}})
+        self.api.load_auth_connect(auth_res)
+        self.token = auth_res.get('token')
+        self._id = lokbot.util.decode_jwt(token).get('_id')
+        project_root.joinpath(f'data/{self._id}.token').write_text(self.token)
+
+        self.kingdom_enter = self.api.kingdom_enter()
+        self.alliance_id = self.kingdom_enter.get('kingdom', {}).get('allianceId')
+
+        self.api.auth_set_device_info({
+            "build": "global",
+            "OS": "Windows 10",
+            "country": "USA",
+            "language": "English",
+            "bundle": "",
+            "version": "1.1694.152.229",
+            "platform": "web",
+            "pushId": ""
+        })
+
+        chat_channels = [f'w{self.kingdom_enter.get("kingdom").get("worldId")}']
+        if self.alliance_id:
+            chat_channels.append(f'a{self.alliance_id}')
+        for result in self.api.batch([(self.api.chat_logs, channel) for channel in chat_channels]):
+            if isinstance(result, Exception):
+                raise result
+
+        self.state.load_kingdom(self.kingdom_enter.get('kingdom'))
+        self.buff_item_use_lock = threading.Lock()
+        self.hospital_recover_lock = threading.Lock()
+        self.has_additional_building_queue = self.kingdom_enter.get('kingdom').get('vip', {}).get('level') >= 5
+        self.march_limit = 2
+        self.march_size = 10000
+        self.level = self.kingdom_enter.get('kingdom').get('level')
+        self.socf_world_id = None
+        self.zone_batch = None
+        self.field_session = None
+        self.started_at = time.time()
+        self.zone_scheduler = None
+        self.state.set_dragos(self.api.drago_lair_list().get('dragos'))
+        self.drago_action_point = self.kingdom_enter.get('kingdom').get('dragoActionPoint', {}).get('value', 0)
+        self.shared_objects = set()
+
+    def _update_building(self, building):
+        if building.get('code') == BUILDING_CODE_MAP['hospital']:
+            if building.get('param', {}).get('wounded', []):
+                logger.info('hospital has wounded troops, try to recover')
+                self.hospital_recover()
+
+        self.state.update_building(building)
+
+    def _request_callback(self, json_response):
+        resources = json_response.get('resources')
+
+        if resources and len(resources) == 4:
+            logger.info(f'resources updated: {resources}')
+            self.state.update_resources(resources)
+
+    def stop(self):
+        """
+        disconnect all websockets, the scheduled jobs belong to the caller
+        :return:
+        """
+        self.stopped = True
+
+        for socket in list(self.sockets.values()):
+            socket.stop()
+
+        for sio in list(self.sio_clients.values()):
+            if sio.connected:
+                sio.disconnect()
+
+    def start_socket(self, name):
+        """
+        run the websocket thread `name` (`sock_thread`, `socc_thread`) in the background
+        :return:
+        """
+        thread = threading.Thread(target=getattr(self, name), name=f'{name}-{self._id}', daemon=True)
+        self.socket_threads[name] = thread
+        thread.start()
+
+    def watch(self, loops, threads):
+        """
+        register the websocket threads and the `threads` ({name: job function}) listed in `loops` on the watchdog
+        :param loops: {name: {'timeout': seconds, 'progress_timeout': seconds}}, see `lokbot.watchdog.Watchdog`
+        :return:
+        """
+        for name, options in loops.items():
+            if name in self.socket_threads:
+                heal = functools.partial(self._reconnect, name)
+                probe = functools.partial(self._socket_seen, name.removesuffix('_thread'))
+            elif name in threads:
+                heal = functools.partial(self._rearm, name, threads[name])
+                probe = functools.partial(self._job_seen, name)
+            else:
+                continue
+
+            self.watchdog.register(name, heal, probe=probe, **options)
+
+    def _job(self, name):
+        return next((job for job in self.scheduler.jobs() if job.get('name') == name), None)
+
+    def _job_seen(self, name):
+        job = self._job(name)
+        if job is None:
+            # failed without re-arming itself
+            return None
+
+        if job.get('state') == JOB_STATE_RUNNING:
+            return job.get('last_run')
+
+        # waiting since it was armed, a parked job without timeout has no deadline
+        late = time.time() - (job.get('next_run') or time.time())
+        if late > DEADLINE_SLACK:
+            raise Stalled(f'{job.get("state")} {late:.0f}s past its deadline')
+
+        return job.get('armed_at')
+
+    def _reconnect(self, name):
+        if self.stopped:
+            return 'stopped'
+
+        thread = self.socket_threads.get(name)
+        if thread is None or not thread.is_alive():
+            # out of retries
+            self.start_socket(name)
+            return 'restart'
+
+        sio = self.sio_clients.get(name.removesuffix('_thread'))
+        if sio is None or not sio.connected:
+            return 'retrying'
+
+        # `sio.wait()` returns and the thread connects again
+        sio.disconnect()
+        return 'reconnect'
+
+    def _rearm(self, name, func):
+        job = self._job(name)
+        self.scheduler.call_later(name, 0, func)
+
+        if job is not None and job.get('state') == JOB_STATE_RUNNING:
+            # a worker can not be interrupted, it runs again once the blocked run returns
+            return 'blocked'
+
+        return 'rearm'
+
+    def _get_optimal_speedups(self, need_seconds, speedup_type):
+        items = self.api.item_list().get('items', [])
+
+        return self._calc_optimal_speedups(items, need_seconds, speedup_type)
+
     def do_speedup(self, expected_ended, task_id, speedup_type):
         need_seconds = self.calc_time_diff_in_seconds(expected_ended)
 
@@ -308,19 +742,19 @@ class LokFarmer:
                         self.api.kingdom_heal_speedup(code, count)
                     else:
                         self.api.kingdom_task_speedup(task_id, code, count)
-                    time.sleep(random.randint(1, 3))
+                    lokbot.tracing.sleep(random.randint(1, 3))
 
-    def _upgrade_building(self, building, buildings, speedup):
-        if not self._is_building_upgradeable(building, buildings):
+    def _upgrade_building(self, building, snapshot, speedup):
+        if not self._is_building_upgradeable(building, snapshot):
             return 'continue'
 
         try:
-            if building.get('level') == 0:
-                res = self.api.kingdom_building_build(building)
-                building = res.get('newBuilding', building)
+            if building.level == 0:
+                res = self.api.kingdom_building_build(building.to_dict())
+                updated = res.get('newBuilding', building.to_dict())
             else:
-                res = self.api.kingdom_building_upgrade(building)
-                building = res.get('updateBuilding', building)
+                res = self.api.kingdom_building_upgrade(building.to_dict())
+                updated = res.get('updateBuilding', building.to_dict())
         except OtherException as error_code:
             if str(error_code) == 'full_task':
                 logger.warning('building_farmer: full_task, quit')
@@ -329,8 +763,9 @@ class LokFarmer:
             logger.info(f'building upgrade failed: {building}')
             return 'continue'
 
-        building['state'] = BUILDING_STATE_UPGRADING
-        self._update_kingdom_enter_building(building)
+        updated['state'] = BUILDING_STATE_UPGRADING
+        self._update_building(updated)
+        self.tasks.add(res.get('newTask'))
 
         if speedup:
             self.do_speedup(res.get('newTask').get('expectedEnded'), res.get('newTask').get('_id'), 'building')
@@ -394,30 +829,31 @@ class LokFarmer:
 
             alliance_point -= cost * amount
 
-    @functools.lru_cache()
     def _get_land_with_level(self):
-        rank = self.api.field_worldmap_devrank().get('lands')
+        world_id = self.kingdom_enter.get('kingdom').get('worldId')
+
+        with land_with_level_lock:
+            if world_id not in land_with_level_cache:
+                rank = self.api.field_worldmap_devrank().get('lands')
+
+                land_with_level = [[], [], [], [], [], [], [], [], [], []]
+                for index, level in enumerate(rank):
+                    # land id start from 100000
+                    land_with_level[int(level)].append(100000 + index)
 
-        land_with_level = [[], [], [], [], [], [], [], [], [], []]
-        for index, level in enumerate(rank):
-            # land id start from 100000
-            land_with_level[int(level)].append(100000 + index)
+                land_with_level_cache[world_id] = land_with_level
 
-        return land_with_level
+            return land_with_level_cache[world_id]
 
     @staticmethod
     @functools.lru_cache()
     def _get_land_array():
         return numpy.arange(100000, 165536).reshape(256, 256)
 
-    @functools.lru_cache()
-    def _get_land_array_4_by_4(self):
-        return blockshaped(self._get_land_array(), 4, 4)
-
     @staticmethod
     @functools.lru_cache()
-    def _get_zone_array():
-        return numpy.arange(0, 4096).reshape(64, 64)
+    def _get_land_array_4_by_4():
+        return blockshaped(LokFarmer._get_land_array(), 4, 4)
 
     @functools.lru_cache()
     def _get_nearest_land(self, x, y, radius=32):
@@ -456,9 +892,10 @@ class LokFarmer:
 
         return lands
 
+    @staticmethod
     @functools.lru_cache()
-    def _get_zone_id_by_land_id(self, land_id):
-        land_array = self._get_land_array_4_by_4()
+    def _get_zone_id_by_land_id(land_id):
+        land_array = LokFarmer._get_land_array_4_by_4()
 
         return ndindex(land_array, land_id)[0]
 
@@ -473,32 +910,18 @@ class LokFarmer:
 
         return zones
 
-    def _get_nearest_zone_ng(self, x, y, radius=8):
-        current_zone_id = lokbot.util.get_zone_id_by_coords(x, y)
-
-        idx = ndindex(self._get_zone_array(), current_zone_id)
-
-        nearby_zone_ids = neighbors(self._get_zone_array(), radius, idx[0] + 1, idx[1] + 1)
-        nearby_zone_ids = [item.item() for sublist in nearby_zone_ids for item in sublist if item != 0]
-
-        return nearby_zone_ids
-
     def _update_march_limit(self):
         troops = self.api.kingdom_profile_troops().get('troops')
-        self.troop_queue = troops.get('field')
+        self.state.set_troops(troops.get('field'))
         self.march_limit = troops.get('info').get('marchLimit')
         self.march_size = troops.get('info').get('marchSize')
 
     def _is_march_limit_exceeded(self):
-        if len(self.troop_queue) >= self.march_limit:
+        if len(self.state.snapshot().troops) >= self.march_limit:
             return True
 
         return False
 
-    @staticmethod
-    def _calc_distance(from_loc, to_loc):
-        return math.ceil(math.sqrt(math.pow(from_loc[1] - to_loc[1], 2) + math.pow(from_loc[2] - to_loc[2], 2)))
-
     def _start_march(self, to_loc, march_troops, march_type=MARCH_TYPE_GATHER, drago_id=None):
         data = {
             'fromId': self.kingdom_enter.get('kingdom').get('fieldObjectId'),
@@ -512,9 +935,7 @@ class LokFarmer:
 
         res = self.api.field_march_start(data)
 
-        new_task = res.get('newTask')
-        new_task['endTime'] = new_task['expectedEnded']
-        self.troop_queue.append(new_task)
+        self.state.add_troop(res.get('newTask'))
 
     def _prepare_march_troops(self, each_obj, march_type=MARCH_TYPE_GATHER):
         march_info = self.api.field_march_info({
@@ -595,13 +1016,6 @@ class LokFarmer:
 
         return march_troops
 
-    def _get_available_dragos(self):
-        drago_lair_list = self.api.drago_lair_list()
-        dragos = drago_lair_list.get('dragos')
-        available_dragos = [each for each in dragos if each['lair']['status'] == DRAGO_LAIR_STATUS_STANDBY]
-
-        return available_dragos
-
     def _on_field_objects_gather(self, each_obj):
         if each_obj.get('occupied'):
             return False
@@ -616,7 +1030,7 @@ class LokFarmer:
             return False
 
         if each_obj.get('code') == OBJECT_CODE_DRAGON_SOUL_CAVERN:
-            self._start_march(to_loc, march_troops, MARCH_TYPE_GATHER, self.available_dragos[0]['_id'])
+            self._start_march(to_loc, march_troops, MARCH_TYPE_GATHER, self.state.snapshot().standby_dragos()[0]._id)
             return True
 
         self._start_march(to_loc, march_troops, MARCH_TYPE_GATHER)
@@ -632,12 +1046,6 @@ class LokFarmer:
         self._start_march(to_loc, march_troops, MARCH_TYPE_MONSTER)
         return True
 
-    @tenacity.retry(
-        stop=tenacity.stop_after_attempt(4),
-        wait=tenacity.wait_random_exponential(multiplier=1, max=60),
-        retry=tenacity.retry_if_not_exception_type(FatalApiException),
-        reraise=True
-    )
     def sock_thread(self, join_rally_code_list=(OBJECT_CODE_DEATHKAR,)):
         """
         websocket connection of the kingdom
@@ -645,19 +1053,32 @@ class LokFarmer:
         """
         url = self.kingdom_enter.get('networks').get('kingdoms')[0]
 
-        sio = socketio.Client(reconnection=False, logger=sock_logger, engineio_logger=sock_logger)
-
-        @sio.on('/building/update')
+        socket = ManagedSocket(
+            'sock', f'{url}?token={self.token}',
+            enter=lambda sio: sio.emit('/kingdom/enter', {'token': self.token}),
+            resync=self.tasks.resync,
+            headers=ws_headers, logger=sock_logger, engineio_logger=sock_logger
+        )
+        self.sockets['sock'] = socket
+        self.sio_clients['sock'] = socket.sio
+
+        # handlers run on the scheduler, the receive thread of `sio` only enqueues
+        dispatcher = EventDispatcher(
+            self.scheduler, 'sock', received=lambda event: self.watchdog.progress('sock_thread')
+        )
+
+        @dispatcher.on('/building/update', lossless=True)
         def on_building_update(data):
             logger.debug(data)
-            self._update_kingdom_enter_building(data)
+            self.tasks.building_updated(data)
+            self._update_building(data)
 
-        @sio.on('/resource/upgrade')
+        @dispatcher.on('/resource/upgrade', coalesce=lambda data: data.get('resourceIdx'))
         def on_resource_update(data):
             logger.debug(data)
-            self.resources[data.get('resourceIdx')] = data.get('value')
+            self.state.update_resource(data.get('resourceIdx'), data.get('value'))
 
-        @sio.on('/buff/list')
+        @dispatcher.on('/buff/list', coalesce=latest)
         def on_buff_list(data):
             logger.debug(f'on_buff_list: {data}')
 
@@ -665,35 +1086,13 @@ class LokFarmer:
                 item for item in data if item.get('param', {}).get('itemCode') == ITEM_CODE_GOLDEN_HAMMER
             ]) > 0
 
-            while self.started_at + 10 > time.time():
+            delay = max(self.started_at + 10 - time.time(), 0)
+            if delay:
                 logger.info(f'started at {arrow.get(self.started_at).humanize()}, wait 10 seconds to activate buff')
-                time.sleep(4)
-
-            item_list = self.api.item_list().get('items')
-
-            for buff_type, item_code_list in USABLE_BOOST_CODE_MAP.items():
-                already_activated = [item for item in data if item.get('param', {}).get('itemCode') in item_code_list]
-
-                if already_activated:
-                    continue
-
-                item_in_inventory = [item for item in item_list if item.get('code') in item_code_list]
-
-                if not item_in_inventory:
-                    continue
-
-                if self.buff_item_use_lock.locked():
-                    return
 
-                with self.buff_item_use_lock:
-                    code = item_in_inventory[0].get('code')
-                    logger.info(f'activating buff: {buff_type}, code: {code}')
-                    self.api.item_use(code)
+            self.scheduler.call_later('activate_buffs', delay, self._activate_buffs, data)
 
-                    if code == ITEM_CODE_GOLDEN_HAMMER:
-                        self.has_additional_building_queue = True
-
-        @sio.on('/alliance/rally/new')
+        @dispatcher.on('/alliance/rally/new')
         def on_alliance_rally_new(data):
             logger.debug(data)
             code = data.get('code')
@@ -703,227 +1102,97 @@ class LokFarmer:
             # battles = self.api.alliance_battle_list_v2().get('battles')
             # TODO: what does `state` mean?
 
-        @sio.on('/task/update')
+        @dispatcher.on('/task/update', lossless=True)
         def on_task_update(data):
             logger.debug(data)
-            if data.get('status') == STATUS_FINISHED:
-                if data.get('code') in (TASK_CODE_SILVER_HAMMER, TASK_CODE_GOLD_HAMMER):
-                    self.building_queue_available.set()
-
-            if data.get('status') == STATUS_CLAIMED:
-                if data.get('code') == TASK_CODE_ACADEMY:
-                    self.research_queue_available.set()
-                if data.get('code') == TASK_CODE_CAMP:
-                    self.train_queue_available.set()
-
-        sio.connect(f'{url}?token={self.token}', transports=["websocket"], headers=ws_headers)
-        sio.emit('/kingdom/enter', {'token': self.token})
-
-        sio.wait()
-        logger.warning('sock_thread disconnected, reconnecting')
-        raise tenacity.TryAgain()
-
-    @tenacity.retry(
-        stop=tenacity.stop_after_attempt(4),
-        wait=tenacity.wait_random_exponential(multiplier=1, max=60),
-        retry=tenacity.retry_if_not_exception_type(FatalApiException),
-        reraise=True
-    )
+            self.tasks.update(data)
+
+        dispatcher.bind(socket.sio)
+
+        socket.run()
+
+    def _activate_buffs(self, data):
+        item_list = self.api.item_list().get('items')
+
+        for buff_type, item_code_list in USABLE_BOOST_CODE_MAP.items():
+            already_activated = [item for item in data if item.get('param', {}).get('itemCode') in item_code_list]
+
+            if already_activated:
+                continue
+
+            item_in_inventory = [item for item in item_list if item.get('code') in item_code_list]
+
+            if not item_in_inventory:
+                continue
+
+            if self.buff_item_use_lock.locked():
+                return
+
+            with self.buff_item_use_lock:
+                code = item_in_inventory[0].get('code')
+                logger.info(f'activating buff: {buff_type}, code: {code}')
+                self.api.item_use(code)
+
+                if code == ITEM_CODE_GOLDEN_HAMMER:
+                    self.has_additional_building_queue = True
+
     def socf_thread(self, radius, targets, share_to=None):
         """
         websocket connection of the field
         Only scans for objects and logs them without starting marches
         :return:
         """
+        if not self.zone_scheduler:
+            logger.info('getting nearest zone')
+            self.zone_scheduler = self._create_zone_scheduler(radius, self._get_land_with_level())
+
+        step = 9
+        zone_ids = self.zone_scheduler.next_batch(step)
+        if not zone_ids:
+            logger.debug('socf_thread no zone is due for a scan')
+            return
+
         while self.api.last_requested_at + 16 > time.time():
             # if last request is less than 16 seconds ago, wait
             # when we are in the field, we should not be doing anything else
             logger.info(f'last requested at {arrow.get(self.api.last_requested_at).humanize()}, waiting...')
-            time.sleep(4)
+            lokbot.tracing.sleep(4)
 
-        # Create a timestamp for the session date (just the date, not time)
-        session_date = arrow.now().format('YYYY-MM-DD')
-
-        # Create main objects logger - use one file per day
-        objects_logger = logging.getLogger(f'{__name__}.objects')
-        # Clear any existing handlers to avoid duplicate logging
-        if objects_logger.hasHandlers():
-            objects_logger.handlers.clear()
-        objects_logger.setLevel(logging.INFO)
-
-        # Create a file handler for the main objects log
-        objects_formatter = logging.Formatter('%(asctime)s - %(message)s')
-        objects_file_handler = logging.FileHandler(project_root.joinpath(f'data/objects_{session_date}.log'), mode='a')
-        objects_file_handler.setFormatter(objects_formatter)
-        objects_logger.addHandler(objects_file_handler)
-
-        # Create separate loggers for each object code - one file per day
-        code_loggers = {}
-        for target in targets:
-            code = target['code']
-            code_name = "Crystal_Mine" if code == 20100105 else "Dragon_Soul_Cavern" if code == 20100106 else f"Code_{code}"
-            code_logger = logging.getLogger(f'{__name__}.{code_name}')
-            # Clear any existing handlers to avoid duplicate logging
-            if code_logger.hasHandlers():
-                code_logger.handlers.clear()
-            code_logger.setLevel(logging.INFO)
-
-            code_file_handler = logging.FileHandler(project_root.joinpath(f'data/{code_name}_{session_date}.log'), mode='a')
-            code_file_handler.setFormatter(objects_formatter)
-            code_logger.addHandler(code_file_handler)
-
-            code_loggers[code] = code_logger
+        objects_logger, code_loggers = self._get_objects_loggers(targets)
 
         current_time = arrow.now().format('HH:mm:ss')
         objects_logger.info(f"Starting new object scanning session at {current_time}")
 
-        self.socf_entered = False
         self.socf_world_id = self.kingdom_enter.get('kingdom').get('worldId')
         url = self.kingdom_enter.get('networks').get('fields')[0]
-        from_loc = self.kingdom_enter.get('kingdom').get('loc')
 
-        if not self.zones:
-            logger.info('getting nearest zone')
-            self.zones = self._get_nearest_zone_ng(from_loc[1], from_loc[2], radius)
+        field_entered = concurrent.futures.Future()
+        entering_at = None
 
-        sio = socketio.Client(reconnection=False, logger=socf_logger, engineio_logger=socf_logger)
+        def enter_field(sio):
+            nonlocal field_entered, entering_at
+            if field_entered.done():
+                field_entered = concurrent.futures.Future()
 
-        @sio.on('/field/objects/v4')
-        def on_field_objects(data):
-            packs = data.get('packs')
-            gzip_decompress = gzip.decompress(bytearray(packs))
-            data_decoded = self.api.b64xor_dec(gzip_decompress)
-            objects = data_decoded.get('objects')
-            target_code_set = set([target['code'] for target in targets])
-
-            logger.debug(f'Processing {len(objects)} objects')
-            for each_obj in objects:
-                code = each_obj.get('code')
-                level = each_obj.get('level')
-                loc = each_obj.get('loc')
-
-                level_whitelist = [target['level'] for target in targets if target['code'] == code]
-                if not level_whitelist:
-                    # not the one we are looking for
-                    continue
+            entering_at = time.time()
+            logger.debug('entering field')
+            sio.emit('/field/enter/v3', self.api.b64xor_enc({'token': self.token}))
 
-                level_whitelist = level_whitelist[0]
-                if level_whitelist and level not in level_whitelist:
-                    logger.info(f'level not in whitelist, ignore: {each_obj}')
-                    continue
+        socket = ManagedSocket(
+            'socf', f'{url}?token={self.token}',
+            enter=enter_field, headers=ws_headers, logger=socf_logger, engineio_logger=socf_logger
+        )
+        sio = socket.sio
+        self.sio_clients['socf'] = sio
 
-                # Log found objects that match our criteria
-                if code in set(OBJECT_MINE_CODE_LIST).intersection(target_code_set) or \
-                   code in set(OBJECT_MONSTER_CODE_LIST).intersection(target_code_set):
-                    obj_type = "Resource" if code in OBJECT_MINE_CODE_LIST else "Monster"
-
-                    # Format status information
-                    status = "Available"
-                    occupied_info = ""
-
-                    if each_obj.get('occupied'):
-                        status = "Occupied"
-                        occupied = each_obj.get('occupied')
-                        occupied_info = f"""
-    Occupied by: {occupied.get('name', 'Unknown')}
-    Alliance: {occupied.get('allianceTag', 'None')}
-    From World: {occupied.get('worldId', 'Unknown')}
-    Started: {occupied.get('started', 'Unknown')}
-    Ended: {occupied.get('ended', 'Unknown')}"""
-
-                    # Log in the requested format
-                    log_message = f"""Found {obj_type}:
-Code - {code}
-Level - {level}
-Location - {loc}
-Status - {status}{occupied_info}"""
+        @sio.on('/field/objects/v4')
+        def on_field_objects(data):
+            objects = self._decode_field_objects(data)
+            found = self._process_field_objects(objects, targets, objects_logger, code_loggers)
 
-                    # Log to main objects file
-                    objects_logger.info(log_message)
-
-                    # Send to Discord if enabled
-                    if config.get('discord', {}).get('enabled', False) and config.get('discord', {}).get('webhook_url'):
-                        try:
-                            from lokbot.discord_webhook import DiscordWebhook
-
-                            # Get resource name based on code
-                            resource_name = "Unknown"
-                            if code == 20100105:
-                                resource_name = "Crystal Mine"
-                            elif code == 20100106:
-                                resource_name = "Dragon Soul Cavern"
-                            else:
-                                resource_name = f"Resource {code}"
-
-                            # Special handling for level 1 Crystal Mines
-                            if code == 20100105 and level == 1 and config.get('discord', {}).get('crystal_mine_level1_webhook_url'):
-                                level1_webhook = DiscordWebhook(config.get('discord', {}).get('crystal_mine_level1_webhook_url'))
-                                level1_webhook.send_object_log(
-                                    f"{obj_type} (Level 1 {resource_name})", 
-                                    code, 
-                                    level, 
-                                    loc, 
-                                    status, 
-                                    occupied_info.strip() if occupied_info else ""
-                                )
-
-                            # For level 3+ resources, send to dedicated webhook if configured
-                            if level >= 3 and config.get('discord', {}).get('level3plus_webhook_url'):
-                                level3plus_webhook = DiscordWebhook(config.get('discord', {}).get('level3plus_webhook_url'))
-                                level3plus_webhook.send_object_log(
-                                    f"{obj_type} (Level {level} {resource_name})", 
-                                    code, 
-                                    level, 
-                                    loc, 
-                                    status, 
-                                    occupied_info.strip() if occupied_info else ""
-                                )
-                                
-                            # For level 2+ resources, send to dedicated webhook if configured
-                            if level >= 2 and config.get('discord', {}).get('level2plus_webhook_url'):
-                                level2plus_webhook = DiscordWebhook(config.get('discord', {}).get('level2plus_webhook_url'))
-                                level2plus_webhook.send_object_log(
-                                    f"{obj_type} (Level {level} {resource_name})", 
-                                    code, 
-                                    level, 
-                                    loc, 
-                                    status, 
-                                    occupied_info.strip() if occupied_info else ""
-                                )
-                                
-                            # Also send to main webhook for all resources except level 1 crystal mines
-                            if level >= 2 or code != 20100105:
-                                webhook = DiscordWebhook(config.get('discord', {}).get('webhook_url'))
-                                webhook.send_object_log(
-                                    f"{obj_type} ({resource_name})", 
-                                    code, 
-                                    level, 
-                                    loc, 
-                                    status, 
-                                    occupied_info.strip() if occupied_info else ""
-                                )
-                                
-                            # Send ALL resources to custom webhook regardless of type or level
-                            if config.get('discord', {}).get('custom_webhook_url'):
-                                custom_webhook = DiscordWebhook(config.get('discord', {}).get('custom_webhook_url'))
-                                custom_webhook.send_all_resources(
-                                    f"{resource_name}", 
-                                    code, 
-                                    level, 
-                                    loc, 
-                                    status, 
-                                    occupied_info.strip() if occupied_info else ""
-                                )
-                        except Exception as e:
-                            logger.error(f"Failed to send to Discord: {e}")
-
-                    # Log to code-specific file if we have a logger for this code
-                    if code in code_loggers:
-                        code_loggers[code].info(log_message)
-
-                    logger.info(f"Found {obj_type} - Code: {code}, Level: {level}, Location: {loc}, Status: {status}")
-
-            self.field_object_processed = True
+            batch = self.zone_batch
+            if batch and covers(batch.zone_ids, objects) and batch.complete() is not None:
+                self.zone_scheduler.record(batch.zone_ids, found)
 
         @sio.on('/field/enter/v3')
         def on_field_enter(data):
@@ -937,62 +1206,90 @@ Status - {status}{occupied_info}"""
             sio.emit('/zone/enter/list/v4', self.api.b64xor_enc({'world': self.socf_world_id, 'zones': default_zones}))
             sio.emit('/zone/leave/list/v2', {'world': self.socf_world_id, 'zones': default_zones})
 
-            self.socf_entered = True
+            if not field_entered.done():
+                field_entered.set_result(time.time())
 
-        sio.connect(f'{url}?token={self.token}', transports=["websocket"], headers=ws_headers)
-        logger.debug(f'entering field: {self.zones}')
-        sio.emit('/field/enter/v3', self.api.b64xor_enc({'token': self.token}))
+        def wait_field_entered():
+            """
+            after a reconnect, the field is entered again before the next batch
+            :return: whether the field is entered
+            """
+            socket.connect()
+            for attempt in range(1 + ENTER_RETRIES):
+                if attempt:
+                    logger.warning(f'socf_thread field not entered after {ENTER_TIMEOUT}s, reconnecting')
+                    socket.reconnect()
 
-        while not self.socf_entered:
-            time.sleep(1)
+                if field_entered.done():
+                    return True
 
-        step = 9
-        grace = 7  # 9 times enter-leave action will cause ban
-        index = 0
-        while self.zones:
-            if index >= grace:
-                logger.info('socf_thread grace exceeded, break')
-                break
+                try:
+                    lokbot.metrics.observe('field_enter_seconds', field_entered.result(ENTER_TIMEOUT) - entering_at)
+                    return True
+                except concurrent.futures.TimeoutError:
+                    continue
 
-            index += 1
-            zone_ids = []
-            for _ in range(step):
-                if not self.zones:
+            return False
+
+        try:
+            grace = 7  # 9 times enter-leave action will cause ban
+            index = 0
+            while zone_ids:
+                if index >= grace:
+                    logger.info('socf_thread grace exceeded, break')
                     break
 
-                zone_ids.append(self.zones.pop(0))
+                index += 1
 
-            if len(zone_ids) < step:
-                logger.info(f'len(zone_ids) < {step}, break')
-                self.zones = []
-                break
+                if self.stopped:
+                    break
+
+                if not wait_field_entered():
+                    logger.warning('socf_thread field not entered, giving up until the next run')
+                    break
+
+                batch = ZoneBatch(self.socf_world_id, zone_ids)
+                self.zone_batch = batch
+                for attempt in range(1 + ZONE_BATCH_RETRIES):
+                    if attempt:
+                        # a retry is another enter-leave action, so it counts towards `grace`
+                        if index >= grace:
+                            break
+                        index += 1
+
+                    batch.enter(sio, self.api)
+                    logger.debug(f'entering zone: {zone_ids} and waiting for processing')
+                    received = batch.wait()
+                    batch.leave(sio)
+                    if received:
+                        break
 
-            if not sio.connected:
-                logger.warning('socf_thread disconnected, reconnecting')
-                raise tenacity.TryAgain()
+                    logger.warning(f'no objects received for zone: {zone_ids} (attempt {attempt + 1})')
 
-            message = {'world': self.socf_world_id, 'zones': json.dumps(zone_ids, separators=(',', ':'))}
-            encoded_message = self.api.b64xor_enc(message)
+                self.zone_batch = None
 
-            sio.emit('/zone/enter/list/v4', encoded_message)
-            self.field_object_processed = False
-            logger.debug(f'entering zone: {zone_ids} and waiting for processing')
-            while not self.field_object_processed:
-                time.sleep(1)
-            sio.emit('/zone/leave/list/v2', message)
+                # zones left over when `grace` is exceeded would be skipped for the cycle
+                zone_ids = self.zone_scheduler.next_batch(step) if index < grace else []
+        finally:
+            self.zone_batch = None
+            socket.stop()
 
+        self.zone_scheduler.save()
         logger.info('a loop is finished')
         current_time = arrow.now().format('HH:mm:ss')
         objects_logger.info(f"Finished object scanning session at {current_time}")
-        sio.disconnect()
-        sio.wait()
-
-    @tenacity.retry(
-        stop=tenacity.stop_after_attempt(4),
-        wait=tenacity.wait_random_exponential(multiplier=1, max=60),
-        retry=tenacity.retry_if_not_exception_type(FatalApiException),
-        reraise=True
-    )
+
+    def socf_session_thread(self, radius, targets, share_to=None, cadence=10):
+        """
+        long-lived websocket connection of the field, enters the next batch of zones every `cadence` seconds
+        an alternative to the `socf_thread` job, see `lokbot.field_session.FieldSession`
+        :return:
+        """
+        self.field_session = FieldSession(self, radius, targets, cadence, ws_headers)
+        self.sio_clients['socf_session'] = self.field_session.sio
+        self.sockets['socf_session'] = self.field_session.socket
+        self.field_session.start()
+
     def socc_thread(self):
         """
         websocket connection of the chat
@@ -1000,40 +1297,30 @@ Status - {status}{occupied_info}"""
         """
         url = self.kingdom_enter.get('networks').get('chats')[0]
 
-        sio = socketio.Client(reconnection=False, logger=socc_logger, engineio_logger=socc_logger)
-
         # no token needed in query string, yet
-        sio.connect(url, transports=["websocket"], headers=ws_headers)
-        sio.emit('/chat/enter', {'token': self.token})
+        socket = ManagedSocket(
+            'socc', url,
+            enter=lambda sio: sio.emit('/chat/enter', {'token': self.token}),
+            headers=ws_headers, logger=socc_logger, engineio_logger=socc_logger
+        )
+        self.sockets['socc'] = socket
+        self.sio_clients['socc'] = socket.sio
 
-        sio.wait()
-        logger.warning('socc_thread disconnected, reconnecting')
-        raise tenacity.TryAgain()
+        socket.run()
 
     def harvester(self):
         """
         收获资源
         :return:
         """
-        buildings = self.kingdom_enter.get('kingdom', {}).get('buildings', [])
+        snapshot = self.state.snapshot()
 
-        random.shuffle(buildings)
+        # 每个种类只需要收获一次, 就会自动收获整个种类下所有资源
+        codes = [code for code in snapshot.buildings_by_code if code in HARVESTABLE_CODE]
+        random.shuffle(codes)
 
-        harvested_code = set()
-        for building in buildings:
-            code = building.get('code')
-            position = building.get('position')
-
-            if code not in HARVESTABLE_CODE:
-                continue
-
-            # 每个种类只需要收获一次, 就会自动收获整个种类下所有资源
-            if code in harvested_code:
-                continue
-
-            harvested_code.add(code)
-
-            self.api.kingdom_resource_harvest(position)
+        for code in codes:
+            self.api.kingdom_resource_harvest(random.choice(snapshot.buildings_of(code)).position)
 
     def quest_monitor_thread(self):
         """
@@ -1049,7 +1336,7 @@ Status - {status}{occupied_info}"""
         if len([self.api.quest_claim(q) for q in quest_list.get('sideQuests') if
                 q.get('status') == STATUS_FINISHED]) >= 5:
             # 若五个均为已完成, 则翻页
-            threading.Thread(target=self.quest_monitor_thread).start()
+            self.scheduler.call_later('quest_monitor_thread', 0, self.quest_monitor_thread)
             return
 
         quest_list_daily = self.api.quest_list_daily().get('dailyQuest')
@@ -1058,7 +1345,7 @@ Status - {status}{occupied_info}"""
         if len([self.api.quest_claim_daily(q) for q in quest_list_daily.get('quests') if
                 q.get('status') == STATUS_FINISHED]) >= 5:
             # 若五个均为已完成, 则翻页
-            threading.Thread(target=self.quest_monitor_thread).start()
+            self.scheduler.call_later('quest_monitor_thread', 0, self.quest_monitor_thread)
             return
 
         # daily quest reward
@@ -1068,8 +1355,11 @@ Status - {status}{occupied_info}"""
         # event
         event_list = self.api.event_list()
         event_has_red_dot = [each for each in event_list.get('events') if each.get('reddot') > 0]
-        for event in event_has_red_dot:
-            event_info = self.api.event_info(event.get('_id'))
+        # the infos are independent reads, fetch them together
+        for event_info in self.api.batch([(self.api.event_info, event.get('_id')) for event in event_has_red_dot]):
+            if isinstance(event_info, Exception):
+                raise event_info
+
             finished_code = [
                 each.get('code') for each in event_info.get('eventKingdom').get('events')
                 if each.get('status') == STATUS_FINISHED
@@ -1083,48 +1373,37 @@ Status - {status}{occupied_info}"""
             ) for each in event_info.get('event').get('events') if each.get('code') in finished_code]
 
         logger.info('quest_monitor: done, sleep for 1h')
-        threading.Timer(3600, self.quest_monitor_thread).start()
+        self.scheduler.call_later('quest_monitor_thread', 3600, self.quest_monitor_thread)
         return
 
-    def _building_farmer_worker(self, speedup=False):
-        buildings = self.kingdom_enter.get('kingdom', {}).get('buildings', [])
-        buildings.sort(key=lambda x: x.get('level'))
-        kingdom_level = [b for b in buildings if b.get('code') == BUILDING_CODE_MAP['castle']][0].get('level')
-
-        # First check if there is any empty position available for building
-        for level_requirement, positions in BUILD_POSITION_UNLOCK_MAP.items():
-            if kingdom_level < level_requirement:
-                continue
-
-            for position in positions:
-                if position.get('position') in [building.get('position') for building in buildings]:
-                    continue
-
-                building = {
-                    'code': position.get('code'),
-                    'position': position.get('position'),
-                    'level': 0,
-                    'state': BUILDING_STATE_NORMAL,
-                }
-
-                res = self._upgrade_building(building, buildings, speedup)
+    def _plan_building(self):
+        """
+        work out the next building while the upgrade just started is in progress, see `lokbot.planner`
+        :return:
+        """
+        snapshot = self.state.snapshot()
+        self.planner.set(QUEUE_BUILDING, next((
+            building for building in self._building_candidates(snapshot)
+            if self._is_building_upgradeable(building, snapshot)
+        ), None))
 
-                if res == 'continue':
-                    continue
-                if res == 'break':
-                    break
+    def _building_farmer_worker(self, speedup=False):
+        snapshot = self.state.snapshot()
+        candidates = self._building_candidates(snapshot)
 
-                return True
+        planned = self.planner.take(QUEUE_BUILDING, self._is_building_plan_valid)
+        if planned is not None:
+            candidates = itertools.chain([planned], candidates)
 
-        # Then check if there is any upgradeable building
-        for building in buildings:
-            res = self._upgrade_building(building, buildings, speedup)
+        for building in candidates:
+            res = self._upgrade_building(building, snapshot, speedup)
 
             if res == 'continue':
                 continue
             if res == 'break':
                 break
 
+            self._plan_building()
             return True
 
         return False
@@ -1135,20 +1414,47 @@ Status - {status}{occupied_info}"""
         :param speedup:
         :return:
         """
-        self.kingdom_tasks = self.api.kingdom_task_all().get('kingdomTasks', [])
-
-        silver_in_use = [t for t in self.kingdom_tasks if t.get('code') == TASK_CODE_SILVER_HAMMER]
-        gold_in_use = [t for t in self.kingdom_tasks if t.get('code') == TASK_CODE_GOLD_HAMMER]
+        self.tasks.woke(TASK_CODE_SILVER_HAMMER)
+        silver_in_use = self.tasks.tasks(TASK_CODE_SILVER_HAMMER)
+        gold_in_use = self.tasks.tasks(TASK_CODE_GOLD_HAMMER)
 
         if not silver_in_use or (self.has_additional_building_queue and not gold_in_use):
             if not self._building_farmer_worker(speedup):
                 logger.info(f'no building to upgrade, sleep for 2h')
-                threading.Timer(7200, self.building_farmer_thread).start()
+                self.scheduler.call_later('building_farmer_thread', 7200, self.building_farmer_thread, speedup)
                 return
 
-        self.building_queue_available.wait()  # wait for building queue available from `sock_thread`
-        self.building_queue_available.clear()
-        threading.Thread(target=self.building_farmer_thread, args=[speedup]).start()
+        # wait for building queue available from `sock_thread`
+        self.tasks.park(
+            'building_farmer_thread', (TASK_CODE_SILVER_HAMMER, TASK_CODE_GOLD_HAMMER), self.building_farmer_thread,
+            speedup
+        )
+
+    def _start_research(self, category_name, research_name, research_code, speedup):
+        try:
+            res = self.api.kingdom_academy_research({'code': research_code})
+        except OtherException as error_code:
+            if str(error_code) == 'not_enough_condition':
+                logger.warning(f'category {category_name} reached max level')
+                return 'break'
+
+            logger.info(f'research failed, try next one, current: {research_name}({research_code})')
+            return 'continue'
+
+        self.tasks.add(res.get('newTask'))
+        if speedup:
+            self.do_speedup(res.get('newTask').get('expectedEnded'), res.get('newTask').get('_id'), 'research')
+
+    def _plan_research(self, to_max_level, research_code):
+        """
+        work out the research after `research_code` while it is in progress, see `lokbot.planner`
+        :return:
+        """
+        exist_researches = self.api.kingdom_academy_research_list().get('researches', [])
+        academy_level = self.state.snapshot().building(BUILDING_CODE_MAP['academy']).level
+
+        planned = next(self._research_candidates(academy_level, exist_researches, to_max_level, research_code), None)
+        self.planner.set(QUEUE_ACADEMY, planned and (*planned, exist_researches))
 
     def academy_farmer_thread(self, to_max_level=False, speedup=False):
         """
@@ -1157,87 +1463,59 @@ Status - {status}{occupied_info}"""
         :param speedup:
         :return:
         """
-        self.kingdom_tasks = self.api.kingdom_task_all().get('kingdomTasks', [])
-
-        worker_used = [t for t in self.kingdom_tasks if t.get('code') == TASK_CODE_ACADEMY]
+        self.tasks.woke(TASK_CODE_ACADEMY)
+        worker_used = self.tasks.tasks(TASK_CODE_ACADEMY)
 
         if worker_used:
-            if worker_used[0].get('status') != STATUS_CLAIMED:
-                self.research_queue_available.wait()  # wait for research queue available from `sock_thread`
-                self.research_queue_available.clear()
-                threading.Thread(target=self.academy_farmer_thread, args=[to_max_level, speedup]).start()
+            if worker_used[0].status != STATUS_CLAIMED:
+                # wait for research queue available from `sock_thread`
+                self.tasks.park(
+                    'academy_farmer_thread', (TASK_CODE_ACADEMY,), self.academy_farmer_thread, to_max_level, speedup
+                )
                 return
 
             # 如果已完成, 则领取奖励并继续
             self.api.kingdom_task_claim(BUILDING_POSITION_MAP['academy'])
-
-        exist_researches = self.api.kingdom_academy_research_list().get('researches', [])
-        buildings = self.kingdom_enter.get('kingdom', {}).get('buildings', [])
-        academy_level = [b for b in buildings if b.get('code') == BUILDING_CODE_MAP['academy']][0].get('level')
-
-        for category_name, each_category in RESEARCH_CODE_MAP.items():
-            for research_name, research_code in each_category.items():
-                if not self._is_researchable(
-                        academy_level, category_name, research_name, exist_researches, to_max_level
-                ):
+            self.tasks.discard(TASK_CODE_ACADEMY)
+
+        planned = self.planner.take(QUEUE_ACADEMY, functools.partial(self._is_research_plan_valid, to_max_level))
+        if planned is not None and self._start_research(*planned[:3], speedup) is None:
+            candidate = planned[:3]
+        else:
+            candidate = None
+            exist_researches = self.api.kingdom_academy_research_list().get('researches', [])
+            academy_level = self.state.snapshot().building(BUILDING_CODE_MAP['academy']).level
+
+            maxed_categories = set()
+            for category_name, research_name, research_code in self._research_candidates(
+                    academy_level, exist_researches, to_max_level
+            ):
+                if category_name in maxed_categories:
                     continue
 
-                try:
-                    res = self.api.kingdom_academy_research({'code': research_code})
-                except OtherException as error_code:
-                    if str(error_code) == 'not_enough_condition':
-                        logger.warning(f'category {category_name} reached max level')
-                        break
-
-                    logger.info(f'research failed, try next one, current: {research_name}({research_code})')
+                res = self._start_research(category_name, research_name, research_code, speedup)
+                if res == 'break':
+                    maxed_categories.add(category_name)
+                    continue
+                if res == 'continue':
                     continue
 
-                if speedup:
-                    self.do_speedup(res.get('newTask').get('expectedEnded'), res.get('newTask').get('_id'), 'research')
-
-                self.research_queue_available.wait()  # wait for research queue available from `sock_thread`
-                self.research_queue_available.clear()
-                threading.Thread(target=self.academy_farmer_thread, args=[to_max_level, speedup]).start()
-                return
-
-        logger.info('academy_farmer: no research to do, sleep for 2h')
-        threading.Timer(2 * 3600, self.academy_farmer_thread, [to_max_level]).start()
-        return
-
-    def _troop_training_capacity(self):
-        """
-        return total troop training capacity of all barracks
-        """
-        buildings = self.kingdom_enter.get('kingdom', {}).get('buildings', [])
-        troop_training_capacity = 0
-        for building in buildings:
-            if building['code'] == BUILDING_CODE_MAP['barrack']:
-                troop_training_capacity += BARRACK_LEVEL_TROOP_TRAINING_RATE_MAP[int(building['level'])]
-
-        return troop_training_capacity
-
-    def _total_troops_capacity_according_to_resources(self, troop_code):
-        """
-        return maximum number of troops according to resources
-        """
-        req_resources = TRAIN_TROOP_RESOURCE_REQUIREMENT[troop_code]
-
-        amount = None
-        for req_resource, resource in zip(req_resources, self.resources):
-            if req_resource == 0:
-                continue
+                candidate = category_name, research_name, research_code
+                break
 
-            if amount is None or resource // req_resource <= amount:
-                amount = resource // req_resource
+        if candidate is None:
+            logger.info('academy_farmer: no research to do, sleep for 2h')
+            self.scheduler.call_later(
+                'academy_farmer_thread', 2 * 3600, self.academy_farmer_thread, to_max_level, speedup
+            )
+            return
 
-        return amount if amount is not None else 0
+        self._plan_research(to_max_level, candidate[2])
 
-    def _random_choice_building(self, building_code):
-        """
-        return a random building object with the building_code
-        """
-        buildings = self.kingdom_enter.get('kingdom', {}).get('buildings', [])
-        return random.choice([building for building in buildings if building['code'] == building_code])
+        # wait for research queue available from `sock_thread`
+        self.tasks.park(
+            'academy_farmer_thread', (TASK_CODE_ACADEMY,), self.academy_farmer_thread, to_max_level, speedup
+        )
 
     def train_troop_thread(self, troop_code, speedup=False, interval=3600):
         """
@@ -1247,28 +1525,32 @@ Status - {status}{occupied_info}"""
         :param speedup:
         :return:
         """
+        self.tasks.woke(TASK_CODE_CAMP)
         while self.api.last_requested_at + 4 > time.time():
             # attempt to prevent `insufficient_resources` due to race conditions
             logger.info(f'last requested at {arrow.get(self.api.last_requested_at).humanize()}, waiting...')
-            time.sleep(4)
-
-        self.kingdom_tasks = self.api.kingdom_task_all().get('kingdomTasks', [])
+            lokbot.tracing.sleep(4)
 
-        worker_used = [t for t in self.kingdom_tasks if t.get('code') == TASK_CODE_CAMP]
+        worker_used = self.tasks.tasks(TASK_CODE_CAMP)
 
         troop_training_capacity = self._troop_training_capacity()
 
         if worker_used:
-            if worker_used[0].get('status') == STATUS_CLAIMED:
-                self.api.kingdom_task_claim(self._random_choice_building(BUILDING_CODE_MAP['barrack'])['position'])
+            if worker_used[0].status == STATUS_CLAIMED:
+                self.api.kingdom_task_claim(self._random_choice_building(BUILDING_CODE_MAP['barrack']).position)
+                self.tasks.discard(TASK_CODE_CAMP)
+                self.tasks.reactions.pause(QUEUE_CAMP, interval)
                 logger.info(f'train_troop: one loop completed, sleep for {interval} seconds')
-                threading.Timer(interval, self.train_troop_thread, [troop_code, speedup, interval]).start()
+                self.scheduler.call_later(
+                    'train_troop_thread', interval, self.train_troop_thread, troop_code, speedup, interval
+                )
                 return
 
-            if worker_used[0].get('status') == STATUS_PENDING:
-                self.train_queue_available.wait()  # wait for train queue available from `sock_thread`
-                self.train_queue_available.clear()
-                threading.Thread(target=self.train_troop_thread, args=[troop_code, speedup, interval]).start()
+            if worker_used[0].status == STATUS_PENDING:
+                # wait for train queue available from `sock_thread`
+                self.tasks.park(
+                    'train_troop_thread', (TASK_CODE_CAMP,), self.train_troop_thread, troop_code, speedup, interval
+                )
                 return
 
         # if there are not enough resources, train how much possible
@@ -1278,22 +1560,28 @@ Status - {status}{occupied_info}"""
 
         if not troop_training_capacity:
             logger.info('train_troop: no resource, sleep for 1h')
-            threading.Timer(3600, self.train_troop_thread, [troop_code, speedup, interval]).start()
+            self.scheduler.call_later(
+                'train_troop_thread', 3600, self.train_troop_thread, troop_code, speedup, interval
+            )
             return
 
         try:
             res = self.api.train_troop(troop_code, troop_training_capacity)
         except OtherException as error_code:
             logger.info(f'train_troop: {error_code}, sleep for 1h')
-            threading.Timer(3600, self.train_troop_thread, [troop_code, speedup, interval]).start()
+            self.scheduler.call_later(
+                'train_troop_thread', 3600, self.train_troop_thread, troop_code, speedup, interval
+            )
             return
 
+        self.tasks.add(res.get('newTask'))
         if speedup:
             self.do_speedup(res.get('newTask').get('expectedEnded'), res.get('newTask').get('_id'), 'train')
 
-        self.train_queue_available.wait()  # wait for train queue available from `sock_thread`
-        self.train_queue_available.clear()
-        threading.Thread(target=self.train_troop_thread, args=[troop_code, speedup, interval]).start()
+        # wait for train queue available from `sock_thread`
+        self.tasks.park(
+            'train_troop_thread', (TASK_CODE_CAMP,), self.train_troop_thread, troop_code, speedup, interval
+        )
 
     def free_chest_farmer_thread(self, _type=0):
         """
@@ -1305,7 +1593,7 @@ Status - {status}{occupied_info}"""
         except OtherException as error_code:
             if str(error_code) == 'free_chest_not_yet':
                 logger.info('free_chest_farmer: free_chest_not_yet, sleep for 2h')
-                threading.Timer(2 * 3600, self.free_chest_farmer_thread).start()
+                self.scheduler.call_later('free_chest_farmer_thread', 2 * 3600, self.free_chest_farmer_thread)
                 return
 
             raise
@@ -1317,10 +1605,11 @@ Status - {status}{occupied_info}"""
         }
         next_type = min(next_dict, key=next_dict.get)
 
-        threading.Timer(
+        self.scheduler.call_later(
+            'free_chest_farmer_thread',
             self.calc_time_diff_in_seconds(next_dict[next_type]),
-            self.free_chest_farmer_thread, [next_type]
-        ).start()
+            self.free_chest_farmer_thread, next_type
+        )
 
     def use_resource_in_item_list(self):
         """
@@ -1336,7 +1625,7 @@ Status - {status}{occupied_info}"""
 
         for each_item in usable_item_list:
             self.api.item_use(each_item.get('code'), each_item.get('amount'))
-            time.sleep(random.randint(1, 3))
+            lokbot.tracing.sleep(random.randint(1, 3))
 
     def vip_chest_claim(self):
         """
@@ -1388,16 +1677,16 @@ Status - {status}{occupied_info}"""
             if resource_index == -1:
                 continue
 
-            if each_item.get('cost') > self.resources[resource_index]:
+            if each_item.get('cost') > self.state.resource(resource_index):
                 continue
 
             self.api.kingdom_caravan_buy(each_item.get('_id'))
 
     def mail_claim(self):
         self.api.mail_claim_all(1)  # report
-        time.sleep(random.randint(4, 6))
+        lokbot.tracing.sleep(random.randint(4, 6))
         self.api.mail_claim_all(2)  # alliance
-        time.sleep(random.randint(4, 6))
+        lokbot.tracing.sleep(random.randint(4, 6))
         self.api.mail_claim_all(3)  # system
 
     def wall_repair(self):
@@ -1443,18 +1732,19 @@ Status - {status}{occupied_info}"""
             self.api.kingdom_hospital_recover()
 
     def keepalive_request(self):
-        try:
-            lokbot.util.run_functions_in_random_order(
-                self.api.kingdom_wall_info,
-                self.api.quest_main,
-                self.api.item_list,
-                self.api.kingdom_treasure_list,
-                self.api.event_list,
-                self.api.event_cvc_open,
-                self.api.event_roulette_open,
-                self.api.drago_lair_list,
-                self.api.pkg_recommend,
-                self.api.pkg_list,
-            )
-        except OtherException:
-            pass
\ No newline at end of file
+        functions = [
+            self.api.kingdom_wall_info,
+            self.api.quest_main,
+            self.api.item_list,
+            self.api.kingdom_treasure_list,
+            self.api.event_list,
+            self.api.event_cvc_open,
+            self.api.event_roulette_open,
+            self.api.drago_lair_list,
+            self.api.pkg_recommend,
+            self.api.pkg_list,
+        ]
+        random.shuffle(functions)
+
+        # independent reads, made together on the HTTP/2 connection
+        self._keepalive_results(functions, self.api.batch(functions))
\ No newline at end of file
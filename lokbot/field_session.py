@@ -0,0 +1,257 @@
+import collections
+import concurrent.futures
+import json
+import threading
+import time
+
+import arrow
+
+import lokbot.util
+from lokbot import logger, socf_logger, metrics
+from lokbot.connection import ManagedSocket
+
+ZONE_BATCH_SIZE = 9
+ZONE_BATCH_LIMIT = 7  # 9 times enter-leave action will cause ban
+ZONE_BATCH_WINDOW = 60  # seconds the limit applies to, one `socf_thread` run used to take about a minute
+QUIET_SECONDS = 16  # when we are in the field, we should not be doing anything else
+ENTER_TIMEOUT = 30
+ENTER_RETRIES = 2  # reconnects when the field is not entered within `ENTER_TIMEOUT`
+ZONE_BATCH_TIMEOUT = 10  # a pack usually arrives within a second
+ZONE_BATCH_RETRIES = 1
+
+
+def covers(zone_ids, objects):
+    """
+    whether a `/field/objects/v4` pack of `objects` is the one of the batch `zone_ids`, not the one of the knock
+    zones or of a batch that timed out. An empty pack may be of any batch.
+    :return:
+    """
+    return all(
+        lokbot.util.get_zone_id_by_coords(each_obj.get('loc')[1], each_obj.get('loc')[2]) in zone_ids
+        for each_obj in objects or []
+    )
+
+
+class ZoneBatch:
+    """
+    A batch of zones waiting for its `/field/objects/v4` pack.
+    The receive thread completes it, so `wait` returns as soon as the pack is processed.
+    """
+    __slots__ = ('zone_ids', 'message', 'future', 'entered_at')
+
+    def __init__(self, world_id, zone_ids):
+        self.zone_ids = zone_ids
+        self.message = {'world': world_id, 'zones': json.dumps(zone_ids, separators=(',', ':'))}
+        self.future = concurrent.futures.Future()
+        self.entered_at = None
+
+    def enter(self, sio, api):
+        self.entered_at = time.time()
+        sio.emit('/zone/enter/list/v4', api.b64xor_enc(self.message))
+
+    def leave(self, sio):
+        sio.emit('/zone/leave/list/v2', self.message)
+
+    def complete(self):
+        """
+        called after the objects of the pack are processed
+        :return: enter -> pack latency, None if the batch was already completed
+        """
+        latency = time.time() - self.entered_at
+        try:
+            self.future.set_result(latency)
+        except concurrent.futures.InvalidStateError:
+            return None
+
+        metrics.observe('field_zone_pack_seconds', latency)
+
+        return latency
+
+    def wait(self, timeout=ZONE_BATCH_TIMEOUT):
+        """
+        :return: whether the pack arrived within `timeout`
+        """
+        try:
+            self.future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            metrics.inc('field_zone_batch_timeouts')
+            return False
+
+        return True
+
+
+class FieldSession:
+    """
+    Long-lived websocket connection of the field.
+
+    Instead of connecting, entering the field and scanning up to `ZONE_BATCH_LIMIT` batches once a minute like
+    `LokFarmer.socf_thread`, the session stays in the field and enters the next batch of zones every `cadence`
+    seconds, never more than `ZONE_BATCH_LIMIT` batches per `ZONE_BATCH_WINDOW`. Every step is a continuation on
+    the scheduler of the farmer. The connection is a `ManagedSocket`, a dropped one is connected and the field
+    entered again with the same client and handlers.
+    """
+
+    def __init__(self, farmer, radius, targets, cadence=10, headers=None, name='socf_session_thread'):
+        self.farmer = farmer
+        self.api = farmer.api
+        self.scheduler = farmer.scheduler
+        self.radius = radius
+        self.targets = targets
+        self.cadence = cadence
+        self.name = name
+
+        self.world_id = farmer.kingdom_enter.get('kingdom').get('worldId')
+        self.entered = False
+        self.entering_at = None
+        self.scanned_batches = 0
+        self.current = None  # ZoneBatch waiting for objects
+        self.batches = collections.deque()  # start time of recent batches
+        self.lock = threading.Lock()
+        self.thread = None
+
+        self.log_date = None
+        self.objects_logger = None
+        self.code_loggers = None
+
+        url = farmer.kingdom_enter.get('networks').get('fields')[0]
+        self.socket = ManagedSocket(
+            'socf_session', f'{url}?token={farmer.token}',
+            enter=self._enter, headers=headers, logger=socf_logger, engineio_logger=socf_logger
+        )
+        self.sio = self.socket.sio
+        self.sio.on('/field/enter/v3', self._on_field_enter)
+        self.sio.on('/field/objects/v4', self._on_field_objects)
+
+    def start(self):
+        """
+        keep the socket connected in the background until `socket.stop()`
+        :return:
+        """
+        if not self.farmer.zone_scheduler:
+            logger.info('getting nearest zone')
+            self.farmer.zone_scheduler = self.farmer._create_zone_scheduler(
+                self.radius, self.farmer._get_land_with_level()
+            )
+
+        self.thread = threading.Thread(target=self.socket.run, name=f'{self.name}-{self.farmer._id}', daemon=True)
+        self.thread.start()
+
+    def _enter(self, sio):
+        # when we are in the field, we should not be doing anything else
+        quiet = self.api.last_requested_at + QUIET_SECONDS - time.time()
+        while quiet > 0 and not self.socket.stopped:
+            logger.info(f'last requested at {arrow.get(self.api.last_requested_at).humanize()}, waiting...')
+            self.socket.stop_event.wait(quiet)
+            quiet = self.api.last_requested_at + QUIET_SECONDS - time.time()
+
+        if self.socket.stopped:
+            return
+
+        self.entered = False
+        with self.lock:
+            self.current = None
+
+        self.entering_at = time.time()
+        sio.emit('/field/enter/v3', self.api.b64xor_enc({'token': self.farmer.token}))
+        self.scheduler.call_later(self.name, ENTER_TIMEOUT, self._check_entered)
+
+    def _check_entered(self):
+        if self.entered or not self.sio.connected:
+            return
+
+        logger.warning(f'socf_session: field not entered after {ENTER_TIMEOUT}s, reconnecting')
+        # `ManagedSocket.run` connects and enters again
+        self.sio.disconnect()
+
+    def _on_field_enter(self, data):
+        data_decoded = self.api.b64xor_dec(data)
+        logger.debug(data_decoded)
+        self.world_id = data_decoded.get('loc')[0]  # in case of cvc event world map
+
+        # knock
+        self.sio.emit('/zone/leave/list/v2', {'world': self.world_id, 'zones': '[]'})
+        default_zones = '[0,64,1,65]'
+        self.sio.emit('/zone/enter/list/v4', self.api.b64xor_enc({'world': self.world_id, 'zones': default_zones}))
+        self.sio.emit('/zone/leave/list/v2', {'world': self.world_id, 'zones': default_zones})
+
+        self.entered = True
+        metrics.inc('field_session_enters')
+        metrics.observe('field_enter_seconds', time.time() - self.entering_at)
+        self.scheduler.call_later(self.name, 0, self.step)
+
+    def _open_loggers(self):
+        # objects are logged to one file per day
+        today = arrow.now().format('YYYY-MM-DD')
+        if today != self.log_date:
+            self.objects_logger, self.code_loggers = self.farmer._get_objects_loggers(self.targets)
+            self.log_date = today
+
+    def step(self):
+        """
+        leave the previous batch if it is still waiting, then enter the next one
+        :return:
+        """
+        if self.farmer.stopped:
+            return
+
+        if not self.sio.connected or not self.entered:
+            # stepping again once the field is entered
+            return
+
+        now = time.time()
+        while self.batches and self.batches[0] <= now - ZONE_BATCH_WINDOW:
+            self.batches.popleft()
+
+        if len(self.batches) >= ZONE_BATCH_LIMIT:
+            self.scheduler.call_later(self.name, self.batches[0] + ZONE_BATCH_WINDOW - now, self.step)
+            return
+
+        with self.lock:
+            previous, self.current = self.current, None
+
+        if previous:
+            logger.warning(f'socf_session: no objects received for zone: {previous.zone_ids}')
+            metrics.inc('field_zone_batch_timeouts')
+            previous.leave(self.sio)
+
+        self._open_loggers()
+
+        zone_ids = self.farmer.zone_scheduler.next_batch(ZONE_BATCH_SIZE)
+        if not zone_ids:
+            # nothing is expected to have changed, check again later
+            self.scheduler.call_later(self.name, self.cadence, self.step)
+            return
+
+        self.scanned_batches += 1
+        if self.scanned_batches % ZONE_BATCH_LIMIT == 0:
+            self.farmer.zone_scheduler.save()
+
+        batch = ZoneBatch(self.world_id, zone_ids)
+
+        with self.lock:
+            self.current = batch
+
+        self.batches.append(now)
+        logger.debug(f'entering zone: {zone_ids}')
+        batch.enter(self.sio, self.api)
+
+        self.scheduler.call_later(self.name, self.cadence, self.step)
+
+    def _on_field_objects(self, data):
+        objects = self.farmer._decode_field_objects(data)
+
+        self._open_loggers()
+        found = self.farmer._process_field_objects(objects, self.targets, self.objects_logger, self.code_loggers)
+
+        with self.lock:
+            current = self.current
+            if current and not covers(current.zone_ids, objects):
+                # the pack of other zones, the batch goes on waiting for its own
+                current = None
+            else:
+                self.current = None
+
+        if current:
+            current.complete()
+            self.farmer.zone_scheduler.record(current.zone_ids, found)
+            current.leave(self.sio)
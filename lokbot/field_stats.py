@@ -0,0 +1,169 @@
+import collections
+import time
+
+import arrow
+
+import lokbot.util
+
+REVISIT_THRESHOLD = 0.5  # expected new targets in a zone worth entering it again
+MIN_REVISIT_SECONDS = 60
+MAX_REVISIT_SECONDS = 3600  # revisit anyway, so the estimates stay fresh
+DEFAULT_RATE = 1 / 3600  # new targets per zone per second, until the first revisits are observed
+PRIOR_SECONDS = 1800  # weight of the field-wide rate in the rate of a single zone
+
+
+class Sighting:
+    __slots__ = ('code', 'level', 'first_seen', 'expired', 'occupied')
+
+    def __init__(self, code, level, first_seen, expired, occupied):
+        self.code = code
+        self.level = level
+        self.first_seen = first_seen
+        self.expired = expired
+        self.occupied = occupied
+
+
+class ZoneStats:
+    __slots__ = ('last_scanned_at', 'observed_seconds', 'appeared', 'sightings', 'known')
+
+    def __init__(self, last_scanned_at=None, observed_seconds=0, appeared=0):
+        self.last_scanned_at = last_scanned_at
+        self.observed_seconds = observed_seconds  # sum of the intervals between two scans
+        self.appeared = appeared  # targets that appeared or got free within those intervals
+        self.sightings = {}  # {object id: Sighting}, not persisted
+        self.known = False  # whether `sightings` are the targets of the last scan
+
+
+class FieldStats:
+    """
+    Respawn model of the targets in the field, fed by the objects of `/field/objects/v4`.
+
+    Between two scans of a zone, every target seen for the first time or freed by a march counts as appeared.
+    The respawn rate of a zone is its appeared count over the observed time, shrunk towards the field-wide rate
+    while the zone has little history. A zone is due when the targets expected since its last scan, plus the
+    known targets whose `expired` has passed (they are replaced), reach `threshold`.
+    """
+
+    def __init__(self, threshold=REVISIT_THRESHOLD):
+        self.threshold = threshold
+        self.zones = {}
+        # field-wide counters per (code, level)
+        self.appeared = collections.Counter()
+        self.freed = collections.Counter()
+        self.taken = collections.Counter()
+        self.gone = collections.Counter()
+
+    def observe(self, zone_ids, objects, now=None):
+        """
+        account a scan of `zone_ids`, `objects` are the targets seen in them
+        :return:
+        """
+        now = time.time() if now is None else now
+
+        seen = {zone_id: [] for zone_id in zone_ids}
+        for each_obj in objects:
+            loc = each_obj.get('loc')
+            zone_id = lokbot.util.get_zone_id_by_coords(loc[1], loc[2])
+            if zone_id in seen:
+                seen[zone_id].append(each_obj)
+
+        for zone_id, zone_objects in seen.items():
+            stats = self.zones.setdefault(zone_id, ZoneStats())
+            revisit = stats.known
+
+            sightings = {}
+            appeared = 0
+            for each_obj in zone_objects:
+                _id = each_obj.get('_id') or tuple(each_obj.get('loc'))
+                key = (each_obj.get('code'), each_obj.get('level'))
+                occupied = bool(each_obj.get('occupied'))
+                previous = stats.sightings.get(_id)
+
+                if previous is None:
+                    expired = each_obj.get('expired')
+                    expired = arrow.get(expired).timestamp() if expired else None
+                    sightings[_id] = Sighting(key[0], key[1], now, expired, occupied)
+                    if revisit and not occupied:
+                        appeared += 1
+                        self.appeared[key] += 1
+                    continue
+
+                if previous.occupied and not occupied:
+                    appeared += 1
+                    self.freed[key] += 1
+                elif not previous.occupied and occupied:
+                    self.taken[key] += 1
+
+                previous.occupied = occupied
+                sightings[_id] = previous
+
+            for _id, sighting in stats.sightings.items():
+                if _id not in sightings:
+                    self.gone[(sighting.code, sighting.level)] += 1
+
+            if revisit:
+                stats.observed_seconds += now - stats.last_scanned_at
+                stats.appeared += appeared
+
+            stats.sightings = sightings
+            stats.last_scanned_at = now
+            stats.known = True
+
+    def field_rate(self):
+        observed_seconds = sum(stats.observed_seconds for stats in self.zones.values())
+        if observed_seconds < PRIOR_SECONDS:
+            return DEFAULT_RATE
+
+        return sum(stats.appeared for stats in self.zones.values()) / observed_seconds
+
+    def rate(self, zone_id, field_rate=None):
+        """
+        :return: estimated new targets per second of the zone
+        """
+        field_rate = self.field_rate() if field_rate is None else field_rate
+        stats = self.zones.get(zone_id)
+        if stats is None:
+            return field_rate
+
+        return (stats.appeared + field_rate * PRIOR_SECONDS) / (stats.observed_seconds + PRIOR_SECONDS)
+
+    def expected(self, zone_id, now=None, field_rate=None):
+        """
+        :return: targets expected to be new in the zone since its last scan
+        """
+        now = time.time() if now is None else now
+        stats = self.zones.get(zone_id)
+        if stats is None or stats.last_scanned_at is None:
+            return float('inf')
+
+        replaced = sum(
+            1 for sighting in stats.sightings.values()
+            if sighting.expired and stats.last_scanned_at < sighting.expired <= now
+        )
+
+        return self.rate(zone_id, field_rate) * (now - stats.last_scanned_at) + replaced
+
+    def is_due(self, zone_id, now=None, field_rate=None):
+        now = time.time() if now is None else now
+        stats = self.zones.get(zone_id)
+        if stats is None or stats.last_scanned_at is None:
+            return True
+
+        elapsed = now - stats.last_scanned_at
+        if elapsed < MIN_REVISIT_SECONDS:
+            return False
+
+        if elapsed >= MAX_REVISIT_SECONDS:
+            return True
+
+        return self.expected(zone_id, now, field_rate) >= self.threshold
+
+    def to_dict(self):
+        return {
+            str(zone_id): [stats.last_scanned_at, stats.observed_seconds, stats.appeared]
+            for zone_id, stats in self.zones.items()
+        }
+
+    def load_dict(self, data):
+        for zone_id, (last_scanned_at, observed_seconds, appeared) in data.items():
+            self.zones[int(zone_id)] = ZoneStats(last_scanned_at, observed_seconds, appeared)
@@ -0,0 +1,298 @@
+import base64
+import copy
+import gzip
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+import arrow
+import psutil
+
+from lokbot import logger, config, project_root
+
+# file the raw `/field/objects/v4` events are appended to, see `record`
+RECORD_ENV = 'LOKBOT_RECORD_PACKS'
+
+ZONE_BATCH_SIZE = 9
+PACK_OBJECTS = 300  # objects per pack, about what a batch of 9 zones holds
+OCCUPIED_RATIO = 0.3
+PACK_POOL = 64  # distinct synthetic packs cycled by the harness
+
+_lock = threading.Lock()
+_record_file = open(os.environ[RECORD_ENV], 'a') if os.getenv(RECORD_ENV) else None
+
+
+def record(data, api):
+    """
+    append a `/field/objects/v4` event to the file of `LOKBOT_RECORD_PACKS`, a no-op when it is not set
+    :return:
+    """
+    if _record_file is None:
+        return
+
+    line = json.dumps({
+        'time': time.time(),
+        'key': api.xor_password,  # packs can only be decoded with the xor password of their session
+        'packs': base64.b64encode(bytes(bytearray(data.get('packs')))).decode(),
+    })
+
+    with _lock:
+        _record_file.write(line + '\n')
+        _record_file.flush()
+
+
+def replay(path, api, loop=False):
+    """
+    events recorded with `LOKBOT_RECORD_PACKS`, `api` takes the xor password of the first one
+    and events of other sessions are encoded again with it
+    :return: generator of `/field/objects/v4` event data
+    """
+    if _record_file is not None and os.path.samefile(_record_file.name, path):
+        # every replayed event would be recorded again, and replayed again
+        raise ValueError(f'{path} is being recorded to, unset {RECORD_ENV} to replay it')
+
+    session_api = copy.copy(api)
+
+    while True:
+        with open(path) as f:
+            for line in f:
+                recorded = json.loads(line)
+                packs = base64.b64decode(recorded.get('packs'))
+
+                if api.xor_password is None:
+                    api.xor_password = recorded.get('key')
+
+                if recorded.get('key') != api.xor_password:
+                    session_api.xor_password = recorded.get('key')
+                    data_decoded = session_api.b64xor_dec(gzip.decompress(packs))
+                    packs = gzip.compress(api.b64xor_enc(data_decoded).encode())
+
+                yield {'packs': packs}
+
+        if not loop:
+            return
+
+
+def load_field_entries():
+    """
+    (code, level) of every object and monster of the field assets
+    :return:
+    """
+    entries = []
+    for name in ('field_object', 'field_monster'):
+        with open(project_root.joinpath(f'lokbot/assets/{name}.json')) as f:
+            entries += [(each.get('code'), each.get('level')) for each in json.load(f)]
+
+    return entries
+
+
+class FieldTrafficGenerator:
+    """
+    Synthetic `/field/objects/v4` events: gzip'd, base64 encoded and xor'ed with the password of `api`,
+    the objects drawn from the field assets.
+    """
+
+    def __init__(self, api, objects=PACK_OBJECTS, codes=None, occupied_ratio=OCCUPIED_RATIO, world_id=0, seed=None):
+        """
+        :param objects: objects per pack, or a (min, max) range
+        :param codes: {code: weight} of the objects, every code of the assets equally by default
+        """
+        self.api = api
+        self.objects_per_pack = objects
+        self.occupied_ratio = occupied_ratio
+        self.world_id = world_id
+        self.random = random.Random(seed)
+        self._ids = itertools.count()
+
+        entries = load_field_entries()
+        if codes:
+            entries = [entry for entry in entries if entry[0] in codes]
+            self.weights = [codes[code] for code, _ in entries]
+        else:
+            self.weights = None
+        self.entries = entries
+
+    def objects(self, zone_ids):
+        count = self.objects_per_pack
+        if not isinstance(count, int):
+            count = self.random.randint(*count)
+
+        objects = []
+        for code, level in self.random.choices(self.entries, self.weights, k=count):
+            zone_id = self.random.choice(zone_ids)
+            # see `lokbot.util.get_zone_id_by_coords`
+            x = zone_id % 64 * 32 + self.random.randrange(32)
+            y = zone_id // 64 * 32 + self.random.randrange(32)
+            each_obj = {
+                '_id': f'{next(self._ids):024x}',
+                'code': code,
+                'level': level,
+                'loc': [self.world_id, x, y],
+                'expired': arrow.utcnow().shift(hours=self.random.randint(1, 48)).isoformat(),
+            }
+            if self.random.random() < self.occupied_ratio:
+                each_obj['occupied'] = {
+                    'name': 'someone', 'allianceTag': 'TAG', 'worldId': self.world_id,
+                    'started': arrow.utcnow().isoformat(), 'ended': arrow.utcnow().shift(hours=1).isoformat(),
+                }
+            objects.append(each_obj)
+
+        return objects
+
+    def pack(self, zone_ids=None):
+        """
+        :return: event data, like the `data` of `on_field_objects`
+        """
+        if zone_ids is None:
+            start = self.random.randrange(4096 - ZONE_BATCH_SIZE)
+            zone_ids = list(range(start, start + ZONE_BATCH_SIZE))
+
+        encoded = self.api.b64xor_enc({'objects': self.objects(zone_ids)})
+
+        return {'packs': list(gzip.compress(encoded.encode()))}
+
+    def __iter__(self):
+        while True:
+            yield self.pack()
+
+
+def _null_objects_loggers(targets):
+    """
+    object loggers formatting and writing to /dev/null, instead of the files of `_get_objects_loggers`
+    """
+    handler = logging.FileHandler(os.devnull)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+
+    loggers = {}
+    for name in ['objects'] + [str(target['code']) for target in targets]:
+        each_logger = logging.getLogger(f'{__name__}.{name}')
+        each_logger.handlers[:] = [handler]
+        each_logger.setLevel(logging.INFO)
+        each_logger.propagate = False
+        loggers[name] = each_logger
+
+    return loggers.pop('objects'), {target['code']: loggers[str(target['code'])] for target in targets}
+
+
+def run_harness(farmer, source, targets, rate=0, duration=10, maxsize=1024):
+    """
+    push events through `_decode_field_objects` and `_process_field_objects` like the socket does:
+    a producer at `rate` events/s (0 for as fast as possible) and one consumer, the receive thread
+    :param source: iterable of event data, `FieldTrafficGenerator` or `replay`
+    :return: dict of throughput, pack -> processed latency and memory growth
+    """
+    objects_logger, code_loggers = _null_objects_loggers(targets)
+    events = queue.Queue(maxsize)
+    latencies = []
+    counts = {'packs': 0, 'objects': 0, 'found': 0, 'dropped': 0}
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+
+    def consume():
+        while True:
+            item = events.get()
+            if item is None:
+                return
+
+            data, sent_at = item
+            objects = farmer._decode_field_objects(data)
+            found = farmer._process_field_objects(objects, targets, objects_logger, code_loggers)
+
+            latencies.append(time.perf_counter() - sent_at)
+            counts['packs'] += 1
+            counts['objects'] += len(objects)
+            counts['found'] += len(found)
+
+    consumer = threading.Thread(target=consume, name='field-traffic-consumer', daemon=True)
+    consumer.start()
+
+    started_at = time.perf_counter()
+    sent = 0
+    for data in source:
+        now = time.perf_counter()
+        if now - started_at >= duration:
+            break
+
+        if rate:
+            due_at = started_at + sent / rate
+            if due_at > now:
+                time.sleep(due_at - now)
+
+        try:
+            # a full queue means the consumer fell behind, like a socket buffer overflowing
+            events.put_nowait((data, time.perf_counter()))
+        except queue.Full:
+            counts['dropped'] += 1
+        sent += 1
+
+    produced_at = time.perf_counter()
+    backlog = events.qsize()
+    events.put(None)
+    consumer.join()
+    elapsed = time.perf_counter() - started_at
+
+    latencies.sort()
+
+    def latency(q):
+        return latencies[min(int(len(latencies) * q), len(latencies) - 1)] if latencies else None
+
+    return {
+        'rate': rate,
+        'duration': produced_at - started_at,
+        'sent': sent,
+        'processed': counts['packs'],
+        'dropped': counts['dropped'],
+        'backlog': backlog,
+        'packs_per_second': counts['packs'] / elapsed,
+        'zones_per_second': counts['packs'] * ZONE_BATCH_SIZE / elapsed,
+        'objects_per_second': counts['objects'] / elapsed,
+        'found': counts['found'],
+        'latency_p50': latency(0.5),
+        'latency_p99': latency(0.99),
+        'latency_max': latencies[-1] if latencies else None,
+        'rss_growth_bytes': process.memory_info().rss - rss_before,
+        'falling_behind': bool(counts['dropped'] or backlog),
+    }
+
+
+def main(rate=0, duration=10, objects=PACK_OBJECTS, replay_file=None, codes=None, webhook=False, seed=0):
+    """
+    `python -m lokbot traffic --rate 20`, measures how many zones per second one farmer absorbs
+    :param rate: packs per second, 0 for as fast as possible
+    :param objects: objects per synthetic pack
+    :param replay_file: events recorded with `LOKBOT_RECORD_PACKS` instead of synthetic ones
+    :param codes: comma separated object codes of the synthetic packs
+    :param webhook: keep the discord webhooks of config.json, off by default
+    :return:
+    """
+    from lokbot.bench import bench_farmer
+
+    farmer = bench_farmer()
+    targets = [{'code': code, 'level': []} for code in (20100105, 20100106)]
+
+    if replay_file:
+        farmer.api.xor_password = None
+        source = replay(replay_file, farmer.api, loop=True)
+    else:
+        if isinstance(codes, str):
+            codes = codes.split(',')
+        codes = {int(code): 1 for code in codes} if codes else None
+        generator = FieldTrafficGenerator(farmer.api, objects, codes, seed=seed)
+        # generated ahead, so the producer keeps up with any rate
+        source = itertools.cycle([generator.pack() for _ in range(PACK_POOL)])
+
+    logger.disable('lokbot')
+    discord_config = None if webhook else config.pop('discord', None)
+    try:
+        result = run_harness(farmer, source, targets, rate, duration)
+    finally:
+        if discord_config is not None:
+            config['discord'] = discord_config
+        logger.enable('lokbot')
+
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,277 @@
+import atexit
+import collections
+import gzip
+import logging
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+
+import arrow
+
+from lokbot import metrics
+
+BUFFER_SIZE = 65536  # messages
+BATCH_SIZE = 512  # messages written per sink per flush
+FLUSH_INTERVAL = 0.2  # seconds the writer sleeps when the buffer is empty
+SAMPLE_WATERMARK = 0.75  # fill ratio of the buffer above which low level messages are sampled
+SAMPLE_RATE = 10  # keep 1 of every `SAMPLE_RATE` low level messages above the watermark
+LATENCY_SAMPLE_RATE = 64  # enqueue latency is measured on 1 of every `LATENCY_SAMPLE_RATE` messages
+
+WARNING = logging.WARNING
+
+
+class RotatingFile:
+    """
+    Append-only file rotated every hour like `logging.handlers.TimedRotatingFileHandler`.
+    Only used from the writer thread; rotated files are gzipped by the compressor thread of the pipeline.
+    """
+
+    def __init__(self, path, backup_count=48, compress=True):
+        self.path = str(path)
+        self.backup_count = backup_count
+        self.compress = compress
+        self.file = None
+        self.rollover_at = None
+
+    def _open(self):
+        # like `TimedRotatingFileHandler`, an existing file is rotated at the end of the hour it was last written in
+        started_at = os.path.getmtime(self.path) if os.path.exists(self.path) else time.time()
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.rollover_at = arrow.get(started_at).to('local').floor('hour').shift(hours=1).timestamp()
+
+    def write(self, lines, compressor):
+        if self.file is None:
+            self._open()
+
+        if time.time() >= self.rollover_at:
+            self.rollover(compressor)
+
+        self.file.write(''.join(lines))
+        self.file.flush()
+
+    def rollover(self, compressor):
+        self.file.close()
+
+        rotated = f'{self.path}.{arrow.get(self.rollover_at).shift(hours=-1).to("local").format("YYYY-MM-DD_HH")}'
+        if os.path.exists(self.path) and not os.path.exists(rotated):
+            os.replace(self.path, rotated)
+            if self.compress:
+                compressor.put(rotated)
+
+        self._open()
+        self._remove_old_backups()
+
+    def _remove_old_backups(self):
+        directory, name = os.path.split(self.path)
+        backups = sorted(f for f in os.listdir(directory or '.') if f.startswith(f'{name}.'))
+        for backup in backups[:max(len(backups) - self.backup_count, 0)]:
+            os.remove(os.path.join(directory, backup))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class StreamSink:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, lines, compressor):
+        self.stream.write(''.join(lines))
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+class LogPipeline:
+    """
+    Bounded, in-memory buffer between the threads that log and the files they log to.
+
+    Enqueuing appends a tuple to a `collections.deque`, which needs no lock, so the socket and request threads never
+    format nor write. One writer thread formats the messages, writes them in batches and rotates the files;
+    a compressor thread gzips the rotated ones. Above `SAMPLE_WATERMARK` only 1 of `SAMPLE_RATE` messages below
+    WARNING is kept, and when the buffer is full they are dropped. WARNING and above always get in, evicting the
+    oldest message if needed.
+    """
+
+    def __init__(self, maxsize=BUFFER_SIZE):
+        self.maxsize = maxsize
+        self.watermark = int(maxsize * SAMPLE_WATERMARK)
+        self.sinks = {}
+        self.buffer = collections.deque(maxlen=maxsize)
+        self.compressor = queue.SimpleQueue()
+        self.stopped = threading.Event()
+        self._sampled = 0
+        self._enqueued = 0
+
+        self.writer = threading.Thread(target=self._write_loop, name='log-writer', daemon=True)
+        self.compress_thread = threading.Thread(target=self._compress_loop, name='log-compressor', daemon=True)
+
+    def add_sink(self, name, sink):
+        self.sinks[name] = sink
+
+    def start(self):
+        self.writer.start()
+        self.compress_thread.start()
+
+    def enqueue(self, sink, level, item):
+        """
+        hand a message to the writer, `item` is a `logging.LogRecord` or a formatted `str`
+        :return: whether the message was kept
+        """
+        self._enqueued += 1
+        measure = self._enqueued % LATENCY_SAMPLE_RATE == 0
+        if measure:
+            started_at = time.perf_counter()
+
+        size = len(self.buffer)
+        if level < WARNING and size >= self.watermark:
+            if size >= self.maxsize:
+                metrics.inc('log_messages_dropped', sink=sink)
+                return False
+
+            self._sampled += 1
+            if self._sampled % SAMPLE_RATE:
+                metrics.inc('log_messages_sampled', sink=sink)
+                return False
+        elif size >= self.maxsize:
+            # evicts the oldest message
+            metrics.inc('log_messages_dropped', sink=sink)
+
+        self.buffer.append((sink, item))
+
+        if measure:
+            metrics.observe('log_enqueue_seconds', time.perf_counter() - started_at)
+
+        return True
+
+    def flush(self):
+        """
+        write everything in the buffer, from the writer thread or after it stopped
+        :return:
+        """
+        pending = {}
+        for _ in range(BATCH_SIZE * max(len(self.sinks), 1)):
+            try:
+                sink, item = self.buffer.popleft()
+            except IndexError:
+                break
+
+            if isinstance(item, logging.LogRecord):
+                item = item.handler.format(item) + '\n'
+
+            pending.setdefault(sink, []).append(item)
+
+        for sink, lines in pending.items():
+            try:
+                self.sinks[sink].write(lines, self.compressor)
+            except Exception as e:
+                sys.stderr.write(f'log_pipeline: failed to write {len(lines)} messages to {sink}: {e}\n')
+
+        metrics.gauge('log_buffer_depth', len(self.buffer))
+
+        return bool(pending)
+
+    def _write_loop(self):
+        while not self.stopped.is_set():
+            if not self.flush():
+                time.sleep(FLUSH_INTERVAL)
+
+    def _compress_loop(self):
+        while True:
+            path = self.compressor.get()
+            if path is None:
+                return
+
+            try:
+                with open(path, 'rb') as src, gzip.open(f'{path}.gz', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(path)
+            except OSError as e:
+                sys.stderr.write(f'log_pipeline: failed to compress {path}: {e}\n')
+
+    def close(self):
+        self.stopped.set()
+        if self.writer.is_alive():
+            self.writer.join()
+
+        while self.flush():
+            pass
+
+        for sink in self.sinks.values():
+            sink.close()
+
+        self.compressor.put(None)
+        if self.compress_thread.is_alive():
+            self.compress_thread.join()
+
+
+class QueuedHandler(logging.Handler):
+    """
+    `logging.Handler` enqueuing records to a `LogPipeline`, formatted later by the writer with this handler's formatter
+    """
+
+    def __init__(self, pipeline, sink, level=logging.NOTSET):
+        super().__init__(level)
+        self.pipeline = pipeline
+        self.sink = sink
+
+    def handle(self, record):
+        # unlike `logging.Handler.handle`, no lock: the pipeline does not need one
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+
+        return rv
+
+    def emit(self, record):
+        record.handler = self
+        self.pipeline.enqueue(self.sink, record.levelno, record)
+
+
+class LoguruSink:
+    """
+    loguru sink enqueuing the formatted message to a `LogPipeline`
+    """
+
+    def __init__(self, pipeline, sink):
+        self.pipeline = pipeline
+        self.sink = sink
+
+    def write(self, message):
+        self.pipeline.enqueue(self.sink, message.record['level'].no, str(message))
+
+
+def install(log_config, formatter, loggers):
+    """
+    route loguru and the socket-io `loggers` through a `LogPipeline`, see the `logging` section of config.json
+    :param loggers: {name: logging.Logger}, each written to `log_path(name)`
+    :return: the started pipeline
+    """
+    from lokbot import logger, log_path
+
+    pipeline = LogPipeline(log_config.get('buffer_size', BUFFER_SIZE))
+    backup_count = log_config.get('backup_count', 48)
+    compress = log_config.get('compress', True)
+
+    for name, each_logger in loggers.items():
+        pipeline.add_sink(name, RotatingFile(log_path(name), backup_count, compress))
+
+        handler = QueuedHandler(pipeline, name)
+        handler.setFormatter(formatter)
+        each_logger.addHandler(handler)
+
+    pipeline.add_sink('main', RotatingFile(log_path('main'), backup_count, compress))
+    pipeline.add_sink('stdout', StreamSink(sys.stdout))
+
+    logger.add(LoguruSink(pipeline, 'main').write)
+    logger.add(LoguruSink(pipeline, 'stdout').write, colorize=True)
+
+    pipeline.start()
+    atexit.register(pipeline.close)
+
+    return pipeline
@@ -0,0 +1,106 @@
+import collections
+import threading
+
+HISTOGRAM_SAMPLES = 1024  # recent observations kept per histogram for quantiles
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_key(key):
+    name, labels = key
+    if not labels:
+        return name
+
+    return name + '{' + ','.join(f'{k}={v}' for k, v in labels) + '}'
+
+
+def quantile(samples, q):
+    if not samples:
+        return None
+
+    samples = sorted(samples)
+
+    return samples[min(int(len(samples) * q), len(samples) - 1)]
+
+
+class Histogram:
+    __slots__ = ('count', 'total', 'min', 'max', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.samples = collections.deque(maxlen=HISTOGRAM_SAMPLES)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.samples.append(value)
+
+    def snapshot(self):
+        samples = list(self.samples)
+
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'p50': quantile(samples, 0.5),
+            'p90': quantile(samples, 0.9),
+            'p99': quantile(samples, 0.99),
+        }
+
+
+class Registry:
+    """
+    In-process counters, gauges and histograms, labelled like `requests_total{api=kingdom/enter}`
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(int)
+        self.gauges = {}
+        self.histograms = collections.defaultdict(Histogram)
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[_key(name, labels)] += value
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            self.histograms[_key(name, labels)].observe(value)
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        """
+        plain dict of every metric, safe to pickle or dump as json
+        :return:
+        """
+        with self.lock:
+            return {
+                'counters': {_format_key(k): v for k, v in self.counters.items()},
+                'gauges': {_format_key(k): v for k, v in self.gauges.items()},
+                'histograms': {_format_key(k): v.snapshot() for k, v in self.histograms.items()},
+            }
+
+
+registry = Registry()
+
+inc = registry.inc
+gauge = registry.gauge
+observe = registry.observe
+snapshot = registry.snapshot
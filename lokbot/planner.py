@@ -0,0 +1,66 @@
+import threading
+import time
+
+from lokbot import metrics
+
+
+class Plan:
+    __slots__ = ('action', 'version', 'planned_at')
+
+    def __init__(self, action, version):
+        self.action = action
+        self.version = version  # of the `KingdomState` it was worked out from
+        self.planned_at = time.time()
+
+    def __repr__(self):
+        return f'<Plan {self.action} version={self.version}>'
+
+
+class Planner:
+    """
+    The next action of each task queue, worked out from a `KingdomState` snapshot while the running task is still
+    in progress, so that the farmer answers the completion of the task with the planned request instead of a scan.
+
+    A plan is invalidated by state changes: at the version it was planned from it is used as is, at a later one
+    its action is validated again against the new snapshot (one check instead of the scan) and dropped if it fails.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.lock = threading.Lock()
+        self.plans = {}  # {queue: Plan}
+
+    def set(self, queue, action):
+        """
+        :param action: the next action of `queue`, or None when there is nothing to do
+        :return:
+        """
+        with self.lock:
+            if action is None:
+                self.plans.pop(queue, None)
+                return
+
+            self.plans[queue] = Plan(action, self.state.version)
+
+    def take(self, queue, validate):
+        """
+        :param validate: `validate(action, snapshot)`, whether the action still holds at a later state version
+        :return: the planned action of `queue`, or None
+        """
+        with self.lock:
+            plan = self.plans.pop(queue, None)
+
+        if plan is None:
+            metrics.inc('planned_actions', queue=queue, outcome='none')
+            return None
+
+        snapshot = self.state.snapshot()
+        if snapshot.version == plan.version:
+            outcome = 'hit'
+        elif validate(plan.action, snapshot):
+            outcome = 'revalidated'
+        else:
+            outcome = 'stale'
+        metrics.inc('planned_actions', queue=queue, outcome=outcome)
+
+        return None if outcome == 'stale' else plan.action
@@ -0,0 +1,297 @@
+import collections
+import cProfile
+import multiprocessing.connection
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+import arrow
+
+from lokbot import logger, config, project_root
+
+# shared secret of the control endpoint, it is not started without one
+AUTHKEY_ENV = 'LOKBOT_PROFILING_AUTHKEY'
+
+DEFAULT_ADDRESS = ('127.0.0.1', 6544)
+SAMPLE_SECONDS = 30
+SAMPLE_INTERVAL = 0.005  # seconds between two samples of every thread's stack
+MAX_SAMPLE_SECONDS = 600
+TRACEMALLOC_FRAMES = 10
+TOP_STATS = 25  # lines of the tracemalloc summary
+
+_lock = threading.Lock()
+_sampling = threading.Event()
+_job_profiles = {}  # {job name: [deadline, pstats.Stats of the runs so far or None, output path]}
+_last_snapshot = None
+
+
+def _output_path(name, suffix):
+    directory = project_root.joinpath('data/profile')
+    directory.mkdir(exist_ok=True)
+
+    return directory.joinpath(f'{name}-{arrow.now().format("YYYYMMDD-HHmmss")}-{os.getpid()}.{suffix}')
+
+
+# region sampling
+
+def _collapse(frame, thread_name):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+
+    stack.append(thread_name)
+
+    return ';'.join(reversed(stack))
+
+
+def _sample_loop(duration, interval, path):
+    me = threading.get_ident()
+    stacks = collections.Counter()
+    samples = 0
+    deadline = time.monotonic() + duration
+
+    try:
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    stacks[_collapse(frame, names.get(ident, str(ident)))] += 1
+            samples += 1
+            time.sleep(interval)
+
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+    finally:
+        _sampling.clear()
+
+    logger.info(f'profiling: {samples} samples of {len(stacks)} stacks written to {path}')
+
+
+def sample(duration=SAMPLE_SECONDS, interval=SAMPLE_INTERVAL):
+    """
+    sample the stacks of every thread for `duration` seconds in the background,
+    the collapsed stacks (flamegraph.pl, speedscope) are written to `data/profile/sample-*.collapsed`
+    :return: path of the output
+    """
+    duration = min(float(duration), MAX_SAMPLE_SECONDS)
+
+    with _lock:
+        if _sampling.is_set():
+            raise ValueError('a sampling profile is already running')
+
+        _sampling.set()
+
+    path = _output_path('sample', 'collapsed')
+    threading.Thread(
+        target=_sample_loop, args=(duration, float(interval), path), name='profiling-sampler', daemon=True
+    ).start()
+    logger.info(f'profiling: sampling every thread for {duration}s')
+
+    return str(path)
+
+
+# endregion
+
+# region jobs
+
+def profile_job(name, duration=SAMPLE_SECONDS):
+    """
+    cProfile the runs of the scheduler job `name` (like `socf_thread`, without the account prefix)
+    started in the next `duration` seconds, written to `data/profile/<name>-*.pstats` after each run
+    :return: path of the output
+    """
+    path = _output_path(name, 'pstats')
+
+    with _lock:
+        _job_profiles[name] = [time.monotonic() + min(float(duration), MAX_SAMPLE_SECONDS), None, path]
+
+    logger.info(f'profiling: profiling the runs of {name} for {duration}s')
+
+    return str(path)
+
+
+def call(job_name, func, *args, **kwargs):
+    """
+    run a scheduler job, under cProfile while `profile_job` asked for it
+    :return:
+    """
+    if not _job_profiles:
+        return func(*args, **kwargs)
+
+    name = job_name.rpartition(':')[2]  # jobs of `SchedulerNamespace` are prefixed with the account id
+    with _lock:
+        entry = _job_profiles.get(name)
+        if entry is not None and time.monotonic() >= entry[0]:
+            del _job_profiles[name]
+            entry = None
+
+    if entry is None:
+        return func(*args, **kwargs)
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        with _lock:
+            # every run of the window adds up in one file
+            if entry[1] is None:
+                entry[1] = pstats.Stats(profile)
+            else:
+                entry[1].add(profile)
+            entry[1].dump_stats(entry[2])
+
+
+# endregion
+
+# region tracemalloc
+
+def snapshot_memory(frames=TRACEMALLOC_FRAMES):
+    """
+    dump a tracemalloc snapshot to `data/profile/tracemalloc-*.snapshot` (`tracemalloc.Snapshot.load`)
+    and its top allocations, compared with the previous snapshot, to a `.txt` next to it.
+    tracing starts with the first call unless it was started with `tracemalloc` in config.json
+    :return: path of the summary
+    """
+    global _last_snapshot
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        logger.info('profiling: tracemalloc started, the next snapshot will have the allocations since now')
+
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    path = _output_path('tracemalloc', 'snapshot')
+    snapshot.dump(str(path))
+
+    with _lock:
+        previous, _last_snapshot = _last_snapshot, snapshot
+
+    summary_path = path.with_suffix('.txt')
+    current, peak = tracemalloc.get_traced_memory()
+    with open(summary_path, 'w') as f:
+        f.write(f'traced {current} bytes, peak {peak} bytes\n\ntop allocations:\n')
+        for stat in snapshot.statistics('lineno')[:TOP_STATS]:
+            f.write(f'{stat}\n')
+
+        if previous is not None:
+            f.write('\ngrowth since the previous snapshot:\n')
+            for stat in snapshot.compare_to(previous, 'lineno')[:TOP_STATS]:
+                f.write(f'{stat}\n')
+
+    logger.info(f'profiling: tracemalloc snapshot written to {path}, {current} bytes traced')
+
+    return str(summary_path)
+
+
+# endregion
+
+# region triggers
+
+handlers = {
+    'sample': sample,
+    'profile_job': profile_job,
+    'snapshot': snapshot_memory,
+}
+
+
+def _in_background(func, *args):
+    # the signal handler interrupts whatever thread runs the main loop, keep it short
+    def run():
+        try:
+            func(*args)
+        except ValueError as e:
+            logger.warning(f'profiling: {e}')
+
+    threading.Thread(target=run, name='profiling-signal', daemon=True).start()
+
+
+def serve(address, authkey):
+    """
+    accept `(cmd, args)` of `handlers` on a local socket, like `Supervisor.serve`
+    :return: the address listened on
+    """
+    listener = multiprocessing.connection.Listener(address, authkey=authkey)
+    threading.Thread(target=_accept_loop, args=(listener,), name='profiling-ipc', daemon=True).start()
+
+    return listener.address
+
+
+def _accept_loop(listener):
+    while True:
+        try:
+            conn = listener.accept()
+        except multiprocessing.AuthenticationError:
+            logger.warning('profiling: rejected a connection with a wrong authkey')
+            continue
+
+        with conn:
+            try:
+                cmd, args = conn.recv()
+                response = True, handlers[cmd](*args)
+            except (EOFError, OSError):
+                continue
+            except Exception as e:
+                response = False, ValueError(f'{type(e).__name__}: {e}')
+
+            conn.send(response)
+
+
+def install(profiling_config):
+    """
+    set up the triggers of the `profiling` section of config.json:
+    SIGUSR1 samples every thread, SIGUSR2 dumps a tracemalloc snapshot,
+    and with `LOKBOT_PROFILING_AUTHKEY` set, `python -m lokbot profile` commands are accepted on `address`
+    :return:
+    """
+    if profiling_config.get('tracemalloc'):
+        tracemalloc.start(profiling_config.get('tracemalloc_frames', TRACEMALLOC_FRAMES))
+
+    duration = profiling_config.get('duration', SAMPLE_SECONDS)
+    interval = profiling_config.get('interval', SAMPLE_INTERVAL)
+    if profiling_config.get('sample_on_start'):
+        sample(duration, interval)
+
+    for name in profiling_config.get('jobs', []):
+        profile_job(name, duration)
+
+    if profiling_config.get('signals') and hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: _in_background(sample, duration, interval))
+        signal.signal(signal.SIGUSR2, lambda signum, frame: _in_background(snapshot_memory))
+
+    authkey = os.getenv(AUTHKEY_ENV)
+    if authkey:
+        address = serve(tuple(profiling_config.get('address', DEFAULT_ADDRESS)), authkey.encode())
+        logger.info(f'profiling: listening on {address}')
+
+
+# endregion
+
+def main(cmd, *args):
+    """
+    ask a running bot for a profile, `python -m lokbot profile sample 60`, `profile profile_job socf_thread 120`
+    or `profile snapshot`; needs the same `LOKBOT_PROFILING_AUTHKEY` as the bot
+    :return: path of the output, on the host of the bot
+    """
+    authkey = os.getenv(AUTHKEY_ENV)
+    if not authkey:
+        logger.error(f'No {AUTHKEY_ENV} found in environment variables.')
+        return
+
+    address = tuple(config.get('profiling', {}).get('address', DEFAULT_ADDRESS))
+    with multiprocessing.connection.Client(address, authkey=authkey.encode()) as conn:
+        conn.send((cmd, args))
+        ok, result = conn.recv()
+
+    if not ok:
+        raise result
+
+    return result
@@ -0,0 +1,145 @@
+import contextvars
+import json
+import os
+import threading
+import time
+
+from lokbot import logger, metrics
+
+POST = 'post'  # the account-wide rate of `LokBotApi.post`, other names are the methods decorated with `limits`
+
+INCREASE = 0.02  # of the configured rate, added after each accepted call
+DECREASE = 0.5  # the rate is multiplied by it on pushback
+FLOOR = 0.25  # of the configured rate
+CEILING = 1.0  # of the configured rate, never above the rates known to be tolerated
+SAVE_INTERVAL = 60  # seconds
+
+# error codes of the server pushing back, HTTP errors count as pushback too
+PUSHBACK_CODES = ('duplicated', 'exceed_limit_packet')
+
+# name of the `limits` decorated method the current `post` is made from
+current_endpoint = contextvars.ContextVar('lokbot_endpoint', default=None)
+
+
+class AdaptiveRates:
+    """
+    Per-endpoint client rates (calls per second) driven by AIMD: every accepted call adds `increase` of the
+    configured rate, every pushback multiplies the rate by `decrease`, always within `floor` and `ceiling`
+    (ratios of the configured rate, or `bounds` of an endpoint in calls per second).
+
+    The rates are saved to `path` so that a restart goes on at the rate the server tolerated last time.
+    """
+
+    def __init__(self, path=None, enabled=True, increase=INCREASE, decrease=DECREASE, floor=FLOOR, ceiling=CEILING,
+                 bounds=None):
+        self.path = path
+        self.enabled = enabled
+        self.increase = increase
+        self.decrease = decrease
+        self.floor = floor
+        self.ceiling = ceiling
+        self.bounds = bounds or {}  # {name: [floor, ceiling]}
+
+        self.lock = threading.Lock()
+        self.bases = {}  # {name: configured rate}
+        self.rates = {}
+        self.last_called = {}
+        self.saved_at = time.time()
+        self.dirty = False
+
+        self.load()
+
+    def _clip(self, name, rate):
+        base = self.bases[name]
+        floor, ceiling = self.bounds.get(name, (base * self.floor, base * self.ceiling))
+
+        return min(max(rate, floor), ceiling)
+
+    def rate(self, name, base):
+        """
+        :param base: the configured rate of `name`, the adaptive rate starts there
+        :return: current rate of `name`
+        """
+        with self.lock:
+            if name not in self.bases:
+                self.bases[name] = base
+                self.rates[name] = self._clip(name, self.rates.get(name, base))
+
+            return self.rates[name] if self.enabled else base
+
+    def acquire(self, name, base):
+        """
+        take a call of `name`, like `ratelimit.limits(calls=1, period=1 / rate)`
+        :return: 0 when the call may be made now, otherwise seconds to wait before trying again
+        """
+        interval = 1 / self.rate(name, base)
+
+        with self.lock:
+            now = time.monotonic()
+            wait = self.last_called.get(name, 0) + interval - now
+            if wait > 0:
+                return wait
+
+            self.last_called[name] = now
+
+        return 0
+
+    def feedback(self, name, accepted):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            if name not in self.bases:
+                return
+
+            rate = self.rates[name]
+            if accepted:
+                rate += self.bases[name] * self.increase
+            else:
+                rate *= self.decrease
+                metrics.inc('adaptive_rate_decreases', endpoint=name)
+
+            self.rates[name] = rate = self._clip(name, rate)
+            self.dirty = True
+
+        metrics.gauge('adaptive_rate', rate, endpoint=name)
+
+        if time.time() - self.saved_at >= SAVE_INTERVAL:
+            self.save()
+
+    def record(self, accepted):
+        """
+        account the outcome of a `post` to its own rate and to the rate of the `limits` method it was made from
+        :return:
+        """
+        self.feedback(POST, accepted)
+
+        endpoint = current_endpoint.get()
+        if endpoint is not None:
+            self.feedback(endpoint, accepted)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path) as f:
+                self.rates.update(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning(f'failed to load adaptive rates from {self.path}: {e}')
+
+    def save(self):
+        if not self.path:
+            return
+
+        with self.lock:
+            if not self.dirty:
+                return
+
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.rates, f)
+
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+            self.saved_at = time.time()
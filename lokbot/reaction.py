@@ -0,0 +1,213 @@
+import collections
+import contextvars
+import json
+import threading
+import time
+
+import arrow
+
+from lokbot import logger, config, project_root, metrics
+from lokbot.metrics import quantile
+
+# the parts a reaction is broken down into, `decision` is what is left of the total after the others
+PARTS = ('wakeup', 'rate_limit', 'sleep', 'decision', 'network')
+
+# `lokbot.tracing.add` keys -> part
+PART_KEYS = {
+    'limiter_wait_seconds': 'rate_limit',
+    'retry_wait_seconds': 'rate_limit',
+    'sleep_seconds': 'sleep',  # deliberate, like the 4s before `train_troop`
+    'network_seconds': 'network',
+}
+
+_current = contextvars.ContextVar('lokbot_reaction', default=None)
+
+
+class Reaction:
+    __slots__ = ('queue', 'event', 'event_at', 'woke_at', 'parts')
+
+    def __init__(self, queue, event):
+        self.queue = queue
+        self.event = event
+        self.event_at = time.time()
+        self.woke_at = None
+        self.parts = collections.Counter()
+
+    def breakdown(self, acted_at):
+        total = acted_at - self.event_at
+        parts = {
+            'wakeup': (self.woke_at or acted_at) - self.event_at,
+            'rate_limit': self.parts['rate_limit'],
+            'sleep': self.parts['sleep'],
+            'network': self.parts['network'],
+        }
+        parts['decision'] = max(total - sum(parts.values()), 0)
+
+        return total, parts
+
+
+class _Writer:
+    """
+    one JSON line per reaction, read by `report`
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def write(self, record):
+        line = json.dumps(record) + '\n'
+
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+
+def _create_writer(reaction_config):
+    if not reaction_config.get('enabled'):
+        return None
+
+    return _Writer(project_root.joinpath(reaction_config.get('path', 'data/reactions.jsonl')))
+
+
+_writer = _create_writer(config.get('reaction', {}))
+
+
+def add(key, value):
+    """
+    account `lokbot.tracing.add` to the reaction the current thread (or asyncio task) is in, if any
+    :return:
+    """
+    part = PART_KEYS.get(key)
+    if part is None:
+        return
+
+    current = _current.get()
+    if current is not None:
+        current.parts[part] += value
+
+
+class Reactions:
+    """
+    Time from a server event freeing a task queue (`/task/update`, `/building/update`) to the next mutating request
+    on the queue, per account.
+
+    The consumer of the queue calls `woke` when it runs, from then on the rate limit and network time of its requests
+    is accounted to the reaction, and `acted` once the request starting the next task returned.
+    """
+
+    def __init__(self, account):
+        self.account = account
+        self.lock = threading.Lock()
+        self.pending = {}  # {queue: Reaction}
+
+    def event(self, queue, event):
+        with self.lock:
+            # the first event of a completion counts, `/task/update` and `/building/update` come both
+            self.pending.setdefault(queue, Reaction(queue, event))
+
+    def woke(self, queue):
+        """
+        the consumer of `queue` runs, like `lokbot.request_scheduler.set_job` it stays with the thread (or task)
+        :return:
+        """
+        with self.lock:
+            reaction = self.pending.get(queue)
+            if reaction is not None and reaction.woke_at is None:
+                reaction.woke_at = time.time()
+
+        _current.set(reaction)
+
+    def pause(self, queue, seconds):
+        """
+        the consumer of `queue` leaves it idle on purpose for `seconds`, like the interval of `train_troop`
+        :return:
+        """
+        with self.lock:
+            reaction = self.pending.get(queue)
+            if reaction is not None:
+                reaction.parts['sleep'] += seconds
+
+    def acted(self, queue):
+        with self.lock:
+            reaction = self.pending.pop(queue, None)
+
+        if reaction is None:
+            return
+
+        if _current.get() is reaction:
+            _current.set(None)
+
+        acted_at = time.time()
+        total, parts = reaction.breakdown(acted_at)
+        day = arrow.get(reaction.event_at).format('YYYY-MM-DD')
+
+        metrics.observe('reaction_seconds', total, queue=queue, part='total')
+        for part, seconds in parts.items():
+            metrics.observe('reaction_seconds', seconds, queue=queue, part=part)
+            metrics.inc('reaction_idle_seconds', seconds, queue=queue, part=part, day=day)
+
+        logger.debug(f'reaction: {queue} {total:.3f}s after {reaction.event}, {parts}')
+
+        if _writer is not None:
+            _writer.write({
+                'account': self.account,
+                'queue': queue,
+                'event': reaction.event,
+                'event_at': reaction.event_at,
+                'day': day,
+                'total': total,
+                **parts,
+            })
+
+
+def report(path, day=None):
+    """
+    :param day: `YYYY-MM-DD`, every day by default
+    :return: {day: {queue: {count, total, p50, p99 and the sum of each of `PARTS`}}}
+    """
+    totals = collections.defaultdict(lambda: collections.defaultdict(list))
+    sums = collections.defaultdict(lambda: collections.defaultdict(collections.Counter))
+
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if day is not None and record.get('day') != day:
+                continue
+
+            totals[record.get('day')][record.get('queue')].append(record.get('total'))
+            for part in PARTS:
+                sums[record.get('day')][record.get('queue')][part] += record.get(part, 0)
+
+    return {
+        each_day: {
+            queue: {
+                'count': len(samples),
+                'total': sum(samples),
+                'p50': quantile(samples, 0.5),
+                'p99': quantile(samples, 0.99),
+                **sums[each_day][queue],
+            } for queue, samples in queues.items()
+        } for each_day, queues in sorted(totals.items())
+    }
+
+
+def main(day=None, path=None):
+    """
+    `python -m lokbot reaction`, idle time lost per queue and day between a server event and the bot's next action
+    :param day: `YYYY-MM-DD`, every day by default
+    :param path: `data/reactions.jsonl` by default
+    :return:
+    """
+    path = path or project_root.joinpath(config.get('reaction', {}).get('path', 'data/reactions.jsonl'))
+
+    for each_day, queues in report(path, day).items():
+        print(f'{each_day:<12} {"count":>7} {"total":>10} {"p50":>8} {"p99":>8}  ' + '  '.join(
+            f'{part:>10}' for part in PARTS
+        ))
+        for queue, row in queues.items():
+            print(
+                f'{queue:<12} {row["count"]:>7} {row["total"]:>10.1f} {row["p50"]:>8.2f} {row["p99"]:>8.2f}  '
+                + '  '.join(f'{row.get(part, 0):>10.1f}' for part in PARTS)
+            )
+        print()
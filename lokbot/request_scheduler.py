@@ -0,0 +1,197 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+
+import lokbot.tracing
+from lokbot import metrics
+
+PRIORITY_INTERACTIVE = 0  # marches and the actions a march or a finished task is waiting for
+PRIORITY_REFILL = 1  # refilling the building, research and training queues
+PRIORITY_BACKGROUND = 2  # housekeeping: mails, quests, alliance, keepalive reads
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_REFILL: 'refill',
+    PRIORITY_BACKGROUND: 'background',
+}
+
+# api path (or prefix ending with `/`) -> priority, anything else is `PRIORITY_BACKGROUND`
+API_PRIORITIES = {
+    'auth/': PRIORITY_INTERACTIVE,
+    'kingdom/enter': PRIORITY_INTERACTIVE,
+    'kingdom/world/change': PRIORITY_INTERACTIVE,
+    'field/march/start': PRIORITY_INTERACTIVE,
+    'field/march/info': PRIORITY_INTERACTIVE,
+    'kingdom/task/claim': PRIORITY_INTERACTIVE,
+    'kingdom/task/speedup': PRIORITY_INTERACTIVE,
+    'kingdom/heal/speedup': PRIORITY_INTERACTIVE,
+    'kingdom/task/all': PRIORITY_REFILL,
+    'kingdom/building/': PRIORITY_REFILL,
+    'kingdom/arcademy/': PRIORITY_REFILL,
+    'kingdom/barrack/train': PRIORITY_REFILL,
+    'kingdom/hospital/': PRIORITY_REFILL,
+    'kingdom/resource/harvest': PRIORITY_REFILL,
+    'kingdom/wall/repair': PRIORITY_REFILL,
+}
+
+RATE = 10  # requests per second of an account, was `limits(calls=1, period=0.1)` on `post`
+
+# name of the job (scheduler job or `_run_every` coroutine) the request is made from, see `set_job`
+current_job = contextvars.ContextVar('lokbot_job', default='')
+
+
+def set_job(name):
+    current_job.set(name)
+
+
+def get_priority(api_path):
+    priority = API_PRIORITIES.get(api_path)
+    if priority is not None:
+        return priority
+
+    for prefix, priority in API_PRIORITIES.items():
+        if prefix.endswith('/') and api_path.startswith(prefix):
+            return priority
+
+    return PRIORITY_BACKGROUND
+
+
+class _RequestQueue:
+    """
+    Grants `rate` requests per second to the waiting callers, the lowest priority class first.
+
+    Within a class, jobs get weighted fair queuing: every request of a job finishes `1 / weight` of virtual time
+    after the previous one of that job (or after the virtual time of the queue, when the job was idle),
+    and the earliest virtual finish is served first. A job bursting many requests only delays its own.
+    """
+
+    def __init__(self, rate=RATE, weights=None):
+        self.rate = rate  # configured, see `set_rate`
+        self.interval = 1 / rate
+        self.weights = weights or {}
+        self.heap = []
+        self.next_at = 0  # monotonic time of the next free slot
+        self.virtual_time = 0
+        self.finish = {}  # {job: virtual finish of its last request}
+        self._seq = itertools.count()
+
+    def set_rate(self, rate):
+        """
+        change the granted requests per second, see `lokbot.rate_control.AdaptiveRates`
+        :return:
+        """
+        self.interval = 1 / rate
+
+    def _push(self, api_path, job):
+        finish = max(self.virtual_time, self.finish.get(job, 0)) + 1 / self.weights.get(job, 1)
+        self.finish[job] = finish
+        entry = (get_priority(api_path), finish, next(self._seq))
+        heapq.heappush(self.heap, entry)
+
+        return entry
+
+    def _grant(self, entry):
+        """
+        :return: 0 when `entry` was granted, otherwise seconds until the next slot, or None when it is not next
+        """
+        now = time.monotonic()
+        if self.heap[0] is not entry:
+            return None
+
+        if now < self.next_at:
+            return self.next_at - now
+
+        heapq.heappop(self.heap)
+        self.next_at = now + self.interval
+        self.virtual_time = entry[1]
+
+        return 0
+
+    def _discard(self, entry):
+        # the caller gave up (cancelled task, interrupted thread), it must not block the queue
+        if entry in self.heap:
+            self.heap.remove(entry)
+            heapq.heapify(self.heap)
+
+    @staticmethod
+    def _observe(entry, enqueued_at):
+        waited = time.monotonic() - enqueued_at
+        priority = PRIORITY_NAMES[entry[0]]
+        metrics.observe('request_queue_wait_seconds', waited, priority=priority)
+        metrics.inc('requests_scheduled', priority=priority)
+        lokbot.tracing.add('limiter_wait_seconds', waited)
+
+
+class RequestScheduler(_RequestQueue):
+    """
+    `_RequestQueue` for the threads of a `LokBotApi`
+    """
+
+    def __init__(self, rate=RATE, weights=None):
+        super().__init__(rate, weights)
+        self.cond = threading.Condition()
+
+    def acquire(self, api_path, job=None):
+        """
+        block until the request to `api_path` may be sent
+        :return:
+        """
+        enqueued_at = time.monotonic()
+
+        with self.cond:
+            entry = self._push(api_path, current_job.get() if job is None else job)
+            metrics.gauge('request_queue_depth', len(self.heap))
+
+            try:
+                while True:
+                    wait = self._grant(entry)
+                    if wait == 0:
+                        break
+
+                    self.cond.wait(wait)
+            except BaseException:
+                self._discard(entry)
+                raise
+            finally:
+                # the next caller is the head now
+                self.cond.notify_all()
+
+        self._observe(entry, enqueued_at)
+
+
+class AsyncRequestScheduler(_RequestQueue):
+    """
+    `_RequestQueue` for the coroutines of an `AsyncLokBotApi`, created on its event loop
+    """
+
+    def __init__(self, rate=RATE, weights=None):
+        super().__init__(rate, weights)
+        self.cond = asyncio.Condition()
+
+    async def acquire(self, api_path, job=None):
+        enqueued_at = time.monotonic()
+
+        async with self.cond:
+            entry = self._push(api_path, current_job.get() if job is None else job)
+            metrics.gauge('request_queue_depth', len(self.heap))
+
+            try:
+                while True:
+                    wait = self._grant(entry)
+                    if wait == 0:
+                        break
+
+                    try:
+                        await asyncio.wait_for(self.cond.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                self._discard(entry)
+                raise
+            finally:
+                self.cond.notify_all()
+
+        self._observe(entry, enqueued_at)
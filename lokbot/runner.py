@@ -0,0 +1,103 @@
+import threading
+
+import httpx
+
+import lokbot.util
+from lokbot import logger, config
+from lokbot.app import create_farmer, start_farmer
+from lokbot.scheduler import Scheduler
+
+
+class MultiAccountRunner:
+    """
+    Hosts many `LokFarmer` in one process.
+
+    Accounts share the scheduler worker pool, the HTTP/2 connection pool, the asset tables of `lokbot.enum` and the
+    devrank of each world, while every `LokFarmer` keeps its own state, rate limits and websockets.
+    """
+
+    def __init__(self, main_config=None, workers=None):
+        self.main_config = main_config if main_config is not None else config.get('main')
+        if workers is None:
+            workers = self.main_config.get('runner', {}).get('workers', 8)
+
+        self.scheduler = Scheduler(workers, name='runner', lanes=self.main_config.get('runner', {}).get('lanes'))
+        self.transport = httpx.HTTPTransport(http2=True)
+        self.farmers = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, _id):
+        with self.lock:
+            return _id in self.farmers
+
+    def add(self, token, captcha_solver_config=None):
+        """
+        login and start farming an account, blocks until the account is logged in
+        :return: account id
+        """
+        _id = lokbot.util.decode_jwt(token).get('_id')
+
+        with self.lock:
+            if _id in self.farmers:
+                raise ValueError(f'account {_id} is already running')
+
+            # reserved while logging in
+            self.farmers[_id] = None
+
+        scheduler = self.scheduler.namespace(_id)
+        farmer = None
+        try:
+            farmer = create_farmer(token, captcha_solver_config or {}, scheduler, self.transport)
+            start_farmer(farmer, self.main_config)
+        except Exception:
+            scheduler.cancel_all()
+            if farmer is not None:
+                farmer.stop()
+
+            with self.lock:
+                del self.farmers[_id]
+
+            raise
+
+        with self.lock:
+            self.farmers[_id] = farmer
+
+        logger.info(f'runner: account {_id} added, {len(self.farmers)} accounts running')
+
+        return _id
+
+    def remove(self, _id):
+        with self.lock:
+            farmer = self.farmers.get(_id)
+            if farmer is None:
+                # unknown, or still logging in
+                return False
+
+            del self.farmers[_id]
+
+        farmer.scheduler.cancel_all()
+        farmer.stop()
+
+        logger.info(f'runner: account {_id} removed, {len(self.farmers)} accounts running')
+
+        return True
+
+    def status(self):
+        with self.lock:
+            farmers = dict(self.farmers)
+
+        return {
+            _id: {
+                'logged_in': farmer is not None,
+                'jobs': farmer.scheduler.jobs() if farmer is not None else [],
+            } for _id, farmer in farmers.items()
+        }
+
+    def stop(self):
+        with self.lock:
+            account_ids = list(self.farmers)
+
+        for _id in account_ids:
+            self.remove(_id)
+
+        self.scheduler.stop()
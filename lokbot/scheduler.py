@@ -0,0 +1,330 @@
+import contextvars
+import heapq
+import itertools
+import queue
+import random
+import threading
+import time
+
+import lokbot.profiling
+import lokbot.request_scheduler
+import lokbot.tracing
+from lokbot import logger
+
+JOB_STATE_PENDING = 'pending'  # waiting for its deadline
+JOB_STATE_PARKED = 'parked'  # waiting for `wakeup()` (or its timeout)
+JOB_STATE_READY = 'ready'  # handed to the worker pool
+JOB_STATE_RUNNING = 'running'
+
+LANE_DEFAULT = 'default'
+LANE_BLOCKING = 'blocking'  # jobs holding a worker for seconds: field scans, speedup and mail sleeps
+LANE_EVENTS = 'events'  # socket event handlers, see `lokbot.dispatcher.EventDispatcher`
+
+LANES = {LANE_BLOCKING: 2, LANE_EVENTS: 1}  # lane -> workers, besides the `workers` of `LANE_DEFAULT`
+
+
+class Job:
+    def __init__(self, name, func, args, kwargs, lane=LANE_DEFAULT, account=''):
+        self.name = name
+        self.account = account  # of the `SchedulerNamespace` it was scheduled through
+        self.lane = lane
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.state = JOB_STATE_PENDING
+        self.next_run = None
+        self.armed_at = None  # last time it was scheduled, parked or woken up
+        self.interval = None  # (start, end) seconds for recurring jobs
+        self.last_run = None
+        self.continuation = None  # (state, deadline) re-armed while running
+        self.cancelled = False
+        self.seq = 0
+
+    def __repr__(self):
+        return f'<Job {self.name} {self.state} next_run={self.next_run}>'
+
+
+class Scheduler:
+    """
+    One deadline heap feeding a fixed pool of worker threads.
+
+    Job continuations (`call_later`, `park`) replace the self re-arming `threading.Thread`/`threading.Timer`
+    pattern, so the number of threads per account stays constant.
+    There is at most one job per name; scheduling a name again replaces its pending continuation.
+
+    Every lane has its own workers, so the jobs of `LANE_BLOCKING` can not hold up the socket events
+    of `LANE_EVENTS` or the other jobs.
+    """
+
+    def __init__(self, workers=4, name='scheduler', lanes=None):
+        self.name = name
+        self._jobs = {}
+        self._heap = []
+        self._latched = set()
+        self._lanes = {}  # {job name: lane}, see `set_lane`
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+
+        lanes = {**LANES, **(lanes or {}), LANE_DEFAULT: workers}
+        self._workers = {lane: count for lane, count in lanes.items() if count}  # {lane: workers}
+        self._ready = {lane: queue.Queue() for lane in self._workers}
+
+        self._threads = [threading.Thread(target=self._timer_loop, name=f'{name}-timer', daemon=True)]
+        self._threads += [
+            threading.Thread(target=self._worker_loop, args=(lane,), name=f'{name}-{lane}-{i}', daemon=True)
+            for lane, count in self._workers.items() for i in range(count)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _lane(self, name):
+        lane = self._lanes.get(name, LANE_DEFAULT)
+        # a lane without workers runs on the default one
+        return lane if lane in self._ready else LANE_DEFAULT
+
+    def _push(self, job, deadline):
+        job.seq = next(self._seq)
+        job.next_run = deadline
+        job.armed_at = time.time()
+        if deadline is not None:
+            heapq.heappush(self._heap, (deadline, job.seq, job.name))
+        self._cond.notify()
+
+    def _arm(self, name, func, args, kwargs, state, deadline, interval=None, account=''):
+        with self._cond:
+            job = self._jobs.get(name)
+            if job is None:
+                job = Job(name, func, args, kwargs, self._lane(name), account)
+                self._jobs[name] = job
+            else:
+                job.func, job.args, job.kwargs = func, args, kwargs
+
+            job.interval = interval
+            job.cancelled = False
+
+            if job.state in (JOB_STATE_RUNNING, JOB_STATE_READY):
+                # re-armed from inside the job itself, takes effect once the current run returns
+                job.continuation = (state, deadline)
+                return job
+
+            job.state = state
+            self._push(job, deadline)
+            return job
+
+    def submit(self, name, func, *args, account='', **kwargs):
+        """
+        run `func` on the pool as soon as possible, unless a job with the same name is already scheduled
+        :return:
+        """
+        with self._cond:
+            if name in self._jobs:
+                return self._jobs[name]
+
+        return self._arm(name, func, args, kwargs, JOB_STATE_PENDING, time.time(), account=account)
+
+    def call_later(self, name, delay, func, *args, account='', **kwargs):
+        return self._arm(name, func, args, kwargs, JOB_STATE_PENDING, time.time() + delay, account=account)
+
+    def park(self, name, func, *args, timeout=None, account='', **kwargs):
+        """
+        run `func` once `wakeup(name)` is called, or after `timeout` seconds
+        a wakeup that arrived before parking is latched, like `threading.Event.set()`
+        :return:
+        """
+        with self._cond:
+            if name in self._latched:
+                self._latched.discard(name)
+                return self._arm(name, func, args, kwargs, JOB_STATE_PENDING, time.time(), account=account)
+
+            deadline = None if timeout is None else time.time() + timeout
+
+            return self._arm(name, func, args, kwargs, JOB_STATE_PARKED, deadline, account=account)
+
+    def every(self, name, start, end, func, *args, run_now=True, account='', **kwargs):
+        """
+        run `func` repeatedly, sleeping a random `start`~`end` seconds after each run
+        :return:
+        """
+        delay = 0 if run_now else random.uniform(start, end)
+
+        return self._arm(name, func, args, kwargs, JOB_STATE_PENDING, time.time() + delay, (start, end), account)
+
+    def set_lane(self, name, lane):
+        """
+        run the job `name` on the workers of `lane` from now on
+        :return:
+        """
+        with self._cond:
+            self._lanes[name] = lane
+
+            job = self._jobs.get(name)
+            if job is not None:
+                job.lane = self._lane(name)
+
+    def wakeup(self, name):
+        with self._cond:
+            job = self._jobs.get(name)
+            if job is None or job.state != JOB_STATE_PARKED:
+                self._latched.add(name)
+                return
+
+            job.state = JOB_STATE_PENDING
+            self._push(job, time.time())
+
+    def cancel(self, name):
+        with self._cond:
+            self._latched.discard(name)
+
+            job = self._jobs.get(name)
+            if job is None:
+                return
+
+            if job.state in (JOB_STATE_RUNNING, JOB_STATE_READY):
+                job.interval = None
+                job.continuation = None
+                job.cancelled = True
+                return
+
+            del self._jobs[name]
+
+    def jobs(self):
+        """
+        introspection of every known job and its next run time
+        :return:
+        """
+        with self._cond:
+            return [{
+                'name': job.name,
+                'state': job.state,
+                'next_run': job.next_run,
+                'armed_at': job.armed_at,
+                'last_run': job.last_run,
+                'interval': job.interval,
+            } for job in sorted(self._jobs.values(), key=lambda x: (x.next_run is None, x.next_run or 0))]
+
+    def next_run_times(self):
+        with self._cond:
+            return {name: job.next_run for name, job in self._jobs.items()}
+
+    def namespace(self, prefix):
+        return SchedulerNamespace(self, prefix)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+        for lane, count in self._workers.items():
+            for _ in range(count):
+                self._ready[lane].put(None)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _timer_loop(self):
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    _, seq, name = heapq.heappop(self._heap)
+                    job = self._jobs.get(name)
+                    if job is None or job.seq != seq:
+                        # superseded entry
+                        continue
+
+                    job.state = JOB_STATE_READY
+                    self._ready[job.lane].put(job)
+
+                timeout = self._heap[0][0] - now if self._heap else None
+                self._cond.wait(timeout)
+
+    def _worker_loop(self, lane):
+        while True:
+            job = self._ready[lane].get()
+            if job is None:
+                return
+
+            with self._cond:
+                if job.cancelled:
+                    del self._jobs[job.name]
+                    continue
+
+                job.state = JOB_STATE_RUNNING
+                job.last_run = time.time()
+                job.next_run = None
+
+            # every run starts from a clean context, what a job sets (its name, its reaction) stays with it
+            contextvars.Context().run(self._run, job)
+
+            with self._cond:
+                # armed while READY or RUNNING
+                continuation, job.continuation = job.continuation, None
+                if job.cancelled:
+                    del self._jobs[job.name]
+                elif continuation:
+                    job.state = continuation[0]
+                    self._push(job, continuation[1])
+                elif job.interval:
+                    job.state = JOB_STATE_PENDING
+                    self._push(job, time.time() + random.uniform(*job.interval))
+                else:
+                    del self._jobs[job.name]
+
+    def _run(self, job):
+        # job names may contain ':' themselves, e.g. `sock:/task/update` of an `EventDispatcher`
+        name = job.name[len(job.account) + 1:] if job.account else job.name
+        lokbot.request_scheduler.set_job(name)
+        try:
+            with lokbot.tracing.span(name, lokbot.tracing.KIND_JOB, account=job.account):
+                lokbot.profiling.call(job.name, job.func, *job.args, **job.kwargs)
+        except Exception as e:
+            logger.exception(f'{self.name}: job {job.name} failed: {e}')
+
+
+class SchedulerNamespace:
+    """
+    View of a `Scheduler` with prefixed job names, several accounts can share one worker pool through it
+    """
+
+    def __init__(self, scheduler, prefix):
+        self.scheduler = scheduler
+        self.account = prefix
+        self.prefix = f'{prefix}:'
+
+    def submit(self, name, func, *args, **kwargs):
+        return self.scheduler.submit(self.prefix + name, func, *args, account=self.account, **kwargs)
+
+    def call_later(self, name, delay, func, *args, **kwargs):
+        return self.scheduler.call_later(self.prefix + name, delay, func, *args, account=self.account, **kwargs)
+
+    def park(self, name, func, *args, timeout=None, **kwargs):
+        return self.scheduler.park(self.prefix + name, func, *args, timeout=timeout, account=self.account, **kwargs)
+
+    def every(self, name, start, end, func, *args, run_now=True, **kwargs):
+        return self.scheduler.every(
+            self.prefix + name, start, end, func, *args, run_now=run_now, account=self.account, **kwargs
+        )
+
+    def set_lane(self, name, lane):
+        return self.scheduler.set_lane(self.prefix + name, lane)
+
+    def wakeup(self, name):
+        return self.scheduler.wakeup(self.prefix + name)
+
+    def cancel(self, name):
+        return self.scheduler.cancel(self.prefix + name)
+
+    def cancel_all(self):
+        for job in self.jobs():
+            self.cancel(job.get('name'))
+
+    def jobs(self):
+        return [
+            dict(job, name=job.get('name')[len(self.prefix):])
+            for job in self.scheduler.jobs() if job.get('name').startswith(self.prefix)
+        ]
+
+    def next_run_times(self):
+        return {job.get('name'): job.get('next_run') for job in self.jobs()}
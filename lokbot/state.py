@@ -0,0 +1,268 @@
+import array
+import threading
+
+from lokbot.enum import BUILDING_STATE_NORMAL, DRAGO_LAIR_STATUS_STANDBY
+
+RESOURCE_COUNT = 4  # [food, lumber, stone, gold]
+
+
+class Building:
+    __slots__ = ('position', 'code', 'level', 'state', 'param')
+
+    def __init__(self, position, code, level=0, state=BUILDING_STATE_NORMAL, param=None):
+        self.position = position
+        self.code = code
+        self.level = level
+        self.state = state
+        self.param = param if param is not None else {}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data.get('position'), data.get('code'), data.get('level', 0), data.get('state', BUILDING_STATE_NORMAL),
+            data.get('param')
+        )
+
+    def to_dict(self):
+        """
+        request body format of `kingdom/building/*`
+        :return:
+        """
+        return {'position': self.position, 'code': self.code, 'level': self.level, 'state': self.state}
+
+    def __repr__(self):
+        return f'<Building {self.code}@{self.position} lv{self.level} state={self.state}>'
+
+
+class Task:
+    __slots__ = ('_id', 'code', 'status', 'expected_ended', 'param')
+
+    def __init__(self, _id, code, status, expected_ended=None, param=None):
+        self._id = _id
+        self.code = code
+        self.status = status
+        self.expected_ended = expected_ended
+        self.param = param if param is not None else {}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('_id'), data.get('code'), data.get('status'), data.get('expectedEnded'), data.get('param'))
+
+    def __repr__(self):
+        return f'<Task {self.code} status={self.status} expected_ended={self.expected_ended}>'
+
+
+class Troop:
+    """
+    a march of the field queue
+    """
+    __slots__ = ('_id', 'code', 'status', 'end_time')
+
+    def __init__(self, _id, code, status, end_time=None):
+        self._id = _id
+        self.code = code
+        self.status = status
+        self.end_time = end_time
+
+    @classmethod
+    def from_dict(cls, data):
+        end_time = data.get('endTime', data.get('expectedEnded'))
+
+        return cls(data.get('_id'), data.get('code'), data.get('status'), end_time)
+
+    def __repr__(self):
+        return f'<Troop {self._id} status={self.status} end_time={self.end_time}>'
+
+
+class Drago:
+    __slots__ = ('_id', 'lair_status')
+
+    def __init__(self, _id, lair_status):
+        self._id = _id
+        self.lair_status = lair_status
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('_id'), data.get('lair', {}).get('status'))
+
+    def __repr__(self):
+        return f'<Drago {self._id} lair_status={self.lair_status}>'
+
+
+class KingdomSnapshot:
+    """
+    Consistent, read-only view of a `KingdomState` at one version.
+    Records are never mutated by the store (updates replace them), so a snapshot only copies the containers.
+    """
+    __slots__ = ('version', 'buildings', 'buildings_by_code', 'resources', 'tasks', 'troops', 'dragos')
+
+    def __init__(self, version, buildings, buildings_by_code, resources, tasks, troops, dragos):
+        self.version = version
+        self.buildings = buildings  # {position: Building}
+        self.buildings_by_code = buildings_by_code  # {code: (Building, ...)}
+        self.resources = resources  # (food, lumber, stone, gold)
+        self.tasks = tasks
+        self.troops = troops
+        self.dragos = dragos
+
+    def buildings_of(self, code):
+        return self.buildings_by_code.get(code, ())
+
+    def building(self, code):
+        """
+        the first building with `code`, for the unique ones like castle or academy
+        :return:
+        """
+        buildings = self.buildings_of(code)
+
+        return buildings[0] if buildings else None
+
+    def tasks_of(self, code):
+        return [task for task in self.tasks if task.code == code]
+
+    def standby_dragos(self):
+        return [drago for drago in self.dragos if drago.lair_status == DRAGO_LAIR_STATUS_STANDBY]
+
+
+class KingdomState:
+    """
+    Thread-safe store of the kingdom, fed by `kingdom/enter`, request callbacks and `sock` events.
+    Every update is O(1) (or O(n) of the replaced collection) and bumps `version`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+
+        self._buildings = {}
+        self._buildings_by_code = {}
+        self._resources = array.array('q', [0] * RESOURCE_COUNT)
+        self._tasks = {}
+        self._troops = {}
+        self._dragos = {}
+        self._snapshot = None
+
+    def load_kingdom(self, kingdom):
+        """
+        replace everything with the `kingdom` of a `kingdom/enter` response
+        :return:
+        """
+        with self.lock:
+            self._buildings.clear()
+            self._buildings_by_code.clear()
+            for building in kingdom.get('buildings', []):
+                self._put_building(Building.from_dict(building))
+
+            self._set_resources(kingdom.get('resources'))
+            self.version += 1
+
+    def _put_building(self, building):
+        old = self._buildings.get(building.position)
+        if old is not None and old.code != building.code:
+            del self._buildings_by_code[old.code][old.position]
+
+        self._buildings[building.position] = building
+        self._buildings_by_code.setdefault(building.code, {})[building.position] = building
+
+    def update_building(self, data):
+        """
+        `/building/update` event or `newBuilding`/`updateBuilding` of a response
+        :return: the new record
+        """
+        building = Building.from_dict(data)
+
+        with self.lock:
+            self._put_building(building)
+            self.version += 1
+
+        return building
+
+    def _set_resources(self, resources):
+        if resources and len(resources) == RESOURCE_COUNT:
+            self._resources[:] = array.array('q', (int(value) for value in resources))
+
+    def update_resources(self, resources):
+        with self.lock:
+            self._set_resources(resources)
+            self.version += 1
+
+    def update_resource(self, index, value):
+        with self.lock:
+            self._resources[index] = int(value)
+            self.version += 1
+
+    def resource(self, index):
+        with self.lock:
+            return self._resources[index]
+
+    def set_tasks(self, tasks):
+        """
+        replace the kingdom tasks with a `kingdom/task/all` response
+        :return:
+        """
+        with self.lock:
+            self._tasks = {task.get('_id') or task.get('code'): Task.from_dict(task) for task in tasks}
+            self.version += 1
+
+    def update_task(self, data):
+        """
+        `/task/update` event or `newTask` of a response
+        :return: the new record
+        """
+        task = Task.from_dict(data)
+
+        with self.lock:
+            self._tasks[data.get('_id') or data.get('code')] = task
+            self.version += 1
+
+        return task
+
+    def remove_tasks(self, code):
+        """
+        drop the tasks of `code` that left their queue (finished hammers, claimed research or training)
+        :return:
+        """
+        with self.lock:
+            self._tasks = {key: task for key, task in self._tasks.items() if task.code != code}
+            self.version += 1
+
+    def set_troops(self, troops):
+        with self.lock:
+            self._troops = {troop.get('_id'): Troop.from_dict(troop) for troop in troops}
+            self.version += 1
+
+    def add_troop(self, data):
+        troop = Troop.from_dict(data)
+
+        with self.lock:
+            self._troops[troop._id] = troop
+            self.version += 1
+
+        return troop
+
+    def set_dragos(self, dragos):
+        with self.lock:
+            self._dragos = {drago.get('_id'): Drago.from_dict(drago) for drago in dragos}
+            self.version += 1
+
+    def snapshot(self):
+        """
+        cached per version, so readers between two updates share the same snapshot
+        :return: KingdomSnapshot
+        """
+        with self.lock:
+            if self._snapshot is None or self._snapshot.version != self.version:
+                buildings_by_code = {
+                    code: tuple(buildings.values()) for code, buildings in self._buildings_by_code.items() if buildings
+                }
+                self._snapshot = KingdomSnapshot(
+                    self.version,
+                    dict(self._buildings),
+                    buildings_by_code,
+                    tuple(self._resources),
+                    tuple(self._tasks.values()),
+                    tuple(self._troops.values()),
+                    tuple(self._dragos.values()),
+                )
+
+            return self._snapshot
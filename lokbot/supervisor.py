@@ -0,0 +1,580 @@
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+
+import fire
+import psutil
+
+import lokbot.util
+from lokbot import logger, config, metrics, LOG_SUFFIX_ENV
+from lokbot.exceptions import ApiException
+
+VIRTUAL_NODES = 64  # points per worker on the hash ring at full weight
+MIN_WEIGHT = 0.125
+RESTART_WINDOW = 300
+RESTART_LIMIT = 3  # restarts within `RESTART_WINDOW` before a worker is taken out of the ring
+WORKER_COOLDOWN = 600
+LOAD_CHECKS = 3  # consecutive checks before the weight of a worker is changed
+
+# the environment of the supervisor is changed while a worker starts, see `Worker.spawn`
+_spawn_lock = threading.Lock()
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+
+def _portable_exception(e):
+    # exceptions of third-party libraries do not always survive pickling
+    if isinstance(e, (ApiException, ValueError)):
+        return e
+
+    return RuntimeError(f'{type(e).__name__}: {e}')
+
+
+class HashRing:
+    """
+    Consistent hashing of account ids onto worker indexes.
+    Lowering the weight of a worker only moves accounts away from it, the others keep theirs.
+    """
+
+    def __init__(self):
+        self.weights = {}
+        self._hashes = []
+        self._nodes = []
+
+    def set_weight(self, node, weight):
+        if weight <= 0:
+            self.weights.pop(node, None)
+        else:
+            self.weights[node] = weight
+
+        points = sorted(
+            (_hash(f'{node}-{i}'), node)
+            for node, weight in self.weights.items()
+            for i in range(max(1, int(VIRTUAL_NODES * weight)))
+        )
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get(self, key):
+        if not self._nodes:
+            return None
+
+        return self._nodes[bisect.bisect(self._hashes, _hash(key)) % len(self._nodes)]
+
+
+def _worker_main(index, conn, main_config):
+    """
+    entrypoint of a worker process, serves the requests of `Worker.call` with a `MultiAccountRunner`
+    """
+    from lokbot.runner import MultiAccountRunner
+
+    runner = MultiAccountRunner(main_config)
+    handlers = {
+        'add': runner.add,
+        'remove': runner.remove,
+        'status': runner.status,
+        'metrics': metrics.snapshot,
+    }
+    send_lock = threading.Lock()
+
+    def handle(request_id, cmd, args):
+        try:
+            response = request_id, True, handlers[cmd](*args)
+        except Exception as e:
+            response = request_id, False, _portable_exception(e)
+
+        with send_lock:
+            conn.send(response)
+
+    logger.info(f'supervisor: worker {index} started, pid {os.getpid()}')
+
+    while True:
+        try:
+            request_id, cmd, args = conn.recv()
+        except (EOFError, OSError):
+            # supervisor is gone
+            break
+
+        if cmd == 'stop':
+            break
+
+        # logging in blocks for a while, do not hold up the other requests
+        threading.Thread(target=handle, args=(request_id, cmd, args), daemon=True).start()
+
+    runner.stop()
+
+
+class Worker:
+    """
+    Handle of one worker process, owned by `Supervisor`
+    """
+
+    def __init__(self, index, main_config, context):
+        self.index = index
+        self.main_config = main_config
+        self.context = context
+        self.process = None
+        self.conn = None
+        self.ps = None
+        self.restarts = collections.deque()
+        self.cooldown_until = 0
+        self.overloaded_checks = 0
+        self.idle_checks = 0
+
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self._futures = {}
+
+    def spawn(self):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=_worker_main,
+            args=(self.index, child_conn, self.main_config),
+            name=f'lokbot-worker-{self.index}',
+            daemon=True
+        )
+
+        # the worker inherits the environment, its log files are its own
+        with _spawn_lock:
+            os.environ[LOG_SUFFIX_ENV] = f'worker-{self.index}'
+            try:
+                process.start()
+            finally:
+                del os.environ[LOG_SUFFIX_ENV]
+
+        child_conn.close()
+
+        with self._lock:
+            self.process, self.conn = process, parent_conn
+            self.ps = psutil.Process(process.pid)
+
+        threading.Thread(target=self._read_loop, args=(parent_conn,), daemon=True).start()
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def _read_loop(self, conn):
+        while True:
+            try:
+                request_id, ok, result = conn.recv()
+            except (EOFError, OSError):
+                break
+
+            with self._lock:
+                _, future = self._futures.pop(request_id, (None, None))
+
+            if future is None:
+                continue
+
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+        # fail whatever was still waiting on this process
+        with self._lock:
+            orphans = [rid for rid, (c, _) in self._futures.items() if c is conn]
+            futures = [self._futures.pop(rid)[1] for rid in orphans]
+
+        for future in futures:
+            future.set_exception(ConnectionError(f'worker {self.index} exited'))
+
+    def call(self, cmd, *args, timeout=None):
+        future = concurrent.futures.Future()
+
+        with self._lock:
+            if self.conn is None:
+                raise ConnectionError(f'worker {self.index} is not running')
+
+            request_id = next(self._request_ids)
+            self._futures[request_id] = (self.conn, future)
+            try:
+                self.conn.send((request_id, cmd, args))
+            except OSError as e:
+                del self._futures[request_id]
+                raise ConnectionError(f'worker {self.index} is not reachable') from e
+
+        return future.result(timeout)
+
+    def resource_usage(self):
+        try:
+            return {'cpu_percent': self.ps.cpu_percent(), 'rss': self.ps.memory_info().rss}
+        except (AttributeError, psutil.Error):
+            return {'cpu_percent': 0, 'rss': 0}
+
+    def stop(self):
+        with self._lock:
+            conn, process = self.conn, self.process
+            self.conn = None
+
+        if process is None:
+            return
+
+        try:
+            conn.send((None, 'stop', ()))
+        except OSError:
+            pass
+
+        process.join(5)
+        if process.is_alive():
+            process.terminate()
+
+
+class Supervisor:
+    """
+    Shards accounts across worker processes, each running a `lokbot.runner.MultiAccountRunner`.
+
+    Accounts are assigned with consistent hashing, so restarting or re-weighting one worker only moves its own
+    accounts. A dead worker is restarted and gets its accounts back, a worker that keeps dying or stays above
+    `overload_cpu_percent` hands (part of) its accounts over to the others.
+    """
+
+    def __init__(self, main_config=None, workers=None):
+        self.main_config = main_config if main_config is not None else config.get('main')
+
+        supervisor_config = self.main_config.get('supervisor', {})
+        workers = workers or supervisor_config.get('workers') or os.cpu_count() or 1
+        self.check_interval = supervisor_config.get('check_interval', 10)
+        self.overload_cpu_percent = supervisor_config.get('overload_cpu_percent', 90)
+
+        # fork is not safe with the threads of this process
+        context = multiprocessing.get_context('spawn')
+        self.workers = [Worker(i, self.main_config, context) for i in range(workers)]
+        self.ring = HashRing()
+        # account id -> {'token', 'captcha_solver_config', 'worker': index or None when not placed, 'busy'}
+        self.accounts = {}
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.executor = concurrent.futures.ThreadPoolExecutor(4, thread_name_prefix='supervisor-move')
+
+    def start(self):
+        for worker in self.workers:
+            worker.spawn()
+            self.ring.set_weight(worker.index, 1)
+
+        threading.Thread(target=self._monitor_loop, name='supervisor-monitor', daemon=True).start()
+
+        return self
+
+    def __contains__(self, _id):
+        with self.lock:
+            return _id in self.accounts
+
+    def add(self, token, captcha_solver_config=None):
+        """
+        login and start farming an account on its worker, blocks until the account is logged in
+        :return: account id
+        """
+        _id = lokbot.util.decode_jwt(token).get('_id')
+
+        with self.lock:
+            if _id in self.accounts:
+                raise ValueError(f'account {_id} is already running')
+
+            index = self.ring.get(_id)
+            if index is None:
+                raise RuntimeError('no worker available')
+
+            account = {'token': token, 'captcha_solver_config': captcha_solver_config, 'worker': None, 'busy': True}
+            self.accounts[_id] = account
+
+        try:
+            self.workers[index].call('add', token, captcha_solver_config)
+        except Exception:
+            with self.lock:
+                del self.accounts[_id]
+
+            raise
+
+        with self.lock:
+            account.update(worker=index, busy=False)
+
+        logger.info(f'supervisor: account {_id} added to worker {index}')
+
+        return _id
+
+    def remove(self, _id):
+        with self.lock:
+            account = self.accounts.get(_id)
+            if account is None or account.get('busy'):
+                # unknown, or still logging in
+                return False
+
+            del self.accounts[_id]
+
+        if account.get('worker') is not None:
+            try:
+                self.workers[account.get('worker')].call('remove', _id, timeout=30)
+            except ConnectionError:
+                pass
+
+        logger.info(f'supervisor: account {_id} removed')
+
+        return True
+
+    def status(self):
+        with self.lock:
+            return {
+                _id: {'worker': account.get('worker'), 'busy': account.get('busy')}
+                for _id, account in self.accounts.items()
+            }
+
+    def stats(self):
+        with self.lock:
+            counts = collections.Counter(account.get('worker') for account in self.accounts.values())
+            weights = dict(self.ring.weights)
+
+        return [{
+            'worker': worker.index,
+            'pid': worker.process.pid if worker.process else None,
+            'alive': worker.is_alive(),
+            'weight': weights.get(worker.index, 0),
+            'accounts': counts[worker.index],
+            **worker.resource_usage(),
+        } for worker in self.workers]
+
+    def metrics(self):
+        """
+        metrics of the supervisor and of every live worker
+        :return:
+        """
+        workers = {}
+        for worker in self.workers:
+            if not worker.is_alive():
+                continue
+
+            try:
+                workers[worker.index] = worker.call('metrics', timeout=5)
+            except (ConnectionError, concurrent.futures.TimeoutError):
+                pass
+
+        return {'supervisor': metrics.snapshot(), 'workers': workers}
+
+    def stop(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=False)
+
+        for worker in self.workers:
+            worker.stop()
+
+    def _monitor_loop(self):
+        while not self.stopped.wait(self.check_interval):
+            for worker in self.workers:
+                try:
+                    self._check(worker)
+                except Exception as e:
+                    logger.exception(f'supervisor: checking worker {worker.index} failed: {e}')
+
+            self._rebalance()
+
+    def _check(self, worker):
+        now = time.time()
+
+        with self.lock:
+            if not worker.is_alive():
+                self._handle_dead_worker(worker, now)
+                return
+
+        usage = worker.resource_usage()
+        metrics.gauge('supervisor_worker_cpu_percent', usage.get('cpu_percent'), worker=worker.index)
+        metrics.gauge('supervisor_worker_rss_bytes', usage.get('rss'), worker=worker.index)
+
+        with self.lock:
+            weight = self.ring.weights.get(worker.index, 0)
+            if usage.get('cpu_percent') > self.overload_cpu_percent:
+                worker.overloaded_checks += 1
+                worker.idle_checks = 0
+            elif usage.get('cpu_percent') < self.overload_cpu_percent / 2:
+                worker.idle_checks += 1
+                worker.overloaded_checks = 0
+            else:
+                worker.overloaded_checks = worker.idle_checks = 0
+
+            if worker.overloaded_checks >= LOAD_CHECKS and weight > MIN_WEIGHT and len(self.ring.weights) > 1:
+                logger.warning(f'supervisor: worker {worker.index} is overloaded ({usage}), shedding accounts')
+                self.ring.set_weight(worker.index, weight / 2)
+                worker.overloaded_checks = 0
+            elif worker.idle_checks >= LOAD_CHECKS and 0 < weight < 1:
+                self.ring.set_weight(worker.index, min(1, weight * 2))
+                worker.idle_checks = 0
+
+            metrics.gauge('supervisor_worker_weight', self.ring.weights.get(worker.index, 0), worker=worker.index)
+
+    def _handle_dead_worker(self, worker, now):
+        if worker.index in self.ring.weights:
+            # its accounts have to be placed again, on the restarted process or elsewhere
+            for account in self.accounts.values():
+                if account.get('worker') == worker.index:
+                    account['worker'] = None
+
+        if now < worker.cooldown_until:
+            return
+
+        while worker.restarts and worker.restarts[0] < now - RESTART_WINDOW:
+            worker.restarts.popleft()
+
+        if len(worker.restarts) >= RESTART_LIMIT and worker.index in self.ring.weights:
+            logger.error(f'supervisor: worker {worker.index} keeps dying, moving its accounts for {WORKER_COOLDOWN}s')
+            worker.cooldown_until = now + WORKER_COOLDOWN
+            worker.restarts.clear()
+            self.ring.set_weight(worker.index, 0)
+            return
+
+        logger.warning(f'supervisor: worker {worker.index} exited, restarting')
+        metrics.inc('supervisor_worker_restarts', worker=worker.index)
+        worker.restarts.append(now)
+        worker.spawn()
+        self.ring.set_weight(worker.index, 1)
+
+    def _rebalance(self):
+        moves = []
+        with self.lock:
+            for _id, account in self.accounts.items():
+                target = self.ring.get(_id)
+                if account.get('busy') or target is None or account.get('worker') == target:
+                    continue
+
+                account['busy'] = True
+                moves.append((_id, account, target))
+
+        for _id, account, target in moves:
+            self.executor.submit(self._move, _id, account, target)
+
+    def _move(self, _id, account, target):
+        source = account.get('worker')
+        try:
+            if source is not None:
+                try:
+                    self.workers[source].call('remove', _id, timeout=30)
+                except ConnectionError:
+                    pass
+
+            self.workers[target].call('add', account.get('token'), account.get('captcha_solver_config'))
+        except Exception as e:
+            logger.error(f'supervisor: moving account {_id} from worker {source} to {target} failed: {e}')
+            with self.lock:
+                account.update(worker=None, busy=False)
+
+            return
+
+        metrics.inc('supervisor_account_moves')
+        logger.info(f'supervisor: account {_id} moved from worker {source} to {target}')
+
+        with self.lock:
+            account.update(worker=target, busy=False)
+
+    def serve(self, address=None, authkey=None):
+        """
+        accept `SupervisorClient` connections on a local socket
+        :return: the address listened on
+        """
+        listener = multiprocessing.connection.Listener(address, authkey=authkey)
+        threading.Thread(target=self._accept_loop, args=(listener,), name='supervisor-ipc', daemon=True).start()
+
+        return listener.address
+
+    def _accept_loop(self, listener):
+        while not self.stopped.is_set():
+            try:
+                conn = listener.accept()
+            except multiprocessing.AuthenticationError:
+                logger.warning('supervisor: rejected a connection with a wrong authkey')
+                continue
+
+            threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def _serve_connection(self, conn):
+        handlers = {
+            'add': self.add,
+            'remove': self.remove,
+            'contains': self.__contains__,
+            'status': self.status,
+            'stats': self.stats,
+            'metrics': self.metrics,
+        }
+
+        with conn:
+            while True:
+                try:
+                    cmd, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+
+                try:
+                    response = True, handlers[cmd](*args)
+                except Exception as e:
+                    response = False, _portable_exception(e)
+
+                conn.send(response)
+
+
+class SupervisorClient:
+    """
+    Control a `Supervisor` over its local IPC socket, has the same interface as `MultiAccountRunner`
+    """
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+
+    def call(self, cmd, *args):
+        # one connection per call, so a slow login never blocks the other callers
+        with multiprocessing.connection.Client(self.address, authkey=self.authkey) as conn:
+            conn.send((cmd, args))
+            ok, result = conn.recv()
+
+        if not ok:
+            raise result
+
+        return result
+
+    def __contains__(self, _id):
+        return self.call('contains', _id)
+
+    def add(self, token, captcha_solver_config=None):
+        return self.call('add', token, captcha_solver_config)
+
+    def remove(self, _id):
+        return self.call('remove', _id)
+
+    def status(self):
+        return self.call('status')
+
+    def stats(self):
+        return self.call('stats')
+
+    def metrics(self):
+        return self.call('metrics')
+
+
+def main(workers=None):
+    """
+    run a standalone supervisor, `LOKBOT_SUPERVISOR_AUTHKEY` is the shared secret of its clients
+    """
+    authkey = os.getenv('LOKBOT_SUPERVISOR_AUTHKEY')
+    if not authkey:
+        logger.error('No LOKBOT_SUPERVISOR_AUTHKEY found in environment variables.')
+        return
+
+    supervisor = Supervisor(workers=workers).start()
+    address = supervisor.serve(
+        tuple(config.get('main').get('supervisor', {}).get('address', ['127.0.0.1', 6543])), authkey.encode()
+    )
+    logger.info(f'supervisor: listening on {address}')
+
+    while True:
+        logger.info(f'supervisor: {supervisor.stats()}')
+        time.sleep(600)
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -0,0 +1,284 @@
+import asyncio
+import time
+
+import arrow
+
+from lokbot import logger, metrics
+from lokbot.enum import *
+from lokbot.reaction import Reactions
+
+DEADLINE_SLACK = 10  # seconds after `expectedEnded` before a task without its `/task/update` is looked up
+IDLE_TIMEOUT = 3600  # seconds a consumer waits when none of its tasks has a deadline ahead
+
+# task code -> (status of `/task/update` the consumers of its queue wait for, whether the task leaves the queue then)
+QUEUES = {
+    TASK_CODE_SILVER_HAMMER: (STATUS_FINISHED, True),
+    TASK_CODE_GOLD_HAMMER: (STATUS_FINISHED, True),
+    TASK_CODE_ACADEMY: (STATUS_CLAIMED, False),  # until `kingdom/task/claim`, see `discard`
+    TASK_CODE_CAMP: (STATUS_CLAIMED, False),
+}
+
+QUEUE_BUILDING = 'building'
+QUEUE_ACADEMY = 'academy'
+QUEUE_CAMP = 'camp'
+
+# task code -> queue of its consumer
+CONSUMER_QUEUES = {
+    TASK_CODE_SILVER_HAMMER: QUEUE_BUILDING,
+    TASK_CODE_GOLD_HAMMER: QUEUE_BUILDING,
+    TASK_CODE_ACADEMY: QUEUE_ACADEMY,
+    TASK_CODE_CAMP: QUEUE_CAMP,
+}
+
+QUEUE_NAMES = {
+    TASK_CODE_SILVER_HAMMER: 'silver_hammer',
+    TASK_CODE_GOLD_HAMMER: 'gold_hammer',
+    TASK_CODE_ACADEMY: 'academy',
+    TASK_CODE_CAMP: 'camp',
+}
+
+
+def get_deadline(task):
+    """
+    :return: timestamp after which the `/task/update` of `task` is overdue, or None
+    """
+    if task.expected_ended is None:
+        return None
+
+    return arrow.get(task.expected_ended).timestamp() + DEADLINE_SLACK
+
+
+class _TaskTracker:
+    """
+    The kingdom tasks of a `KingdomState` (hammers, academy, camp) and the consumers waiting for their queues.
+
+    `/task/update` events and the `newTask` of responses keep the tasks current, so `kingdom/task/all` is only
+    requested at start and when a task is past its `expectedEnded` without its update, a missed socket event.
+    Consumers wake on the update or at the deadline of their tasks, whichever comes first.
+    """
+
+    def __init__(self, state, account):
+        self.state = state
+        self.reactions = Reactions(account)
+        self.synced_at = None  # of the last `kingdom/task/all`
+        self.consumers = {}  # {name: task codes}
+        self.freed_at = {}  # {task code: when its queue became free}, for `task_queue_idle_seconds`
+
+    def _overdue(self, codes):
+        # whether a task should have ended since the last `kingdom/task/all` but its update never came
+        if self.synced_at is None:
+            return True
+
+        now = time.time()
+        for code in codes:
+            wakeup_status = QUEUES[code][0]
+            for task in self.state.snapshot().tasks_of(code):
+                deadline = get_deadline(task)
+                if task.status != wakeup_status and deadline is not None and self.synced_at < deadline <= now:
+                    logger.warning(f'task_tracker: no update of {task}, refreshing the tasks')
+                    metrics.inc('task_tracker_missed_updates', code=code)
+                    return True
+
+        return False
+
+    def _load(self, res):
+        self.state.set_tasks(res.get('kingdomTasks', []))
+        self.synced_at = time.time()
+
+        snapshot = self.state.snapshot()
+        for code in QUEUES:
+            if snapshot.tasks_of(code):
+                self._record_idle(code)
+            else:
+                self.freed_at.setdefault(code, self.synced_at)
+
+    def _record_idle(self, code):
+        """
+        account the time the queue of `code` was free to `task_queue_idle_seconds` of each day (UTC) it spans
+        :return:
+        """
+        started_at = self.freed_at.pop(code, None)
+        now = time.time()
+        while started_at is not None and started_at < now:
+            day = arrow.get(started_at).floor('day')
+            ended_at = min(day.shift(days=1).timestamp(), now)
+            metrics.inc(
+                'task_queue_idle_seconds', ended_at - started_at, queue=QUEUE_NAMES[code], day=day.format('YYYY-MM-DD')
+            )
+            started_at = ended_at
+
+    def _timeout(self, codes):
+        """
+        :return: seconds until the earliest deadline ahead of the tasks of `codes`
+        """
+        now = time.time()
+        deadlines = [
+            deadline for code in codes for task in self.state.snapshot().tasks_of(code)
+            if (deadline := get_deadline(task)) is not None and deadline > now
+        ]
+
+        return min(deadlines) - now if deadlines else IDLE_TIMEOUT
+
+    def _update(self, data):
+        """
+        :return: names of the consumers to wake
+        """
+        code = data.get('code')
+        if code not in QUEUES:
+            self.state.update_task(data)
+            return []
+
+        wakeup_status, leaves_queue = QUEUES[code]
+        if data.get('status') != wakeup_status:
+            self.state.update_task(data)
+            return []
+
+        self.freed_at.setdefault(code, time.time())
+        self.reactions.event(CONSUMER_QUEUES[code], '/task/update')
+
+        if leaves_queue:
+            self.state.remove_tasks(code)
+        else:
+            self.state.update_task(data)
+
+        return [name for name, codes in self.consumers.items() if code in codes]
+
+    def _resync(self, res):
+        """
+        :return: names of the consumers of the queues freed while the kingdom websocket was disconnected
+        """
+        before = self.state.snapshot()
+        self._load(res)
+        after = self.state.snapshot()
+
+        freed = set()
+        for code, (wakeup_status, _) in QUEUES.items():
+            waiting = [task for task in before.tasks_of(code) if task.status != wakeup_status]
+            if waiting and all(task.status == wakeup_status for task in after.tasks_of(code)):
+                freed.add(code)
+                self.freed_at.setdefault(code, time.time())
+                self.reactions.event(CONSUMER_QUEUES[code], 'resync')
+
+        return [name for name, codes in self.consumers.items() if freed.intersection(codes)]
+
+    def add(self, task):
+        """
+        `newTask` of a response starting a building, research or training
+        :return:
+        """
+        if task:
+            self.state.update_task(task)
+            if task.get('code') in QUEUES:
+                self._record_idle(task.get('code'))
+                self.reactions.acted(CONSUMER_QUEUES[task.get('code')])
+
+    def building_updated(self, data):
+        """
+        `/building/update` event, an upgrade that finished frees the building queue too
+        :return:
+        """
+        building = self.state.snapshot().buildings.get(data.get('position'))
+        if building is None or building.state == BUILDING_STATE_NORMAL:
+            return
+
+        if data.get('state') == BUILDING_STATE_NORMAL:
+            self.reactions.event(QUEUE_BUILDING, '/building/update')
+
+    def woke(self, code):
+        """
+        the consumer of the queue of `code` runs, see `lokbot.reaction.Reactions.woke`
+        :return:
+        """
+        self.reactions.woke(CONSUMER_QUEUES[code])
+
+    def discard(self, code):
+        """
+        the task of `code` was claimed with `kingdom/task/claim`
+        :return:
+        """
+        self.state.remove_tasks(code)
+        self.freed_at.setdefault(code, time.time())
+
+
+class TaskTracker(_TaskTracker):
+    """
+    `_TaskTracker` for the scheduler jobs of a `LokFarmer`
+    """
+
+    def __init__(self, state, api, scheduler):
+        super().__init__(state, api._id)
+        self.api = api
+        self.scheduler = scheduler
+
+    def tasks(self, code):
+        """
+        :return: current tasks of `code`
+        """
+        if self._overdue(QUEUES):
+            self._load(self.api.kingdom_task_all())
+
+        return self.state.snapshot().tasks_of(code)
+
+    def park(self, name, codes, func, *args, **kwargs):
+        """
+        `Scheduler.park` job `name` until the queue of `codes` is available, or until the deadline of its tasks
+        :return:
+        """
+        self.consumers[name] = codes
+        self.scheduler.park(name, func, *args, timeout=self._timeout(codes), **kwargs)
+
+    def update(self, data):
+        """
+        `/task/update` event
+        :return:
+        """
+        for name in self._update(data):
+            self.scheduler.wakeup(name)
+
+    def resync(self):
+        """
+        reload the tasks after a reconnect of the kingdom websocket, the `/task/update` events may be lost
+        :return:
+        """
+        for name in self._resync(self.api.kingdom_task_all()):
+            self.scheduler.wakeup(name)
+
+
+class AsyncTaskTracker(_TaskTracker):
+    """
+    `_TaskTracker` for the coroutines of an `AsyncLokFarmer`
+    """
+
+    def __init__(self, state, api):
+        super().__init__(state, api._id)
+        self.api = api
+        self.events = {}  # {name: asyncio.Event}
+
+    async def tasks(self, code):
+        if self._overdue(QUEUES):
+            self._load(await self.api.kingdom_task_all())
+
+        return self.state.snapshot().tasks_of(code)
+
+    async def wait(self, name, codes):
+        """
+        wait until the queue of `codes` is available, or until the deadline of its tasks
+        :return:
+        """
+        self.consumers[name] = codes
+        event = self.events.setdefault(name, asyncio.Event())
+
+        try:
+            await asyncio.wait_for(event.wait(), self._timeout(codes))
+        except asyncio.TimeoutError:
+            pass
+
+        event.clear()
+
+    def update(self, data):
+        for name in self._update(data):
+            self.events.setdefault(name, asyncio.Event()).set()
+
+    async def resync(self):
+        for name in self._resync(await self.api.kingdom_task_all()):
+            self.events.setdefault(name, asyncio.Event()).set()
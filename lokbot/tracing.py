@@ -0,0 +1,323 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import os
+import queue
+import threading
+import time
+
+import httpx
+import ratelimit
+
+import lokbot.reaction
+from lokbot import logger, config, project_root
+from lokbot.metrics import quantile
+
+EXPORT_BATCH_SIZE = 256  # spans per OTLP request
+EXPORT_INTERVAL = 5  # seconds between two OTLP requests
+
+KIND_JOB = 'job'
+KIND_POST = 'post'
+
+# accumulated on a span and on its parent when it ends, so a job span sums up the posts it made
+ROLLUP_KEYS = (
+    'post_seconds', 'network_seconds', 'decode_seconds', 'limiter_wait_seconds', 'retry_wait_seconds',
+    'sleep_seconds', 'retries',
+)
+
+_current = contextvars.ContextVar('lokbot_span', default=None)
+
+
+class Span:
+    __slots__ = ('name', 'kind', 'trace_id', 'span_id', 'parent_id', 'start', 'started', 'duration', 'attributes')
+
+    def __init__(self, name, kind, parent, attributes):
+        self.name = name
+        self.kind = kind
+        self.span_id = os.urandom(8).hex()
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.attributes = attributes
+
+    def add(self, key, value):
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'kind': self.kind,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'duration': self.duration,
+            'attributes': self.attributes,
+        }
+
+
+# region exporters
+
+class JsonlExporter:
+    """
+    one JSON line per span, read by `summary`
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str) + '\n'
+
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+
+    return {'stringValue': str(value)}
+
+
+class OtlpExporter:
+    """
+    batches spans to an OTLP/HTTP JSON endpoint like `http://127.0.0.1:4318/v1/traces` from a background thread,
+    spans are dropped when the endpoint is not reachable
+    """
+
+    def __init__(self, endpoint, service_name='lokbot'):
+        self.endpoint = endpoint
+        self.resource = {'attributes': [{'key': 'service.name', 'value': {'stringValue': service_name}}]}
+        self.spans = queue.Queue(EXPORT_BATCH_SIZE * 16)
+        self.opener = httpx.Client(timeout=10)
+
+        threading.Thread(target=self._export_loop, name='tracing-export', daemon=True).start()
+
+    def export(self, span):
+        try:
+            self.spans.put_nowait(span)
+        except queue.Full:
+            pass
+
+    def _to_otlp(self, span):
+        started_at = int(span.start * 1e9)
+        otlp_span = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': 3 if span.kind == KIND_POST else 1,  # SPAN_KIND_CLIENT, SPAN_KIND_INTERNAL
+            'startTimeUnixNano': str(started_at),
+            'endTimeUnixNano': str(started_at + int(span.duration * 1e9)),
+            'attributes': [
+                {'key': key, 'value': _otlp_value(value)}
+                for key, value in dict(span.attributes, **{'lokbot.kind': span.kind}).items()
+            ],
+        }
+        if span.parent_id:
+            otlp_span['parentSpanId'] = span.parent_id
+
+        return otlp_span
+
+    def _export_loop(self):
+        while True:
+            batch = [self.spans.get()]
+            deadline = time.monotonic() + EXPORT_INTERVAL
+            while len(batch) < EXPORT_BATCH_SIZE:
+                try:
+                    batch.append(self.spans.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            body = {'resourceSpans': [{
+                'resource': self.resource,
+                'scopeSpans': [{'scope': {'name': 'lokbot'}, 'spans': [self._to_otlp(span) for span in batch]}],
+            }]}
+            try:
+                self.opener.post(self.endpoint, json=body).raise_for_status()
+            except httpx.HTTPError as e:
+                logger.warning(f'tracing: failed to export {len(batch)} spans to {self.endpoint}: {e}')
+
+
+def _create_exporter(tracing_config):
+    if not tracing_config.get('enabled'):
+        return None
+
+    if tracing_config.get('exporter') == 'otlp':
+        return OtlpExporter(tracing_config.get('endpoint', 'http://127.0.0.1:4318/v1/traces'))
+
+    return JsonlExporter(project_root.joinpath(tracing_config.get('path', 'data/traces.jsonl')))
+
+
+_exporter = _create_exporter(config.get('tracing', {}))
+
+
+# endregion
+
+# region instrumentation
+
+@contextlib.contextmanager
+def span(name, kind=KIND_JOB, **attributes):
+    """
+    time the block as a child of the current span (of the thread or asyncio task), a no-op unless `tracing` is
+    enabled in config.json
+    :return: the span, or None when tracing is disabled
+    """
+    if _exporter is None:
+        yield None
+        return
+
+    parent = _current.get()
+    current = Span(name, kind, parent, attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.attributes['error'] = type(e).__name__
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.started
+        _current.reset(token)
+
+        if parent is not None:
+            parent.add(f'{kind}_seconds', current.duration)
+            for key in ROLLUP_KEYS:
+                if key in current.attributes:
+                    parent.add(key, current.attributes[key])
+
+        _exporter.export(current)
+
+
+def traced(kind=KIND_POST):
+    """
+    decorator running `LokBotApi.post` (or its async counterpart) in a span named after the api path
+    :return:
+    """
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(self, url, *args, **kwargs):
+                with span(str(url).split('/api/').pop(), kind):
+                    return await func(self, url, *args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(self, url, *args, **kwargs):
+            with span(str(url).split('/api/').pop(), kind):
+                return func(self, url, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def add(key, value):
+    """
+    accumulate `value` on the current span, if any, and on the current reaction of `lokbot.reaction`
+    :return:
+    """
+    current = _current.get()
+    if current is not None:
+        current.add(key, value)
+
+    lokbot.reaction.add(key, value)
+
+
+def before_sleep(retry_state):
+    """
+    `before_sleep` of tenacity, accounts the back-off of a retry to the current span
+    :return:
+    """
+    exception = retry_state.outcome.exception()
+    if isinstance(exception, ratelimit.RateLimitException):
+        add('limiter_wait_seconds', retry_state.next_action.sleep)
+        return
+
+    add('retry_wait_seconds', retry_state.next_action.sleep)
+    add('retries', 1)
+
+
+def sleep(seconds):
+    """
+    `time.sleep` accounted as deliberate sleep of the current span
+    :return:
+    """
+    add('sleep_seconds', seconds)
+    time.sleep(seconds)
+
+
+async def async_sleep(seconds):
+    add('sleep_seconds', seconds)
+    await asyncio.sleep(seconds)
+
+
+# endregion
+
+def summary(path, top=10):
+    """
+    :return: {kind: [{name, count, total, p50, p99, max and the mean of `ROLLUP_KEYS`}]} of the slowest first
+    """
+    durations = collections.defaultdict(list)
+    totals = collections.defaultdict(collections.Counter)
+
+    with open(path) as f:
+        for line in f:
+            each_span = json.loads(line)
+            if each_span.get('duration') is None:
+                continue
+
+            key = each_span.get('kind'), each_span.get('name')
+            durations[key].append(each_span.get('duration'))
+            for rollup_key in ROLLUP_KEYS:
+                totals[key][rollup_key] += each_span.get('attributes', {}).get(rollup_key, 0)
+
+    rows = collections.defaultdict(list)
+    for (kind, name), samples in durations.items():
+        rows[kind].append({
+            'name': name,
+            'count': len(samples),
+            'total': sum(samples),
+            'p50': quantile(samples, 0.5),
+            'p99': quantile(samples, 0.99),
+            'max': max(samples),
+            **{key: value / len(samples) for key, value in totals[(kind, name)].items()},
+        })
+
+    return {kind: sorted(each_rows, key=lambda x: x['total'], reverse=True)[:top] for kind, each_rows in rows.items()}
+
+
+def main(path=None, top=10):
+    """
+    `python -m lokbot trace`, the jobs and endpoints that took the most time in a JSONL trace file
+    :param path: `data/traces.jsonl` by default
+    :param top: rows per kind
+    :return:
+    """
+    path = path or project_root.joinpath(config.get('tracing', {}).get('path', 'data/traces.jsonl'))
+
+    columns = ('network_seconds', 'limiter_wait_seconds', 'retry_wait_seconds', 'sleep_seconds')
+    for kind, rows in summary(path, top).items():
+        print(f'{kind:<32} {"count":>7} {"total":>9} {"p50":>8} {"p99":>8}  ' + '  '.join(
+            f'{column.removesuffix("_seconds"):>12}' for column in columns
+        ))
+        for row in rows:
+            print(
+                f'{row["name"]:<32} {row["count"]:>7} {row["total"]:>9.2f} {row["p50"]:>8.3f} {row["p99"]:>8.3f}  '
+                + '  '.join(f'{row.get(column, 0):>12.3f}' for column in columns)
+            )
+        print()
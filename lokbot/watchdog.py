@@ -0,0 +1,117 @@
+import time
+
+from lokbot import logger, metrics
+
+CHECK_INTERVAL = 60  # seconds between two checks of the loops
+TIMEOUT = 3 * 3600  # seconds without heartbeat, longer than the longest sleep of a queue consumer
+DEADLINE_SLACK = 600  # seconds a scheduled job may start late, e.g. behind the other jobs of its lane
+
+
+class Stalled(Exception):
+    """
+    raised by a probe when its loop is known to be stalled, without waiting for the timeout
+    """
+
+
+class Loop:
+    __slots__ = ('name', 'heal', 'timeout', 'progress_timeout', 'probe', 'heartbeat_at', 'progress_at')
+
+    def __init__(self, name, heal, timeout, progress_timeout, probe):
+        self.name = name
+        self.heal = heal
+        self.timeout = timeout
+        self.progress_timeout = progress_timeout
+        self.probe = probe
+        self.heartbeat_at = self.progress_at = time.time()
+
+
+class Watchdog:
+    """
+    Heartbeat and last progress of the long running loops of a farmer, its websockets and its queue consumers.
+
+    A loop beats while it is alive (connected, scheduled) and makes progress when it does its work (receives events).
+    No heartbeat for `timeout` seconds, or no progress for `progress_timeout` seconds, is a stall: `check` calls
+    the `heal` of the loop (reconnect the websocket, re-arm the job), then gives it another timeout to recover.
+    """
+
+    def __init__(self):
+        self.loops = {}
+
+    def register(self, name, heal, timeout=TIMEOUT, progress_timeout=None, probe=None):
+        """
+        :param heal: called on a stall, returns the name of the action taken
+        :param probe: polled by every `check`, returns when the loop was last seen alive, or None, or raises `Stalled`
+        :return:
+        """
+        self.loops[name] = Loop(name, heal, timeout, progress_timeout, probe)
+
+    def beat(self, name, at=None):
+        loop = self.loops.get(name)
+        if loop is not None:
+            loop.heartbeat_at = max(loop.heartbeat_at, at or time.time())
+
+    def progress(self, name):
+        loop = self.loops.get(name)
+        if loop is not None:
+            loop.heartbeat_at = loop.progress_at = time.time()
+
+    def _stall(self, loop, now):
+        """
+        :return: why `loop` is stalled, or None
+        """
+        if loop.probe is not None:
+            try:
+                seen_at = loop.probe()
+            except Stalled as e:
+                return str(e)
+
+            if seen_at is not None:
+                self.beat(loop.name, seen_at)
+
+        if now - loop.heartbeat_at > loop.timeout:
+            return f'no heartbeat for {now - loop.heartbeat_at:.0f}s'
+
+        if loop.progress_timeout is not None and now - loop.progress_at > loop.progress_timeout:
+            return f'no progress for {now - loop.progress_at:.0f}s'
+
+        return None
+
+    def check(self):
+        """
+        heal the stalled loops, every `CHECK_INTERVAL` seconds
+        :return: names of the healed loops
+        """
+        now = time.time()
+        healed = []
+
+        for loop in list(self.loops.values()):
+            stall = self._stall(loop, now)
+            metrics.gauge('watchdog_stalled', int(stall is not None), loop=loop.name)
+            if stall is None:
+                continue
+
+            try:
+                action = loop.heal()
+            except Exception as e:
+                logger.exception(f'watchdog: failed to heal {loop.name}: {e}')
+                action = 'failed'
+
+            metrics.inc('watchdog_interventions', loop=loop.name, action=action)
+            logger.warning(f'watchdog: {loop.name} stalled, {stall}, {action}')
+
+            loop.heartbeat_at = loop.progress_at = now
+            healed.append(loop.name)
+
+        return healed
+
+    def states(self):
+        """
+        introspection of every loop, seconds since its last heartbeat and progress
+        :return:
+        """
+        now = time.time()
+
+        return {
+            name: {'heartbeat': now - loop.heartbeat_at, 'progress': now - loop.progress_at}
+            for name, loop in self.loops.items()
+        }
@@ -0,0 +1,179 @@
+import heapq
+import json
+import math
+import os
+import threading
+import time
+
+import lokbot.metrics
+import lokbot.util
+from lokbot import logger
+from lokbot.field_stats import FieldStats
+
+ZONE_SIZE = 32  # coords, see `lokbot.util.get_zone_id_by_coords`
+ZONES_PER_ROW = 64
+LAND_SIZE = 8  # coords
+LANDS_PER_ROW = 256
+LAND_ID_START = 100000
+
+LEVEL_WEIGHT = 1.0
+DISTANCE_WEIGHT = 1.0
+FIND_RATE_WEIGHT = 2.0
+FIND_RATE_PRIOR = 2  # scans a zone is assumed to have had before its own history counts
+FIND_HISTORY = 50  # scans after which the history of a zone is halved, so old finds fade out
+
+
+def zone_land_ids(zone_id):
+    """
+    the 4x4 lands of a zone
+    :return:
+    """
+    lands_per_zone = ZONE_SIZE // LAND_SIZE
+    row, column = divmod(zone_id, ZONES_PER_ROW)
+
+    return [
+        LAND_ID_START + (row * lands_per_zone + i) * LANDS_PER_ROW + column * lands_per_zone + j
+        for i in range(lands_per_zone) for j in range(lands_per_zone)
+    ]
+
+
+def zone_center(zone_id):
+    row, column = divmod(zone_id, ZONES_PER_ROW)
+
+    return column * ZONE_SIZE + ZONE_SIZE // 2, row * ZONE_SIZE + ZONE_SIZE // 2
+
+
+class ZoneScheduler:
+    """
+    Hands out the zones around the kingdom in batches, the most valuable ones first.
+
+    A zone scores higher on leveled land (devrank), close to `center` and where targets were found before.
+    Every cycle pops each zone once from a heap; the zones scanned in the current cycle and the find history are
+    saved to `path`, so the next run continues the cycle instead of starting over from the first zone.
+    Zones where `field_stats` expects nothing new since their last scan are skipped for the cycle.
+    """
+
+    def __init__(self, zones, center, land_with_level=None, path=None):
+        self.zones = list(dict.fromkeys(zones))
+        self.center = center  # (x, y)
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.cycle = 0
+        self.scanned = set()
+        self.stats = {}  # {zone_id: [scans, finds]}
+        self.field_stats = FieldStats()
+        self._heap = []
+
+        land_levels = {}
+        for level, land_ids in enumerate(land_with_level or []):
+            for land_id in land_ids:
+                land_levels[land_id] = level
+
+        self.levels = {
+            zone_id: sum(land_levels.get(land_id, 0) for land_id in zone_land_ids(zone_id)) / 16
+            for zone_id in self.zones
+        }
+        self.distances = {zone_id: math.dist(zone_center(zone_id), center) for zone_id in self.zones}
+        self.max_distance = max(self.distances.values(), default=0) or 1
+
+        self.load()
+        self._fill()
+
+    def score(self, zone_id):
+        scans, finds = self.stats.get(zone_id, (0, 0))
+
+        return LEVEL_WEIGHT * self.levels[zone_id] / 10 + \
+            DISTANCE_WEIGHT * (1 - self.distances[zone_id] / self.max_distance) + \
+            FIND_RATE_WEIGHT * finds / (scans + FIND_RATE_PRIOR)
+
+    def _fill(self):
+        self._heap = [(-self.score(zone_id), zone_id) for zone_id in self.zones if zone_id not in self.scanned]
+        heapq.heapify(self._heap)
+
+    def next_batch(self, size):
+        """
+        the next `size` due zones of the cycle, starting a new cycle (with fresh scores) when it runs out
+        :return: fewer than `size` zones if not that many are due, after looking at every zone once
+        """
+        batch = []
+        now = time.time()
+        field_rate = self.field_stats.field_rate()
+
+        with self.lock:
+            for _ in range(len(self.zones)):
+                if len(batch) >= size:
+                    break
+
+                if not self._heap:
+                    self.cycle += 1
+                    self.scanned.clear()
+                    self._fill()
+                    logger.debug(f'zone scan cycle {self.cycle} started')
+
+                _, zone_id = heapq.heappop(self._heap)
+                if zone_id in batch:
+                    continue
+
+                self.scanned.add(zone_id)
+                if self.field_stats.is_due(zone_id, now, field_rate):
+                    batch.append(zone_id)
+                else:
+                    lokbot.metrics.inc('field_zones_skipped')
+
+        return batch
+
+    def record(self, zone_ids, objects):
+        """
+        account a scan of `zone_ids`, `objects` are the targets found in them
+        :return:
+        """
+        with self.lock:
+            for zone_id in zone_ids:
+                stat = self.stats.setdefault(zone_id, [0, 0])
+                stat[0] += 1
+                if stat[0] > FIND_HISTORY:
+                    stat[0] //= 2
+                    stat[1] //= 2
+
+            for each_obj in objects:
+                loc = each_obj.get('loc')
+                zone_id = lokbot.util.get_zone_id_by_coords(loc[1], loc[2])
+                if zone_id in zone_ids:
+                    self.stats[zone_id][1] += 1
+
+            self.field_stats.observe(zone_ids, objects)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f'failed to load zone scan state from {self.path}: {e}')
+            return
+
+        self.cycle = data.get('cycle', 0)
+        self.scanned = set(data.get('scanned', [])).intersection(self.zones)
+        self.stats = {int(zone_id): stat for zone_id, stat in data.get('stats', {}).items()}
+        self.field_stats.load_dict(data.get('respawn', {}))
+
+    def save(self):
+        if not self.path:
+            return
+
+        with self.lock:
+            data = {
+                'cycle': self.cycle,
+                'scanned': sorted(self.scanned),
+                'stats': {str(zone_id): stat for zone_id, stat in self.stats.items()},
+                'respawn': self.field_stats.to_dict(),
+            }
+
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+
+        os.replace(tmp_path, self.path)
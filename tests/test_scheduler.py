@@ -0,0 +1,34 @@
+import threading
+import time
+import unittest
+
+from lokbot.scheduler import Scheduler, JOB_STATE_READY
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler(workers=1, lanes={})
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def test_continuation_armed_while_ready(self):
+        blocked = threading.Event()
+        runs = []
+
+        # the only default worker is busy, `x` stays READY behind it
+        self.scheduler.submit('block', blocked.wait, 5)
+        self.scheduler.call_later('x', 0, runs.append, 1)
+        time.sleep(0.1)
+        self.assertEqual(self.scheduler._jobs['x'].state, JOB_STATE_READY)
+
+        self.scheduler.call_later('x', 0.3, runs.append, 2)
+        blocked.set()
+
+        # the READY run, then the continuation armed meanwhile
+        time.sleep(0.6)
+        self.assertEqual(len(runs), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()